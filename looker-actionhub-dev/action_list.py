@@ -0,0 +1,122 @@
+# Import libs
+import base64
+import gzip
+import hashlib
+import json
+import threading
+
+from flask import Response
+
+# Brotli is optional: if it is not installed the payloads are only served as gzip or identity
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class CachedPayload():
+    """
+    Response body encoded once and kept in memory together with its compressed variants and ETag.
+    """
+    def __init__(self, body, mimetype, compress=True, max_age=0):
+        self.body = body
+        self.mimetype = mimetype
+        self.max_age = max_age
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+
+        # Preferred encodings first, ties in the client Accept-Encoding are resolved in this order
+        self.encodings = {}
+        if compress:
+            if brotli is not None:
+                self.encodings["br"] = brotli.compress(body, quality=11)
+            self.encodings["gzip"] = gzip.compress(body, compresslevel=9)
+        self.encodings["identity"] = body
+
+    def to_response(self, request):
+        """
+        Builds the Flask response for the request, answering 304 when the client already has this version
+
+        :param request:             Flask request being served
+        :return response:           Flask response with the best encoding accepted by the client
+        """
+        if request.if_none_match.contains(self.etag):
+            response = Response(status=304)
+        else:
+            encoding = request.accept_encodings.best_match(list(self.encodings), default="identity")
+            response = Response(self.encodings[encoding], mimetype=self.mimetype)
+            if encoding != "identity":
+                response.headers["Content-Encoding"] = encoding
+
+        response.set_etag(self.etag)
+        response.headers["Vary"] = "Accept-Encoding"
+        if self.max_age > 0:
+            response.headers["Cache-Control"] = f"public, max-age={self.max_age}"
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+
+        return response
+
+
+class ActionListCache():
+    """
+    Builds the /list payload and the action icons once per process and serves them as pre-encoded bytes.
+    """
+    def __init__(self, build_action_list, inline_icons=True, icon_max_age=86400):
+        """
+        :param build_action_list:   Function returning the /list payload as a dict, called only once
+        :param inline_icons:        Keep the base64 icon_data_uri inside /list. If False the icons are
+                                    only served by the /icons/<name> endpoint
+        :param icon_max_age:        Seconds the clients are allowed to cache the icons
+        """
+        self.__build_action_list = build_action_list
+        self.inline_icons = inline_icons
+        self.icon_max_age = icon_max_age
+        self.__lock = threading.Lock()
+        self.__list_payload = None
+        self.__icons = {}
+
+    def __build(self):
+        action_list = self.__build_action_list()
+
+        icons = {}
+        for integration in action_list["integrations"]:
+            icon_data_uri = integration.get("icon_data_uri")
+            if icon_data_uri is None:
+                continue
+
+            # data:<mimetype>;base64,<data>
+            header, data = icon_data_uri.split(",", 1)
+            mimetype = header[len("data:"):].split(";")[0]
+            icons[integration["name"]] = CachedPayload(base64.b64decode(data), mimetype, compress=False, max_age=self.icon_max_age)
+
+            if not self.inline_icons:
+                del integration["icon_data_uri"]
+
+        body = json.dumps(action_list, separators=(",", ":")).encode("utf-8")
+
+        self.__icons = icons
+        self.__list_payload = CachedPayload(body, "application/json")
+
+    def get_list(self):
+        """
+        Returns the cached /list payload, building it on the first call
+
+        :return payload:            CachedPayload of the action list
+        """
+        if self.__list_payload is None:
+            with self.__lock:
+                # Another request may have built it while waiting for the lock
+                if self.__list_payload is None:
+                    self.__build()
+
+        return self.__list_payload
+
+    def get_icon(self, name):
+        """
+        Returns the cached icon of an integration
+
+        :param name:                Name of the integration
+        :return payload:            CachedPayload of the icon, None if the integration has no icon
+        """
+        self.get_list()
+        return self.__icons.get(name)
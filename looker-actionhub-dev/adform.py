@@ -1,57 +1,172 @@
 # Import libs
-import json
-import pandas as pd
+import hashlib
+import os
+import threading
+import time
+
 import requests
 
+from clients import get_http_session
+
+
+# Responses retried with backoff. 5xx are only retried for the requests that can be repeated safely
+RETRY_ALWAYS_STATUSES = {429}
+RETRY_IDEMPOTENT_STATUSES = {500, 502, 503, 504}
+
+
+class AdformTokenCache():
+    """
+    Process-wide cache of the client_credentials tokens, refreshed <refresh_margin> seconds before they expire
+    """
+    def __init__(self, refresh_margin=60):
+        """
+        :param refresh_margin:      Seconds before the expiration a token is considered expired
+        """
+        self.refresh_margin = refresh_margin
+        self.requests = 0
+        self.__tokens = {}
+        self.__lock = threading.Lock()
+        self.__key_locks = {}
+
+    def get(self, client_id, client_secret, fetch_token):
+        """
+        Returns a valid token of a client, only one request per client fetches a new one
+
+        :param fetch_token:         Function that requests a new token, returns (access_token, expires_in)
+        """
+        key = (client_id, hashlib.sha256(client_secret.encode("utf-8")).hexdigest())
+        with self.__lock:
+            key_lock = self.__key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            entry = self.__tokens.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                return entry[0]
+
+            access_token, expires_in = fetch_token()
+            self.requests += 1
+            self.__tokens[key] = (access_token, time.monotonic() + max(int(expires_in) - self.refresh_margin, 0))
+            return access_token
+
+    def invalidate(self, client_id, client_secret):
+        key = (client_id, hashlib.sha256(client_secret.encode("utf-8")).hexdigest())
+        self.__tokens.pop(key, None)
+
+
+class AdformSegmentIndex():
+    """
+    Process-wide index of the DMP segments by refId, filled from the searches and the segments created
+    """
+    def __init__(self, ttl=21600):
+        """
+        :param ttl:                 Seconds a segment is kept in the index
+        """
+        self.ttl = ttl
+        self.__segments = {}
+        self.__lock = threading.Lock()
+
+    def get(self, client_id, ref_id):
+        with self.__lock:
+            entry = self.__segments.get((client_id, ref_id))
+            if entry is not None and entry[1] > time.monotonic():
+                return entry[0]
+            return None
+
+    def add(self, client_id, segments):
+        with self.__lock:
+            expires_at = time.monotonic() + self.ttl
+            for segment in segments:
+                if isinstance(segment, dict) and segment.get("refId") is not None:
+                    self.__segments[(client_id, segment["refId"])] = (segment, expires_at)
+
+
+token_cache = AdformTokenCache(refresh_margin = int(os.environ.get("adform_token_refresh_margin", "60")))
+segment_index = AdformSegmentIndex(ttl = int(os.environ.get("adform_segment_cache_ttl", "21600")))
+
 
 class AdformSession():
     def __init__(self, client_id, client_secret):
         self.client_id = client_id
         self.client_secret = client_secret
-        self.__access_token = self.__get_access_token()
+        self.api_url = os.environ.get("adform_api_url", "https://api.adform.com").rstrip("/")
+        self.token_url = os.environ.get("adform_token_url", "https://id.adform.com/sts/connect/token")
+        self.timeout = (float(os.environ.get("adform_connect_timeout", "10")), float(os.environ.get("adform_read_timeout", "60")))
+        self.retries = int(os.environ.get("adform_retries", "3"))
+        self.backoff = float(os.environ.get("adform_retry_backoff", "0.5"))
 
-    def __get_access_token(self):
+    def __request(self, method, url, idempotent, **kwargs):
         """
-        Get access token from Adform API fro generating report
+        Sends a request through the shared pooled session, retrying with exponential backoff
 
-        :return response: Access token
+        :param idempotent:          True if the request can be repeated when the server failed
         """
+        retry_statuses = RETRY_ALWAYS_STATUSES | (RETRY_IDEMPOTENT_STATUSES if idempotent else set())
+        for attempt in range(self.retries + 1):
+            retry_after = ""
+            try:
+                response = get_http_session().request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if not idempotent or attempt == self.retries:
+                    raise
+            else:
+                if response.status_code not in retry_statuses or attempt == self.retries:
+                    return response
+                retry_after = response.headers.get("Retry-After", "")
 
-        url = "https://id.adform.com/sts/connect/token"
-        headers = {"content-type": "application/x-www-form-urlencoded"}
+            # Retry-After is honoured when the server sends it in seconds
+            time.sleep(float(retry_after) if retry_after.isdigit() else self.backoff * 2 ** attempt)
+
+    def __fetch_access_token(self):
         body = {
             "grant_type": "client_credentials",
             "client_id": self.client_id,
             "client_secret": self.client_secret,
             "scope": "https://api.adform.com/scope/dmp.segments https://api.adform.com/scope/dmp.segments.readonly https://api.adform.com/scope/dmp.categories https://api.adform.com/scope/dmp.reports.readonly https://api.adform.com/scope/dmp.categories.readonly https://api.adform.com/scope/dmp.accountpermissions https://api.adform.com/scope/dmp.accountpermissions.readonly"
             }
-        
-        response = requests.post(url, headers=headers, data=body)
-        access_token = response.json()["access_token"]
-        return access_token
+        headers = {"content-type": "application/x-www-form-urlencoded"}
 
-    def search_segment(self, search_string:str):
+        response = self.__request("POST", self.token_url, idempotent=True, headers=headers, data=body)
+        response.raise_for_status()
+        token = response.json()
+        return token["access_token"], token.get("expires_in", 3600)
+
+    def __get_access_token(self):
         """
-        Search for a segment in the DMP starting from its name as <search_string>. 
+        Get access token from Adform API fro generating report. Tokens are cached by the process until they are about to expire
 
-        A list of items containing the segments details is returned
+        :return response: Access token
         """
+        return token_cache.get(self.client_id, self.client_secret, self.__fetch_access_token)
 
-        url = f"https://api.adform.com/v1/dmp/segments?search={search_string}"
-        headers = {
-            'Accept': 'application/json',
-            'Authorization': f'Bearer {self.__access_token}'
-            }
+    def __api_request(self, method, path, idempotent, headers, **kwargs):
+        # An expired or revoked token is refreshed once
+        for attempt in range(2):
+            headers = {**headers, 'Authorization': f'Bearer {self.__get_access_token()}'}
+            response = self.__request(method, f"{self.api_url}{path}", idempotent, headers=headers, **kwargs)
+            if response.status_code != 401 or attempt == 1:
+                return response
+            token_cache.invalidate(self.client_id, self.client_secret)
 
-        response = requests.get(url, headers=headers)
-        segments = response.json()
-        for segment in segments:
-          if segment["refId"] == search_string:
+    def search_segment(self, search_string:str):
+        """
+        Search for a segment in the DMP starting from its name as <search_string>.
+
+        The segment with refId <search_string> is returned, an empty list if it does not exist.
+        Segments found are kept in an index by refId, the search is only sent to the DMP on a miss
+        """
+        segment = segment_index.get(self.client_id, search_string)
+        if segment is not None:
             return segment
-            
-        return segments
 
-    def create_segment(self, 
+        headers = {'Accept': 'application/json'}
+        response = self.__api_request("GET", "/v1/dmp/segments", True, headers, params={"search": search_string})
+        segments = response.json()
+        segment_index.add(self.client_id, segments)
+
+        segment = segment_index.get(self.client_id, search_string)
+        return segment if segment is not None else []
+
+    def create_segment(self,
         DataProviderId: int,
         CategoryId: int,
         RefId: str,
@@ -61,16 +176,13 @@ class AdformSession():
         Frequency: int,
         Status = "active"):
         """
-        Creates a segment for a defined "provider" within the Adfrom DMP. 
-        
+        Creates a segment for a defined "provider" within the Adfrom DMP.
+
         If the request is successful, a list with all the details of the created segment is returned.
         """
-
-        url = "https://api.adform.com/v1/dmp/segments"
         headers = {
             'Accept': 'application/json',
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.__access_token}'
+            'Content-Type': 'application/json'
             }
         body = {
             "DataProviderId": DataProviderId,
@@ -83,5 +195,7 @@ class AdformSession():
             "Frequency": Frequency
             }
 
-        response = requests.post(url, headers=headers, json=body)
-        return response.json()
+        response = self.__api_request("POST", "/v1/dmp/segments", False, headers, json=body)
+        segment = response.json()
+        segment_index.add(self.client_id, [segment])
+        return segment
@@ -0,0 +1,193 @@
+# Import libs
+import json
+import os
+import threading
+import time
+
+from clients import get_logger
+
+
+logger = get_logger('looker-actionhub')
+
+MB = 1024 * 1024
+
+# Estimated memory used by a run of each action on top of the idle process, in MB
+DEFAULT_ACTION_COSTS = {
+    "sftp_upload": 64,
+    "adform_upload": 128,
+    "googleads_upload": 256
+}
+
+# Runs of each action allowed at the same time in an instance
+DEFAULT_ACTION_LIMITS = {
+    "sftp_upload": 4,
+    "adform_upload": 2,
+    "googleads_upload": 1
+}
+
+
+def _read_int(path):
+    try:
+        with open(path) as file:
+            value = file.read().strip()
+    except OSError:
+        return None
+    return int(value) if value.isdigit() else None
+
+
+def get_memory_limit():
+    """
+    Memory limit of the container from its cgroup (v2 or v1)
+
+    :return                         Limit in bytes, None if it is not limited or unknown
+    """
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        limit = _read_int(path)
+        # cgroup v1 reports a huge number when there is no limit
+        if limit is not None and limit < 1 << 60:
+            return limit
+    return None
+
+
+def get_memory_usage():
+    """
+    Memory used by the container. The cgroup usage also counts the files written to the in-memory /tmp,
+    the resident memory of the process is used when there is no cgroup
+
+    :return                         Usage in bytes
+    """
+    for path in ("/sys/fs/cgroup/memory.current", "/sys/fs/cgroup/memory/memory.usage_in_bytes"):
+        usage = _read_int(path)
+        if usage is not None:
+            return usage
+
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class AdmissionTicket():
+    """
+    Admission of a run of an action, released when the run finishes
+    """
+    def __init__(self, action, cost):
+        self.action = action
+        self.cost = cost
+        self.admitted_at = time.time()
+
+
+class AdmissionController():
+    """
+    Admits the runs of the actions while the instance has memory left for them.
+
+    Each action has an estimated cost and a limit of concurrent runs. A run is admitted if the memory in use
+    (the live usage, or the idle usage plus the costs of the runs admitted, whichever is higher) leaves room
+    for its cost within the budget. Runs that do not fit wait until another one finishes or the timeout expires.
+    A run is always admitted when nothing else is running, so an action never waits forever for itself.
+    """
+    def __init__(self, memory_budget, action_costs=None, action_limits=None, default_cost=128 * MB, default_limit=2):
+        """
+        :param memory_budget:       Bytes of memory the instance may use
+        :param action_costs:        Dict action -> estimated bytes used by a run
+        :param action_limits:       Dict action -> runs allowed at the same time
+        :param default_cost:        Cost of the actions not in <action_costs>
+        :param default_limit:       Limit of the actions not in <action_limits>
+        """
+        self.memory_budget = memory_budget
+        self.action_costs = action_costs or {}
+        self.action_limits = action_limits or {}
+        self.default_cost = default_cost
+        self.default_limit = default_limit
+        self.baseline = get_memory_usage()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.__running = {}
+        self.__reserved = 0
+        self.__condition = threading.Condition()
+
+    def __fits(self, action, cost):
+        if self.__running.get(action, 0) >= self.action_limits.get(action, self.default_limit):
+            return False
+
+        if self.__reserved == 0:
+            return True
+
+        in_use = max(get_memory_usage(), self.baseline + self.__reserved)
+        return in_use + cost <= self.memory_budget
+
+    def admit(self, action, timeout=0):
+        """
+        Admits a run of an action, waiting up to <timeout> seconds for room
+
+        :param action:              Name of the action
+        :param timeout:             Seconds to wait, 0 to answer right away and None to wait without limit
+        :return                     AdmissionTicket to release when the run finishes, None if it was not admitted
+        """
+        cost = self.action_costs.get(action, self.default_cost)
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self.__condition:
+            is_queued = False
+            # The live usage changes without notifications, so the waits are short
+            while not self.__fits(action, cost):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self.rejected += 1
+                    if is_queued:
+                        self.queued -= 1
+                    logger.log_text(f"Action {action} rejected, {self.__running} running and {get_memory_usage() // MB}MB in use", severity='WARNING')
+                    return None
+
+                if not is_queued:
+                    is_queued = True
+                    self.queued += 1
+                self.__condition.wait(1 if remaining is None else min(remaining, 1))
+
+            if is_queued:
+                self.queued -= 1
+            self.__running[action] = self.__running.get(action, 0) + 1
+            self.__reserved += cost
+            self.admitted += 1
+
+        return AdmissionTicket(action, cost)
+
+    def release(self, ticket):
+        """
+        Frees the room taken by an admitted run
+        """
+        with self.__condition:
+            self.__running[ticket.action] -= 1
+            self.__reserved -= ticket.cost
+            self.__condition.notify_all()
+
+    def stats(self):
+        with self.__condition:
+            return {
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "running": dict(self.__running),
+                "reserved_mb": self.__reserved // MB,
+                "memory_in_use_mb": get_memory_usage() // MB,
+                "memory_budget_mb": self.memory_budget // MB
+            }
+
+
+def new_admission_controller():
+    """
+    Creates the controller configured from the env variables. The budget is a fraction (admission_memory_fraction)
+    of admission_memory_limit_mb, or of the cgroup limit of the container when it is not set
+    """
+    memory_limit = int(os.environ.get("admission_memory_limit_mb", "0")) * MB or get_memory_limit() or 512 * MB
+
+    action_costs = {**DEFAULT_ACTION_COSTS, **json.loads(os.environ.get("admission_action_costs_mb", "{}"))}
+    action_limits = {**DEFAULT_ACTION_LIMITS, **json.loads(os.environ.get("admission_action_limits", "{}"))}
+
+    return AdmissionController(
+        int(memory_limit * float(os.environ.get("admission_memory_fraction", "0.85"))),
+        action_costs = {action: cost * MB for action, cost in action_costs.items()},
+        action_limits = action_limits
+    )
+
+
+admission_controller = new_admission_controller()
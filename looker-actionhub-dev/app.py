@@ -2,39 +2,33 @@
 
 import json
 import os
+import posixpath
+import sys
 from datetime import datetime, timedelta
 
-import googleapiclient.discovery
 import google.auth
 import google.auth.exceptions
-import pandas as pd
-import pysftp
-from flask import Flask, jsonify, request
-from google.cloud import logging, bigquery
-from waitress import serve
-from google.oauth2 import service_account
-import googleapiclient.discovery
-import s3fs
-import boto3
-from adform import AdformSession
-from google_ads import GoogleAdsSession
-
-from utils import is_activation_updated, append_f_looker_sent
-
-logging_client = logging.Client()
+from flask import Flask, Response, jsonify, request
+from waitress import create_server
+from action_list import ActionListCache
+from admission import admission_controller
+from batched_logging import flush_loggers_on_sigterm
+from bq_reader import read_query
+from clients import get_env_prefixes, get_logger, get_project_id, get_s3_client
+from freshness import freshness_gate
+from jobs import JobManager, report_bytes, report_rows, report_stage
+from metrics import render_metrics, trace_action
+from payload_recorder import payload_recorder
+from prewarm import start_prewarm
+from sent_ledger import get_sent_ledger, sent_ledgers_stats
+
+from utils import is_activation_updated, numeric_customer_codes, prepare_f_looker_sent
+
+# The channel SDKs and the modules built on pandas/pyarrow are imported by the actions that use them,
+# so a cold start serving /list or a form does not load them. See prewarm.py
 
 log_name = 'looker-actionhub'
-logger = logging_client.logger(log_name)
-
-def get_project_id():
-    """Find the GCP project ID when running on Cloud Run."""
-    try:
-        _, project_id = google.auth.default()
-    except google.auth.exceptions.DefaultCredentialsError:
-        # Probably running a local development server.
-        project_id = os.environ.get('GOOGLE_CLOUD_PROJECT', 'development')
-
-    return project_id
+logger = get_logger(log_name)
 
 def get_service_url():
     """Return the URL for this service, depending on the environment.
@@ -44,6 +38,7 @@ def get_service_url():
     """
     # https://cloud.google.com/run/docs/reference/rest/v1/namespaces.services/list
     try:
+        import googleapiclient.discovery
         service = googleapiclient.discovery.build('run', 'v1')
     except google.auth.exceptions.DefaultCredentialsError:
         # Probably running the local development server.
@@ -71,65 +66,52 @@ def get_service_url():
 
 
 
-cnopts = pysftp.CnOpts()
-cnopts.hostkeys = None
-
 my_api = Flask(__name__)
 
 
-# ENDPOINT 2: execute
-@my_api.route('/sftp_upload/execute', methods=['POST'])
-def sendfile():
-    
+def run_sftp_upload(request_json, restarted_after=None):
+    """
+    Action that sends the Looker CSV to the SFMC SFTP server and optionally loads it in BigQuery.
+
+    :param request_json:            Request sent by Looker
+    :param restarted_after:         SENT_DATETIME of the interrupted attempt, when it was discarded and the delivery starts over
+    :return                         Dict with the response expected by Looker
+    """
+    import pandas as pd
+    from bq_writer import new_bigquery_writer
+    from checkpoints import CheckpointMismatch, discard_delivery, open_checkpoint, resume_sftp_file
+    from json_rows import dataframe_to_json_rows
+    from sftp_pipeline import new_sftp_upload_pipeline
+    from sftp_pool import open_pipelined, sftp_pool
+
     # Extract current date and time UTC+1
     time_now = (datetime.now() + timedelta(hours=1)).replace(microsecond=0)
     time_now_str = time_now.strftime("%Y%m%d_%H%M%S")
     date_now = time_now.date()
     date_now_str = date_now.strftime("%Y%m%d")
-    timedelta_days = os.environ.get("days_check_updates", "0") # timedelta must be 0 in production (current date)
-    date_today = date_now - timedelta(days=int(timedelta_days)) # for test purposes maybe we want to allow another date different from the current date
-    date_today_str = date_today.strftime("%Y%m%d")
 
     # Data for BQ auth
-    project_id = get_project_id()
-    if "dev-" in project_id: 
-        prefix_project = "dev-"
-        prefix_dataset = "dev_"
-    elif "test-" in project_id: 
-        prefix_project = "test-"
-        prefix_dataset = "test_"
-    else: 
-        prefix_project = "prod-"
-        prefix_dataset = ""
+    prefix_project, prefix_dataset = get_env_prefixes()
 
     logger.log_text("Checking if all tables in activation layer are updated...", severity='DEFAULT')
     
-    client = bigquery.Client()
-    query = f"""
-        SELECT MIN(LAST_UPDATE_DATE)
-        FROM `{prefix_project}cross-cloud4marketing.{prefix_dataset}clz_c4m_curated.TABLES_LAST_UPDATE`
-        WHERE DATASET_NAME = '{prefix_dataset}clz_c4m_public_activation'
-    """
-    # Run query and extract result
-    df_result = client.query(query).to_dataframe()
-    date_last_update_str = df_result.iloc[0,0].strftime("%Y%m%d")
+    is_updated, date_last_update_str, date_today_str = freshness_gate.check(prefix_project, prefix_dataset)
 
     # Check if activation tables are NOT updated yet
-    if (date_last_update_str < date_today_str):
+    if not is_updated:
         error_message = f"Action NOT performed, tables were updated on {date_last_update_str} and min date allowed is {date_today_str}!"
         logger.log_text(error_message, severity='WARNING')
-        message = jsonify({
+        message = {
                 "looker": {
                     "success": False,
                     "message": error_message
                     }
-            })
+            }
         return message
 
     logger.log_text("Tables are updated! Checking if action already perfomed today...", severity='DEFAULT')
 
-    # Obtain Looker request
-    request_json = request.get_json()
+    sent_ledger = get_sent_ledger(prefix_project, prefix_dataset)
 
     # Extract data from the form
     brand = request_json["form_params"].get("brand", "")
@@ -164,7 +146,34 @@ def sendfile():
     report_name = request_json["scheduled_plan"]["title"]
 
     send_to_bq = ((dataset_id != "") & (table_id != ""))
+    table_ref = f'{dataset_id}.{table_id}' if send_to_bq else None
+
+    # When the file only needs to be relayed to the SFTP server it is not parsed at all
+    passthrough = (not send_to_bq) and os.environ.get("sftp_passthrough", "false").lower() == "true"
+
+    # A retry of a delivery interrupted today resumes from its checkpoint, see checkpoints.py
+    checkpoint = open_checkpoint("sftp_upload", request_json, date_now_str)
+    if checkpoint is not None and checkpoint.completed:
+        logger.log_text(f"Delivery {checkpoint.run_key} already completed today, nothing to do", severity='DEFAULT')
+        return {
+            "looker": {
+                "success": True
+                }
+        }
+    resumed = checkpoint is not None and checkpoint.is_resumed
+    # The ledger already has the send of the interrupted attempt, it must not stop its retry
+    is_redelivery = resumed or restarted_after is not None
+    if resumed:
+        # The retry writes the same file and loads the rows with the same SENT_DATETIME
+        time_now = checkpoint.sent_datetime
+        time_now_str = time_now.strftime("%Y%m%d_%H%M%S")
+        logger.log_text(f"Resuming delivery {checkpoint.run_key}: {checkpoint.sftp_bytes} bytes in the SFTP file, {checkpoint.bq_rows} rows in BigQuery", severity='INFO')
     
+    if restarted_after is not None and time_now <= restarted_after:
+        # Restarted within the second of the discarded attempt, its load job ids must not be reused
+        time_now = restarted_after + timedelta(seconds=1)
+        time_now_str = time_now.strftime("%Y%m%d_%H%M%S")
+
     # Generate filename from extracted date and time
     file_name = f"{report_name}_{time_now_str}.csv"
 
@@ -172,23 +181,83 @@ def sendfile():
     chars_to_replace = ["/","\\",":","*","?","\"","<",">","|"]
     for char in chars_to_replace:
         file_name = file_name.replace(char, " ")
+    file_path = posixpath.join(path_sftp, file_name)
 
-    # Create a BQ connection if needed
+    # Create a BQ writer if needed, all the chunks are loaded with a single load job
+    bq_writer = None
     if send_to_bq:
-        client = bigquery.Client()
-        table_ref = f'{dataset_id}.{table_id}'
-        job_config = bigquery.LoadJobConfig(create_disposition="CREATE_NEVER",
-                                            write_disposition="WRITE_APPEND")
+        if checkpoint is None:
+            bq_writer = new_bigquery_writer(table_ref)
+        else:
+            # The ids of the load jobs do not change between attempts, BigQuery rejects a load done twice
+            bq_writer = new_bigquery_writer(table_ref, job_id_prefix=f"actionhub_sftp_{checkpoint.run_key}_{time_now_str}", on_commit=checkpoint.record_bigquery, rows_offset=checkpoint.bq_rows)
+        sent_campaign_codes = set()
 
     header=True
     success = False
     is_file_created = False
-    with pysftp.Connection(host=host, username=user, password=password, port=int(port_sftp), cnopts=cnopts) as sftp:
-        success = True  # Connection succeeded
-        with sftp.cd(path_sftp):    # Temporally select directory to load files
-            with pd.read_csv(url_download, dtype=str, index_col=0, chunksize=100000) as content_df: # Read a chunk from URL
+    restart = False
+    file_offset = 0
+
+    def open_sftp_file(sftp):
+        # Open or create the file in server, writes are pipelined. A resumed delivery continues its file
+        nonlocal file_offset, header
+        if checkpoint is not None:
+            mode = "passthrough" if passthrough else "rows"
+            if checkpoint.state["mode"] not in (None, mode):
+                raise CheckpointMismatch(f"Delivery {checkpoint.run_key} was started in another mode")
+            checkpoint.start(mode, time_now, file_path)
+            file_offset = resume_sftp_file(sftp, checkpoint, file_path)
+            header = file_offset == 0
+        return open_pipelined(sftp, file_path)
+
+    def record_sftp_progress(position):
+        # Called by the writer once the content up to <position> of the CSV is written
+        return lambda bytes_written: checkpoint.record_sftp(position, file_offset + bytes_written)
+
+    # Download, CSV encoding and SFTP writes run concurrently
+    pipeline = new_sftp_upload_pipeline(url_download)
+    pipeline.start_download()
+    try:
+        # Connections of the same user are reused across requests, see sftp_pool.py
+        with sftp_pool.connection(host, port_sftp, user, password) as sftp:
+            success = True  # Connection succeeded
+            if passthrough:
+                # Check if action already performed today with the first row of the CSV
+                first_row = pipeline.peek_first_row()
+                if first_row is None:
+                    logger.log_text(f'sftp_upload - CSV received is empty', severity='WARNING')
+                else:
+                    date_last_update_str = sent_ledger.last_sent("MKT", brand, first_row["CampaignID"], date_now)
+                    if (date_last_update_str == date_now_str) and not is_redelivery:
+                        error_message = f"Last day the action was performed = {date_last_update_str}. No need to run the action again, aborting program..."
+                        logger.log_text(error_message, severity='DEFAULT')
+                        message = {
+                            "looker": {
+                                "success": True
+                                }
+                        }
+                        return message
+
+                logger.log_text("Action NOT performed today. Relaying file...", severity='DEFAULT')
+                report_stage("sftp_upload")
+                f = open_sftp_file(sftp)
+                is_file_created = True
+                logger.log_text(f"{file_name} created on SFTP server!", severity='DEFAULT')
+                pipeline.start_writer(f)
+                if checkpoint is None:
+                    pipeline.relay()
+                else:
+                    # Bytes already in the file are skipped, once checked against the checkpoint
+                    while (block := pipeline.next_block()) is not None:
+                        start = checkpoint.track_bytes(block)
+                        if start < len(block):
+                            pipeline.write(block[start:])
+                            pipeline.write_marker(record_sftp_progress(checkpoint.position))
+
+            else:
                 chunk_number = 1
-                for chunk in content_df:
+                for chunk in pipeline.iter_chunks(chunksize=100000): # Read a chunk from URL
                     # Alert if csv is empty  
                     if chunk_number == 1 and chunk.empty:   
                         logger.log_text(f'sftp_upload - CSV received is empty', severity='WARNING')
@@ -197,52 +266,45 @@ def sendfile():
                         # Get brand_code & campaign_code from Looker table
                         # brand_code = chunk["Brand"].unique()[0]
                         campaign_code = chunk["CampaignID"].unique()[0]
-                        # Query to get the last date action was perfomed
-                        query = f"""
-                        SELECT
-                            MAX(SENT_DATE)
-                        FROM
-                            `{prefix_project}cross-cloud4marketing.{prefix_dataset}clz_c4m_public_activation.F_LOOKER_SENT`
-                        WHERE
-                            CHANNEL = "MKT"
-                            AND BRAND = '{brand}'
-                            AND CAMPAIGN_CODE = '{campaign_code}'
-                        """
-                        # Run query and extract result as string 
-                        # We need an exception to handle when the segment doesn't exit and a NaN value is returned
-                        df_result = client.query(query).to_dataframe()
-                        try:
-                            date_last_update_str = df_result.iloc[0,0].strftime("%Y%m%d")
-                        except ValueError:
-                            date_last_update_str = "00000000"
+                        # Get the last date action was perfomed from the ledger of F_LOOKER_SENT
+                        date_last_update_str = sent_ledger.last_sent("MKT", brand, campaign_code, date_now)
 
                         # If the action was already performed today, we can abort the program execution
-                        if (date_last_update_str == date_now_str):
+                        if (date_last_update_str == date_now_str) and not is_redelivery:
                             error_message = f"Last day the action was performed = {date_last_update_str}. No need to run the action again, aborting program..."
                             logger.log_text(error_message, severity='DEFAULT')
-                            message = jsonify({
+                            message = {
                                 "looker": {
                                     "success": True
                                     }
-                            })
+                            }
                             return message
                         
                         logger.log_text("Action NOT performed today. Running action...", severity='DEFAULT')
-                        f = sftp.open(file_name,'a') # Open or create the file in server
+                        report_stage("sftp_upload")
+                        f = open_sftp_file(sftp)
                         is_file_created = True
                         logger.log_text(f"{file_name} created on SFTP server!", severity='DEFAULT')
+                        pipeline.start_writer(f)
 
-                    f.write(chunk.to_csv(index=False, header=header)) # Write the content in CSV file
-                    header = False
+                    # Rows delivered by an interrupted attempt are skipped, once checked against the checkpoint
+                    sftp_start, bq_start = checkpoint.track_rows(chunk) if checkpoint is not None else (0, 0)
+                    if sftp_start < len(chunk):
+                        pipeline.write(chunk.iloc[sftp_start:].to_csv(index=False, header=header).encode("utf-8")) # Enqueue the content to be written in CSV file
+                        header = False
+                        if checkpoint is not None:
+                            pipeline.write_marker(record_sftp_progress(checkpoint.position))
+                    report_rows(len(chunk))
 
                     # ======== Send Data to BQ ========
                     if send_to_bq:
+                        sent_campaign_codes.update(chunk["CampaignID"].unique())
+                    if send_to_bq and bq_start < len(chunk):
                         try:
                             # Build DataFrame
-                            content_bq = chunk.copy()
+                            content_bq = chunk.iloc[bq_start:].copy()
                             content_bq.where(pd.notnull(content_bq), None, inplace=True)
-                            content_bq['CONTENT_DESC'] = pd.Series(content_bq.to_dict(orient="records"), index=content_bq.index)#.astype(str)
-                            content_bq['CONTENT_DESC'] = content_bq['CONTENT_DESC'].apply(lambda x: json.dumps(x))
+                            content_bq['CONTENT_DESC'] = dataframe_to_json_rows(content_bq)
                             content_bq['BRAND'] = brand #pd.Series(content_bq['Brand'], index=content_bq.index)
                             content_bq.insert(0, 'CHANNEL', "MKT")
                             content_bq.insert(0, 'SENT_DATE', date_now)
@@ -250,94 +312,123 @@ def sendfile():
                             content_bq = content_bq.rename(columns={"HerokuID": "CUSTOMER_CODE", "CampaignID": "CAMPAIGN_CODE"})
                             content_bq = content_bq[["SENT_DATE","SENT_DATETIME","CUSTOMER_CODE","CAMPAIGN_CODE","BRAND","CHANNEL","CONTENT_DESC"]]
                             content_bq.reset_index(drop=True, inplace=True)
-                            # Import to BQ
-                            job = client.load_table_from_dataframe(content_bq, table_ref, job_config=job_config)
-                            job.result() # Wait to finish the job
+                            # Enqueue for BQ, the writer loads the rows in the background
+                            bq_writer.append(content_bq)
                         except Exception as e:
+                            bq_writer.abort()
                             send_to_bq = False
                             success = False
                             error_message = str(e)
                             logger.log_text(error_message, severity='ERROR') 
                     # ==============================  
-                if is_file_created:
-                    f.close()
-                    logger.log_text(f"{file_name} closed!", severity='DEFAULT')
+
+            if is_file_created:
+                bytes_written = pipeline.close() # Wait until all the content is written
+                report_bytes(bytes_written)
+                f.close()
+                logger.log_text(f"{file_name} closed! {bytes_written} bytes written", severity='DEFAULT')
+                if checkpoint is not None:
+                    checkpoint.record_sftp(checkpoint.position, file_offset + bytes_written, force=True)
+
+        # ======== Commit Data to BQ ========
+        if bq_writer is not None:
+            report_stage("bigquery_load")
+            try:
+                rows_written = bq_writer.close() # Wait to finish the load job
+                logger.log_text(f"{rows_written} rows loaded in {table_ref} with {bq_writer.load_jobs} load jobs", severity='DEFAULT')
+            except Exception as e:
+                success = False
+                error_message = str(e)
+                logger.log_text(error_message, severity='ERROR') 
+
+            # Rows of flushes committed before an error, or by an interrupted attempt, are in the table too
+            if (bq_writer.rows_committed > 0 or (resumed and checkpoint.bq_rows > 0)) and sent_ledger.is_ledger_table(table_ref):
+                for sent_campaign_code in sent_campaign_codes:
+                    sent_ledger.record("MKT", brand, sent_campaign_code, date_now)
+        # ==============================  
+
+        if success and checkpoint is not None:
+            checkpoint.complete()
+
+    except CheckpointMismatch as e:
+        # The CSV changed since the interrupted attempt: what it delivered is removed and the delivery starts over
+        logger.log_text(f"{str(e)}, restarting the delivery", severity='WARNING')
+        restart = True
+
+    finally:
+        # Stop the download and the BQ writer if the action ended before reading the whole file
+        pipeline.abort()
+        if bq_writer is not None:
+            bq_writer.abort()
+
+    if restart:
+        with sftp_pool.connection(host, port_sftp, user, password) as sftp:
+            # send_to_bq may have been turned off by an error after some rows were committed, they are removed too
+            discard_delivery(checkpoint, sftp=sftp, table_ref=table_ref, channel="MKT", brand=brand)
+        return run_sftp_upload(request_json, restarted_after=checkpoint.sent_datetime)
 
     # Generate message
     if success:
-        message = jsonify({
+        message = {
             "looker": {
                 "success": success
             }
-        })
+        }
     else:
-        message = jsonify({
+        message = {
             "looker": {
                 "success": success,
                 "message": error_message
                 }
-        })
+        }
 
     return message
 
-# ENDPOINT 3: execute Adform
-@my_api.route('/adform_upload/execute', methods=['POST'])
-def sendfile_adform():
+
+def run_adform_upload(request_json):
+    """
+    Action that uploads the Adform IDs of the Looker customers to the Adform S3 bucket.
+    It also creates the segment if not exists.
+
+    :param request_json:            Request sent by Looker
+    :return                         Dict with the response expected by Looker
+    """
+    import numpy as np
+    import pandas as pd
+    from adform import AdformSession
+    from bq_writer import new_bigquery_writer
+    from csv_ingest import read_csv_url_chunks
+    from identity_index import identity_index_manager
+    from s3_upload import new_s3_upload
 
     # Extract current date and time UTC+1
     time_now = (datetime.now() + timedelta(hours=1)).replace(microsecond=0)
     time_now_str = time_now.strftime("%H%M%S")
     date_now = time_now.date()
     date_now_str = date_now.strftime("%Y%m%d")
-    timedelta_days = os.environ.get("days_check_updates", "0") # timedelta must be 0 in production (current date)
-    date_today = date_now - timedelta(days=int(timedelta_days)) # for test purposes maybe we want to allow another date different from the current date
-    date_today_str = date_today.strftime("%Y%m%d")
 
     # Data for BQ auth
-    project_id = get_project_id()
-    if "dev-" in project_id: 
-        prefix_project = "dev-"
-        prefix_dataset = "dev_"
-    elif "test-" in project_id: 
-        prefix_project = "test-"
-        prefix_dataset = "test_"
-    else: 
-        prefix_project = "prod-"
-        prefix_dataset = ""
+    prefix_project, prefix_dataset = get_env_prefixes()
 
     logger.log_text(f"Checking if all tables in activation layer are updated...", severity='DEFAULT')
-    # Create a BQ client to check last updated date
-    client = bigquery.Client()
-    query = f"""
-        SELECT
-            MIN(LAST_UPDATE_DATE)
-        FROM
-            `{prefix_project}cross-cloud4marketing.{prefix_dataset}clz_c4m_curated.TABLES_LAST_UPDATE`
-        WHERE
-            DATASET_NAME = '{prefix_dataset}clz_c4m_public_activation'
-        """
-    # Run query and extract result
-    df_result = client.query(query).to_dataframe()
-    date_last_update_str = df_result.iloc[0,0].strftime("%Y%m%d")
+    
+    is_updated, date_last_update_str, date_today_str = freshness_gate.check(prefix_project, prefix_dataset)
 
     # Check if tables are NOT updated yet
-    if (date_last_update_str < date_today_str):
+    if not is_updated:
         error_message = f"Action NOT performed, tables were updated on {date_last_update_str} and min date allowed is {date_today_str}!"
         logger.log_text(error_message, severity='WARNING')
-        message = jsonify({
+        message = {
                 "looker": {
                     "success": False,
                     "message": error_message
                     }
-            })
+            }
         return message
     
     else:
         logger.log_text(f"Tables are updated! Checking if action is already performed today...", severity='DEFAULT')
 
-        # Obtain response from Looker
-        request_json = request.get_json()
-
         # Extract data from ENV Variables
         access_key = os.environ.get("adform_aws_access_key", "NOT FOUND")
         secret_key = os.environ.get("adform_aws_secret_key", "NOT FOUND")
@@ -351,50 +442,23 @@ def sendfile_adform():
         # Extract data from Looker
         url_download = request_json["scheduled_plan"]["download_url"]
 
-        # Read CSV (only 2 columns)
-        column_names = ["HerokuID"]
-        #logger.log_text(url_download, severity='ERROR') 
-        df_looker = pd.read_csv(url_download, usecols=column_names)
-        if df_looker.empty:
-            logger.log_text(f"CSV received is empty", severity='WARNING')
-
-        # Rename columns
-        df_looker = df_looker.rename(columns={
-            column_names[0]:"CUSTOMER_CODE"
-        })
-        df_looker["CUSTOMER_CODE"] = df_looker["CUSTOMER_CODE"].apply(str)
-
-        # Query to get the last date the segment was updated
-        query = f"""
-        SELECT
-            MAX(SENT_DATE)
-        FROM
-            `{prefix_project}cross-cloud4marketing.{prefix_dataset}clz_c4m_public_activation.F_LOOKER_SENT`
-        WHERE
-            CHANNEL = "ADFORM"
-            AND BRAND = '{brand}'
-            AND CAMPAIGN_CODE = '{segment_name}'
-        """
-        # Run query and extract result as string 
-        # We need an exception to handle when the segment doesn't exit and a NaN value is returned
-        df_result = client.query(query).to_dataframe()
-        try:
-            date_last_update_str = df_result.iloc[0,0].strftime("%Y%m%d")
-        except ValueError:
-            date_last_update_str = "00000000"
+        # Get the last date the segment was updated from the ledger of F_LOOKER_SENT
+        sent_ledger = get_sent_ledger(prefix_project, prefix_dataset)
+        date_last_update_str = sent_ledger.last_sent("ADFORM", brand, segment_name, date_now)
 
         # If the segment was already updated today, we can abort the program execution
         if (date_last_update_str == date_now_str):
             error_message = f"Last day the segment was updated = {date_last_update_str}. No need to run the action again, aborting program..."
             logger.log_text(error_message, severity='DEFAULT')
-            message = jsonify({
+            message = {
                 "looker": {
                     "success": True
                     }
-            })
+            }
             return message
 
         logger.log_text(f"Running the action...", severity='DEFAULT')
+        report_stage("segment")
 
         # Connect to AdForm API
         adform_session = AdformSession(client_id, client_secret)
@@ -450,26 +514,43 @@ def sendfile_adform():
         for char in chars_to_replace:
             report_name = report_name.replace(char, "-")
 
-        
-        # Add data and format dataframe to upload to BQ
-        df_looker["SENT_DATE"] = date_now
-        df_looker["SENT_DATETIME"] = time_now
-        df_looker["CAMPAIGN_CODE"] = segment_refId
-        df_looker["BRAND"] = brand
-        df_looker["CHANNEL"] = "ADFORM"
-        df_looker["CONTENT_DESC"] = ""
-        # Reorder columns
-        df_looker = df_looker[["SENT_DATE","SENT_DATETIME","CUSTOMER_CODE","CAMPAIGN_CODE","BRAND","CHANNEL","CONTENT_DESC"]]
-
-        # Append DataFrame to BQ table
-        client = bigquery.Client()
-        table_ref = f'{prefix_dataset}clz_c4m_public_activation.F_LOOKER_SENT'
-        job_config = bigquery.LoadJobConfig(create_disposition="CREATE_NEVER",
-                                            write_disposition="WRITE_APPEND")
-
-        # Upload table to BQ
-        job = client.load_table_from_dataframe(df_looker, table_ref, job_config=job_config)
-        job.result()
+
+        # Read the CSV in chunks (only the customer code) and append them to BQ with a single load job
+        report_stage("download")
+        f_looker_sent_writer = new_bigquery_writer(f'{prefix_dataset}clz_c4m_public_activation.F_LOOKER_SENT')
+
+        # With a local identity index of today the EXTERNAL_CODEs are resolved while the CSV is read
+        identity_index = identity_index_manager.get(prefix_project, prefix_dataset) if identity_index_manager is not None else None
+        if identity_index is not None:
+            is_code_sent = np.zeros(len(identity_index.codes), dtype=bool)
+        try:
+            column_names = ["HerokuID"]
+            for chunk in read_csv_url_chunks(url_download, usecols=column_names, chunksize=int(os.environ.get("adform_chunk_size", "200000"))):
+                # Rename columns
+                content_bq = chunk.rename(columns={
+                    column_names[0]:"CUSTOMER_CODE"
+                })
+                content_bq["CUSTOMER_CODE"] = numeric_customer_codes(content_bq["CUSTOMER_CODE"])
+                content_bq["CONTENT_DESC"] = ""
+                f_looker_sent_writer.append(prepare_f_looker_sent(content_bq, segment_refId, brand, "ADFORM", time_now))
+                if identity_index is not None:
+                    is_code_sent[identity_index.lookup_code_ids(content_bq["CUSTOMER_CODE"])] = True
+                report_rows(len(content_bq))
+
+            if f_looker_sent_writer.rows_appended == 0:
+                logger.log_text(f"CSV received is empty", severity='WARNING')
+
+            if identity_index is None:
+                # Wait for the rows, the identity join below reads them
+                report_stage("bigquery_load")
+                f_looker_sent_writer.close()
+                sent_ledger.record("ADFORM", brand, segment_refId, date_now)
+            else:
+                # The codes are resolved by the index, the last rows are loaded while the file is uploaded
+                f_looker_sent_writer.start_close()
+        except Exception:
+            f_looker_sent_writer.abort()
+            raise
 
         # JOIN query to extract EXTERNAL_CODE
         # This query is build like this because we can not pass the array of customer codes diectly, as we can run in an error because of too long query 
@@ -489,67 +570,90 @@ def sendfile_adform():
             AND CAMPAIGN_CODE = '{segment_refId}'
         """
 
-        # Run query and save as DataFrame
-        df_result = client.query(query).to_dataframe()
+        # Run query, the result is read page by page. Not needed when the index resolved the codes
+        report_stage("identity_join")
+        page_size = int(os.environ.get("adform_result_page_size", "100000"))
+        if identity_index is None:
+            result_reader = read_query(query, page_size=page_size)
+            result_reader.result()
+        else:
+            code_ids_sent = np.flatnonzero(is_code_sent)
+            logger.log_text(f"EXTERNAL_CODEs resolved by the identity index {identity_index.metadata['built_at']} => {len(code_ids_sent)}", severity='DEFAULT')
         success = False
         
-        # Upload Dataframe to S3 bucket
+        # Stream the result to the S3 bucket as a parallel multipart upload
+        report_stage("s3_upload")
+        ProviderTitle = os.environ.get("ProviderTitle")
+        s3_upload = new_s3_upload(get_s3_client(access_key, secret_key), "data-providers", f"{ProviderTitle}/dt={date_now_str}/{report_name}")
         try:
-            # Create an S3 Client
-            s3 = s3fs.S3FileSystem(key=access_key, secret=secret_key)
-            ProviderTitle = os.environ.get("ProviderTitle")
-            file_path = f's3://data-providers/{ProviderTitle}/dt={date_now_str}/{report_name}'
-            # Create file and save data as CSV
-            with s3.open(file_path, 'w') as f:
-                df_result.to_csv(f, index=False, header=False, sep ='\t')
-                success = True
-                # Print Logs
-                logger.log_text(f"FILE UPLOADED TO S3 => {file_path}", severity='DEFAULT')
+            if identity_index is None:
+                pages = result_reader.iter_dataframes()
+            else:
+                pages = (
+                    pd.DataFrame({
+                        "EXTERNAL_CODE": identity_index.external_codes(code_ids_sent[start:start + page_size]).to_pandas(),
+                        "CAMPAIGN_CODE": segment_refId
+                    })
+                    for start in range(0, len(code_ids_sent), page_size)
+                )
+            for df_result in pages:
+                s3_upload.write(df_result.to_csv(index=False, header=False, sep ='\t'))
+            report_bytes(s3_upload.close())
+            success = True
+            # Print Logs
+            logger.log_text(f"FILE UPLOADED TO S3 => s3://data-providers/{s3_upload.key} ({s3_upload.bytes_written} bytes)", severity='DEFAULT')
 
         except Exception as e:
+            s3_upload.abort()
             success = False
             error_message = str(e)
             logger.log_text(f"ERROR => {error_message}", severity='ERROR') 
+
+        if identity_index is not None:
+            # The request ends once the rows are in F_LOOKER_SENT, the CPU may be throttled after the response
+            report_stage("bigquery_load")
+            f_looker_sent_writer.close()
+            sent_ledger.record("ADFORM", brand, segment_refId, date_now)
         
 
         # Generate message to return
         if success:
-            message = jsonify({
+            message = {
                 "looker": {
                     "success": success
                 }
-            })
+            }
         else:
-            message = jsonify({
+            message = {
                 "looker": {
                     "success": success,
                     "message": error_message
                     }
-            })
+            }
 
         return message
 
 
-@my_api.route('/googleads_upload/execute', methods=['POST'])
-def sendfile_googleads():
+def run_googleads_upload(request_json):
     """
     Action that adds and removes users form a Google Ads user list. 
     It also creates the user list if not exists.
+
+    :param request_json:            Request sent by Looker
+    :return                         Dict with the response expected by Looker
     """
+    import numpy as np
+    import pandas as pd
+    from bq_writer import new_bigquery_writer
+    from csv_ingest import open_csv_url, read_csv_chunks
+    from google_ads import get_google_ads_session
+    from json_rows import dataframe_to_json_rows
+    from membership_store import diff_members, drop_kept_identifiers, full_refresh_interval, get_membership_store, is_last_upload, keys_to_hex, membership_keys, sort_keys
 
     logger.log_text(f"Executing Google Ads action", severity='INFO') 
 
     # Dinamically get the dataset  prefix depending on the project
-    project_id = get_project_id()
-    if "dev-" in project_id: 
-        prefix_project = "dev-"
-        prefix_dataset = "dev_"
-    elif "test-" in project_id: 
-        prefix_project = "test-"
-        prefix_dataset = "test_"
-    else: 
-        prefix_project = "prod-"
-        prefix_dataset = ""
+    prefix_project, prefix_dataset = get_env_prefixes()
         
     logger.log_text(f"Checking if all tables in activation layer are updated...", severity='DEFAULT')
     
@@ -559,17 +663,16 @@ def sendfile_googleads():
     if (not is_updated):
         error_message = f"Action NOT performed, tables were NOT updated!"
         logger.log_text(error_message, severity = 'WARNING')
-        message = jsonify({
+        message = {
                 "looker": {
                     "success": False,
                     "message": error_message
                     }
-            })
+            }
         
         return message
 
     # Extract form varianles 
-    request_json = request.get_json()
     segment_name = request_json["form_params"]["segment_name"]
     brand = request_json["form_params"].get("brand", "")
     country = request_json["form_params"].get("country", "")
@@ -579,125 +682,374 @@ def sendfile_googleads():
    # df_looker = pd.read_csv(url_download, usecols=column_names, dtype=dtype, keep_default_na=False)
    # df_looker.fillna('', inplace=True)
     
-    # Connect to GoogleAds API
-    googleads_session = GoogleAdsSession(brand, country)
+    # Connect to GoogleAds API, the session of the account is shared by all the requests
+    report_stage("segment")
+    googleads_session = get_google_ads_session(brand, country)
     
     # Check if segment already exists, if not a new one is created
     segment_id = googleads_session.search_segment(segment_name = segment_name)
+    is_segment_created = segment_id is None
 
-    if segment_id is None:
+    # Membership duration (days) of the segment, also the limit of the delta uploads between full refreshes
+    if ttl == "" or ttl.isdigit() == False or int(ttl)< 1: 
+        ttl = os.environ.get("Ttl", "10")
+    if int(ttl) > 120:
+        ttl = 120
 
-        if ttl == "" or ttl.isdigit() == False or int(ttl)< 1: 
-            ttl = os.environ.get("Ttl")
-        if int(ttl) > 120:
-            ttl = 120
-        
+    if segment_id is None:
         segment_creation_result = googleads_session.create_segment(segment_name = segment_name, description="", ttl = int(ttl))
         segment_id = segment_creation_result.results[0].resource_name.split("/")[3] 
 
     # Extract data from Looker
-    url_download = request.get_json()["scheduled_plan"]["download_url"]
+    url_download = request_json["scheduled_plan"]["download_url"]
 
     success = True
 
+    # SENT_DATETIME of the rows, UTC+1 as in the other actions
+    time_now = (datetime.now() + timedelta(hours=1)).replace(microsecond=0)
+
+    # All the chunks are appended to F_LOOKER_SENT with a single load job
+    f_looker_sent_writer = new_bigquery_writer(f'{prefix_dataset}clz_c4m_public_activation.F_LOOKER_SENT')
+
+    # With a snapshot of the members sent last time only the changes are uploaded (delta mode)
+    membership_store = get_membership_store()
+    snapshot = membership_store.load(brand, country, segment_name) if membership_store is not None else None
+    f_looker_sent_table = f"{prefix_project}cross-cloud4marketing.{prefix_dataset}clz_c4m_public_activation.F_LOOKER_SENT"
+    if snapshot is not None and membership_store.is_local and not is_last_upload(snapshot, f_looker_sent_table, brand, segment_name):
+        # A local store only knows the uploads of its instance, the changes sent by another one are unknown
+        logger.log_text(f"Membership snapshot of {segment_name} is older than the last upload of the segment, uploading the whole audience", severity='WARNING')
+        snapshot = None
+    is_delta = snapshot is not None
+    chunk_keys = []
+
     try:
         # Read a chunk from URL
-        with pd.read_csv(url_download, dtype=str, index_col=0, chunksize=100000, keep_default_na=False) as content_df:
-            
+        with open_csv_url(url_download) as csv_source:
+            content_df = read_csv_chunks(csv_source, chunksize=100000, index_col=0, keep_default_na=False)
+
             chunk_number = 1
-            job_resource_name = googleads_session.create_offline_user_data_job_service(segment_id = segment_id)
+            # In delta mode the jobs are created once all the audience is known
+            job_resource_name = None if is_delta else googleads_session.create_offline_user_data_job_service(segment_id = segment_id)
             
             for chunk in content_df:
                 # Alert if csv is empty  
                 if chunk_number == 1 and chunk.empty:   
                     logger.log_text(f'sftp_upload - CSV received is empty', severity='WARNING')
                 else:
-                    if(job_resource_name is not None):
-                        success = googleads_session.upsert_user_in_segment(users_to_add = chunk, job_resource_name = job_resource_name)
+                    if(job_resource_name is not None or is_delta):
+                        report_stage("upsert_users")
+                        chunk.columns = chunk.columns.str.strip()
+                        hashed_emails, hashed_phone_numbers = googleads_session.hash_users(chunk, 'Email', 'PhoneNumber')
+                        if membership_store is not None:
+                            chunk_keys.append(membership_keys(hashed_emails, hashed_phone_numbers))
+                        if not is_delta:
+                            success = googleads_session.submit_users(hashed_emails.hex(), hashed_phone_numbers.hex(), job_resource_name = job_resource_name)
+                        report_rows(len(chunk))
                         
                         content_bq = chunk.copy()
                         
                         # Add the country so it is included in the CONTENT_DESC json
                         content_bq['country'] = country
                         content_bq.where(pd.notnull(content_bq), None, inplace=True)
-                        content_bq['CONTENT_DESC'] = pd.Series(content_bq.to_dict(orient="records"), index=content_bq.index)
-                        content_bq['CONTENT_DESC'] = content_bq['CONTENT_DESC'].apply(lambda x: json.dumps(x))
+                        content_bq['CONTENT_DESC'] = dataframe_to_json_rows(content_bq)
                         content_bq = content_bq.rename(columns={"HerokuID": "CUSTOMER_CODE"})
 
                         # Remove the country column because it will not be inserted its own column
                         content_bq = content_bq.drop(columns=['country'])
 
-                        append_f_looker_sent(content_bq, segment_name, brand, "GOOGLEADS", prefix_dataset)
+                        f_looker_sent_writer.append(prepare_f_looker_sent(content_bq, segment_name, brand, "GOOGLEADS", time_now))
                         
             if(job_resource_name is not None):
                 googleads_session.run_offline_user_data_job(job_resource_name = job_resource_name)
-            else:
+            elif not is_delta:
                 logger.log_text(f"ERROR => No job was created", severity='ERROR') 
                 success = False
 
-        # Query the users that exist in the segment because they where inserted before
-        # and Looker did not sent this time, in order to delte them
-        date_now = datetime.today().strftime('%Y-%m-%d') 
-        yesterday = (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
-
-        query = f"""
-            SELECT DISTINCT
-                JSON_EXTRACT_SCALAR(LS1.CONTENT_DESC, '$.Email') AS email,
-                JSON_EXTRACT_SCALAR(LS1.CONTENT_DESC, '$.PhoneNumber') AS phone_number
-            FROM `{prefix_project}cross-cloud4marketing.{prefix_dataset}clz_c4m_public_activation.F_LOOKER_SENT` LS1
-            WHERE
-                CHANNEL = "GOOGLEADS"
-                AND LS1.SENT_DATE = '{yesterday}'
-                AND LS1.CAMPAIGN_CODE = '{segment_name}'
-                AND LS1.BRAND = '{brand}'
-                AND JSON_EXTRACT_SCALAR(LS1.CONTENT_DESC, '$.country') = '{country}'
-                AND LS1.CUSTOMER_CODE NOT IN (
-                    SELECT
-                        LS2.CUSTOMER_CODE
-                    FROM `{prefix_project}cross-cloud4marketing.{prefix_dataset}clz_c4m_public_activation.F_LOOKER_SENT` LS2
-                    WHERE 
-                        LS2.CHANNEL = 'GOOGLEADS'
-                        AND LS2.SENT_DATE = '{date_now}'
-                        AND LS2.CAMPAIGN_CODE = '{segment_name}'
-                        AND LS2.BRAND = '{brand}'
-                        AND JSON_EXTRACT_SCALAR(LS2.CONTENT_DESC, '$.country') = '{country}'
-                )
-        """
-        
-        df_users_to_remove = bigquery.Client().query(query).to_dataframe()
-        
-        if(not df_users_to_remove.empty):
-            logger.log_text(f"Removing users from segment", severity='INFO') 
-
-            # Set the maximum size of each chunk. The API only allows 100k identifiers per request
-            chunk_size = 50000  
-            num_rows = len(df_users_to_remove)
+            # Wait for the rows of today, the removal query below compares them with yesterday's
+            report_stage("bigquery_load")
+            if f_looker_sent_writer.close() > 0:
+                get_sent_ledger(prefix_project, prefix_dataset).record("GOOGLEADS", brand, segment_name, time_now.date())
+
+        current_keys = sort_keys(np.concatenate(chunk_keys)) if chunk_keys else sort_keys([])
+        uploaded_at = datetime.now().replace(microsecond=0)
+        full_refresh_at = uploaded_at
+
+        if is_delta:
+            # ======== Delta Upload ========
+            # The whole audience is uploaded again before the membership TTL expires, the members only
+            # sent in the delta uploads would expire otherwise
+            is_full_refresh = uploaded_at - snapshot.full_refresh_at >= full_refresh_interval(
+                ttl,
+                full_refresh_days = int(os.environ.get("membership_full_refresh_days", "7")),
+                ttl_margin_days = int(os.environ.get("membership_ttl_margin_days", "2"))
+            )
+            # A segment created by this request is empty, the snapshot of the previous one is ignored
+            is_full_refresh = is_full_refresh or is_segment_created
+            previous_keys = snapshot.keys[:0] if is_segment_created else snapshot.keys
+            if not is_full_refresh:
+                full_refresh_at = snapshot.full_refresh_at
+
+            keys_to_add, keys_to_remove = diff_members(current_keys, previous_keys)
+            keys_to_remove = drop_kept_identifiers(keys_to_remove, current_keys)
+            if is_full_refresh:
+                keys_to_add = current_keys
+            logger.log_text(f"Delta upload => {len(keys_to_add)} members to add, {len(keys_to_remove)} to remove (full refresh: {is_full_refresh})", severity='INFO') 
+
+            # The jobs run asynchronously, the removals never include an identifier that is still in the audience
+            report_stage("remove_users")
+            for keys, remove in ((keys_to_remove, True), (keys_to_add, False)):
+                if len(keys) == 0:
+                    continue
+                # The same job cannot be used for create and remove operations
+                job_resource_name = googleads_session.create_offline_user_data_job_service(segment_id = segment_id)
+                if job_resource_name is None:
+                    success = False
+                    break
+                hashed_emails, hashed_phone_numbers = keys_to_hex(keys)
+                success = googleads_session.submit_users(hashed_emails, hashed_phone_numbers, job_resource_name = job_resource_name, remove = remove) and success
+                googleads_session.run_offline_user_data_job(job_resource_name = job_resource_name)
+            # ==============================
 
-            # The same job cannot be used for create and remove operations so a new one is created 
-            job_resource_name_remove = googleads_session.create_offline_user_data_job_service(segment_id = segment_id)
-            
-            # Process the DataFrame in chunks of 50.000 rows
-            for start_row in range(0, num_rows, chunk_size):
-                chunk = df_users_to_remove[start_row:start_row + chunk_size]
-                success = googleads_session.remove_user_in_segment(users_to_remove = chunk, job_resource_name = job_resource_name_remove)
-            
-            googleads_session.run_offline_user_data_job(job_resource_name = job_resource_name_remove)
-            
         else:
-            logger.log_text(f"No users need to be removed from segment", severity='INFO') 
+            # Query the users that exist in the segment because they where inserted before
+            # and Looker did not sent this time, in order to delte them
+            date_now = datetime.today().strftime('%Y-%m-%d') 
+            yesterday = (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
+
+            query = f"""
+                SELECT DISTINCT
+                    JSON_EXTRACT_SCALAR(LS1.CONTENT_DESC, '$.Email') AS email,
+                    JSON_EXTRACT_SCALAR(LS1.CONTENT_DESC, '$.PhoneNumber') AS phone_number
+                FROM `{prefix_project}cross-cloud4marketing.{prefix_dataset}clz_c4m_public_activation.F_LOOKER_SENT` LS1
+                WHERE
+                    CHANNEL = "GOOGLEADS"
+                    AND LS1.SENT_DATE = '{yesterday}'
+                    AND LS1.CAMPAIGN_CODE = '{segment_name}'
+                    AND LS1.BRAND = '{brand}'
+                    AND JSON_EXTRACT_SCALAR(LS1.CONTENT_DESC, '$.country') = '{country}'
+                    AND LS1.CUSTOMER_CODE NOT IN (
+                        SELECT
+                            LS2.CUSTOMER_CODE
+                        FROM `{prefix_project}cross-cloud4marketing.{prefix_dataset}clz_c4m_public_activation.F_LOOKER_SENT` LS2
+                        WHERE 
+                            LS2.CHANNEL = 'GOOGLEADS'
+                            AND LS2.SENT_DATE = '{date_now}'
+                            AND LS2.CAMPAIGN_CODE = '{segment_name}'
+                            AND LS2.BRAND = '{brand}'
+                            AND JSON_EXTRACT_SCALAR(LS2.CONTENT_DESC, '$.country') = '{country}'
+                    )
+            """
+            
+            report_stage("remove_users")
+            job_resource_name_remove = None
+            removed = True
+
+            # The users are read and removed page by page, the list is never loaded at once
+            for df_users_to_remove in read_query(query).iter_dataframes():
+                if df_users_to_remove.empty:
+                    continue
+
+                if job_resource_name_remove is None:
+                    logger.log_text(f"Removing users from segment", severity='INFO') 
+
+                    # The same job cannot be used for create and remove operations so a new one is created 
+                    job_resource_name_remove = googleads_session.create_offline_user_data_job_service(segment_id = segment_id)
+                
+                # The operations are split in requests within the API limits (100k identifiers per request)
+                removed = googleads_session.remove_user_in_segment(users_to_remove = df_users_to_remove, job_resource_name = job_resource_name_remove) and removed
+
+            if job_resource_name_remove is not None:
+                googleads_session.run_offline_user_data_job(job_resource_name = job_resource_name_remove)
+                success = removed
+                
+            else:
+                logger.log_text(f"No users need to be removed from segment", severity='INFO') 
+
+        # The snapshot is only replaced when the upload succeeded, the next run retries the same changes otherwise
+        if membership_store is not None and success:
+            membership_store.save(brand, country, segment_name, current_keys, full_refresh_at, sent_at=time_now)
 
     except Exception as e:
+        f_looker_sent_writer.abort()
         logger.log_text(f"ERROR => There was an error processing Looker request", severity='WARNING') 
         logger.log_text(f"{str(e)}", severity='WARNING') 
 
 
-    return jsonify({
+    return {
         "looker": {
             "success": success
         }
+    }
+
+
+#####################################################
+################### EXECUTE START ###################
+#####################################################
+
+
+# Background workers of the asynchronous execution mode
+job_manager = JobManager(
+    max_workers = int(os.environ.get("jobs_max_workers", "2")),
+    max_queued = int(os.environ.get("jobs_max_queued", "20")),
+    retention_seconds = int(os.environ.get("jobs_retention_seconds", "86400"))
+)
+
+# Fields of the Looker request each action needs, checked before a job is queued
+ACTION_REQUIRED_FIELDS = {
+    "sftp_upload": [("scheduled_plan", "download_url"), ("scheduled_plan", "title"), ("form_params", "path_sftp")],
+    "adform_upload": [("scheduled_plan", "download_url"), ("form_params", "segment_name")],
+    "googleads_upload": [("scheduled_plan", "download_url"), ("form_params", "segment_name")]
+}
+
+
+def is_async_request():
+    """
+    Checks if the action must run in the background. The mode is taken from the "mode" query
+    parameter of the execute URL and defaults to the execute_mode env variable (sync/async)
+    """
+    mode = request.args.get("mode", os.environ.get("execute_mode", "sync"))
+    return mode.lower() == "async"
+
+
+def validate_action_request(action, request_json):
+    """
+    Validates the Looker request of an action before it is queued
+
+    :param action:                  Name of the action
+    :param request_json:            Request sent by Looker
+    :return                         Error message, None if the request is valid
+    """
+    if not isinstance(request_json, dict):
+        return "Invalid request, a JSON body is expected"
+
+    for section, field in ACTION_REQUIRED_FIELDS[action]:
+        if not isinstance(request_json.get(section), dict) or request_json[section].get(field) in (None, ""):
+            return f"Invalid request, {section}.{field} is required"
+
+    return None
+
+
+def retry_later_response(message):
+    """
+    Response asking Looker to send the request again later (503 with Retry-After)
+    """
+    response = jsonify({
+        "looker": {
+            "success": False,
+            "message": message
+            }
+    })
+    response.headers["Retry-After"] = os.environ.get("admission_retry_after", "60")
+    return response, 503
+
+
+def traced(action, function):
+    """
+    Wraps an action so its stages are measured, see metrics.py
+    """
+    def run(request_json):
+        with trace_action(action) as trace:
+            response = function(request_json)
+            trace.success = response["looker"]["success"]
+            return response
+
+    return run
+
+
+def admitted(action, function):
+    """
+    Wraps an action so a background job waits in the queue until the instance has room for it
+    """
+    def run(request_json):
+        report_stage("admission")
+        ticket = admission_controller.admit(action, timeout=None)
+        try:
+            return function(request_json)
+        finally:
+            admission_controller.release(ticket)
+
+    return run
+
+
+def execute_action(action, function):
+    """
+    Runs an action inside the request or, in asynchronous mode, validates the request,
+    queues the action and answers right away
+
+    :param action:                  Name of the action
+    :param function:                Function running the action
+    :return                         Flask response for Looker
+    """
+    request_json = request.get_json()
+    payload_recorder.record(action, request_json)
+
+    if not is_async_request():
+        # Runs that would not fit in the memory of the instance wait a little, then Looker is asked to retry
+        ticket = admission_controller.admit(action, timeout=float(os.environ.get("admission_queue_timeout", "10")))
+        if ticket is None:
+            return retry_later_response("The instance is busy with other actions, try again later")
+
+        try:
+            return jsonify(traced(action, function)(request_json))
+        finally:
+            admission_controller.release(ticket)
+
+    error_message = validate_action_request(action, request_json)
+    if error_message is not None:
+        logger.log_text(f"ERROR => {action}: {error_message}", severity='WARNING')
+        return jsonify({
+            "looker": {
+                "success": False,
+                "message": error_message
+                }
+        })
+
+    job = job_manager.submit(action, traced(action, admitted(action, function)), request_json)
+    if job is None:
+        return retry_later_response("Too many actions queued, try again later")
+
+    return jsonify({
+        "looker": {
+            "success": True,
+            "message": f"Action queued as job {job.id}"
+            },
+        "job_id": job.id
     })
 
 
+# ENDPOINT 2: execute
+@my_api.route('/sftp_upload/execute', methods=['POST'])
+def sendfile():
+    return execute_action("sftp_upload", run_sftp_upload)
+
+
+# ENDPOINT 3: execute Adform
+@my_api.route('/adform_upload/execute', methods=['POST'])
+def sendfile_adform():
+    return execute_action("adform_upload", run_adform_upload)
+
+
+# ENDPOINT 4: execute Google Ads
+@my_api.route('/googleads_upload/execute', methods=['POST'])
+def sendfile_googleads():
+    return execute_action("googleads_upload", run_googleads_upload)
+
+
+# Returns the status of an action executed in asynchronous mode
+@my_api.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job {job_id} not found"}), 404
+
+    return jsonify(job.to_dict())
+
+
+#####################################################
+#################### EXECUTE END ####################
+#####################################################
+
+
 #####################################################
 #################### FORMS START ####################
 #####################################################
@@ -750,10 +1102,13 @@ def formdesign_googleads():
 
 
 
-# Lists the available actions in the custom Action Hub. 
-# The configuration is added dinamically based on the environment (dev/test/prod)
-@my_api.route('/list', methods=['POST'])
-def returnjson():
+def build_action_list():
+    """
+    Builds the list of available actions. The configuration is added dinamically 
+    based on the environment (dev/test/prod)
+    
+    :return                         Dict with the action list expected by Looker
+    """
     service_url = get_service_url()
     # Get project_id and write corresponding prefeix to action
     project_id = get_project_id()
@@ -777,12 +1132,68 @@ def returnjson():
     integrations[2]["url"] = f"{service_url}/googleads_upload/execute"
     integrations[2]["form_url"] = f"{service_url}/googleads_upload/form"
 
-    return jsonify({
+    return {
         "label": "Calzedonia Custom Actions",
-        "integrations": integrations})
+        "integrations": integrations}
+
+
+# The action list only depends on the environment, so it is built once per process
+# and served as pre-encoded bytes (ETag/304, gzip and br)
+action_list_cache = ActionListCache(
+    build_action_list, 
+    inline_icons = os.environ.get("list_inline_icons", "true").lower() == "true"
+)
+
+
+def loaded_cache_stats(module_name, cache_name):
+    """
+    Counters of a cache of an action module, None if the module was not loaded yet (the action did not run)
+    """
+    cache = getattr(sys.modules.get(module_name), cache_name, None)
+    return cache.stats() if cache is not None else None
+
+
+# Returns the counters of the process-wide caches
+@my_api.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        "freshness_gate": freshness_gate.stats(),
+        "sent_ledgers": sent_ledgers_stats(),
+        "google_ads_segments": loaded_cache_stats("google_ads", "segment_cache"),
+        "identity_index": loaded_cache_stats("identity_index", "identity_index_manager"),
+        "sftp_pool": loaded_cache_stats("sftp_pool", "sftp_pool"),
+        "admission": admission_controller.stats()
+    })
+
+
+# Per-stage durations, rows, bytes and peak memory of the actions in the Prometheus format
+@my_api.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+# Lists the available actions in the custom Action Hub. 
+@my_api.route('/list', methods=['POST'])
+def returnjson():
+    return action_list_cache.get_list().to_response(request)
+
+
+# Returns the icon of an action, so it can be cached by the clients separately from the list
+@my_api.route('/icons/<name>', methods=['GET'])
+def returnicon(name):
+    icon = action_list_cache.get_icon(name)
+    if icon is None:
+        return jsonify({"error": f"No icon for action {name}"}), 404
+
+    return icon.to_response(request)
 
 
 if __name__ == '__main__':
+    # The queued log entries are written before the instance is stopped
+    flush_loggers_on_sigterm()
     server_port = os.environ.get('PORT', '8080')
-    serve(my_api, port=server_port, host='0.0.0.0')
+    # The socket is listening once the server is created, the pre-warm runs while requests are served
+    server = create_server(my_api, port=server_port, host='0.0.0.0', threads=int(os.environ.get('waitress_threads', '4')))
+    start_prewarm()
+    server.run()
 
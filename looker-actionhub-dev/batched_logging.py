@@ -0,0 +1,175 @@
+# Import libs
+import atexit
+import signal
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+
+# Entries below WARNING are dropped first when the buffer is full
+LOW_SEVERITIES = {None, "DEFAULT", "DEBUG", "INFO", "NOTICE"}
+
+_loggers = []
+_loggers_lock = threading.Lock()
+
+
+class BatchedLogger():
+    """
+    Drop-in replacement of a Cloud Logging logger that queues the entries and writes them in batches
+    from a background thread, so log_text never waits for the API.
+
+    The buffer is bounded. When it is full a new entry below WARNING is dropped, and a WARNING or
+    higher entry replaces the oldest one. The number of dropped entries is logged with the next batch.
+    Batches that can not be written are printed to stderr, which Cloud Run also collects.
+    """
+    def __init__(self, logger, max_entries=10000, batch_size=500, flush_interval=1.0):
+        """
+        :param logger:              google.cloud.logging Logger the entries are written to, or a function
+                                    creating it, called by the background thread before the first write
+        :param max_entries:         Entries kept in the buffer at most
+        :param batch_size:          Entries written with each API call at most
+        :param flush_interval:      Seconds an entry can wait in the buffer before it is written
+        """
+        self.logger = logger if hasattr(logger, "batch") else None
+        self.__logger_factory = None if hasattr(logger, "batch") else logger
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.__entries = deque()
+        self.__in_flight = 0
+        self.__dropped_unreported = 0
+        self.__condition = threading.Condition()
+        self.__closed = False
+        self.__thread = threading.Thread(target=self.__run, name="log-writer", daemon=True)
+        self.__thread.start()
+
+    def log_text(self, text, severity=None, **kwargs):
+        """
+        Queues a text entry, same arguments as google.cloud.logging Logger.log_text
+        """
+        entry = (text, {**kwargs, "severity": severity, "timestamp": kwargs.get("timestamp") or datetime.now(timezone.utc)})
+
+        with self.__condition:
+            if len(self.__entries) >= self.max_entries:
+                self.dropped += 1
+                self.__dropped_unreported += 1
+                if severity in LOW_SEVERITIES:
+                    return
+                self.__entries.popleft()
+
+            self.__entries.append(entry)
+            if len(self.__entries) >= self.batch_size:
+                self.__condition.notify_all()
+
+    def __next_batch(self):
+        with self.__condition:
+            if not self.__closed and len(self.__entries) < self.batch_size:
+                self.__condition.wait(self.flush_interval)
+
+            batch = [self.__entries.popleft() for _ in range(min(self.batch_size, len(self.__entries)))]
+            if self.__dropped_unreported > 0:
+                batch.append((f"{self.__dropped_unreported} log entries dropped, the log buffer was full", {"severity": "WARNING", "timestamp": datetime.now(timezone.utc)}))
+                self.__dropped_unreported = 0
+            self.__in_flight = len(batch)
+            return batch
+
+    def __write(self, batch):
+        try:
+            if self.logger is None:
+                self.logger = self.__logger_factory()
+            logger_batch = self.logger.batch()
+            for text, kwargs in batch:
+                logger_batch.log_text(text, **kwargs)
+            logger_batch.commit()
+            self.written += len(batch)
+
+        except Exception as e:
+            self.errors += 1
+            for text, kwargs in batch:
+                print(f"[{kwargs.get('severity')}] {text}", file=sys.stderr)
+            print(f"[WARNING] Log batch could not be written: {str(e)}", file=sys.stderr)
+
+    def __run(self):
+        while True:
+            batch = self.__next_batch()
+            if batch:
+                self.__write(batch)
+
+            with self.__condition:
+                self.__in_flight = 0
+                self.__condition.notify_all()
+                if self.__closed and not self.__entries:
+                    return
+
+    def flush(self, timeout=10):
+        """
+        Waits until the entries queued so far are written
+
+        :param timeout:             Seconds to wait at most
+        :return                     True if the buffer was emptied
+        """
+        deadline = time.monotonic() + timeout
+        with self.__condition:
+            self.__condition.notify_all()
+            while self.__entries or self.__in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.__thread.is_alive():
+                    return False
+                self.__condition.wait(remaining)
+        return True
+
+    def close(self, timeout=10):
+        """
+        Writes the remaining entries and stops the background thread
+        """
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        self.__thread.join(timeout)
+
+    def stats(self):
+        with self.__condition:
+            return {"written": self.written, "dropped": self.dropped, "errors": self.errors, "buffered": len(self.__entries)}
+
+
+def new_batched_logger(logger, **kwargs):
+    """
+    Creates a batched logger that is flushed when the process exits
+    """
+    batched_logger = BatchedLogger(logger, **kwargs)
+    with _loggers_lock:
+        _loggers.append(batched_logger)
+    return batched_logger
+
+
+@atexit.register
+def close_loggers(timeout=10):
+    """
+    Writes the entries of all the batched loggers and stops them
+    """
+    with _loggers_lock:
+        loggers = list(_loggers)
+    for batched_logger in loggers:
+        batched_logger.close(timeout)
+
+
+def flush_loggers_on_sigterm():
+    """
+    Flushes the loggers when the process receives SIGTERM (Cloud Run sends it before stopping an instance),
+    then exits. Must be called from the main thread
+    """
+    previous_handler = signal.getsignal(signal.SIGTERM)
+
+    def handler(signum, frame):
+        close_loggers()
+        if callable(previous_handler):
+            previous_handler(signum, frame)
+        else:
+            sys.exit(0)
+
+    signal.signal(signal.SIGTERM, handler)
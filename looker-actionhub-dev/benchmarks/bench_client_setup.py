@@ -0,0 +1,98 @@
+"""
+Micro-benchmark of the per-request client setup removed by the shared client registry (clients.py).
+
+Compares what a request used to do (google.auth.default() plus a new bigquery.Client() for every
+query or load) with the registry lookups that replace it. With --query a query is also run on every
+iteration, to include the TLS handshake paid by the fresh clients.
+
+Usage (from looker-actionhub-dev):
+    python benchmarks/bench_client_setup.py --iterations 200 --clients-per-request 3
+    python benchmarks/bench_client_setup.py --iterations 20 --query "SELECT 1"
+"""
+# Import libs
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import google.auth
+import google.auth.exceptions
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import bigquery
+
+import clients
+
+
+def legacy_request(clients_per_request, query):
+    """
+    Client setup done by a request before the registry
+    """
+    _, project_id = google.auth.default()
+    for _ in range(clients_per_request):
+        client = bigquery.Client()
+        if query:
+            client.query(query).result()
+
+
+def registry_request(clients_per_request, query):
+    """
+    Client setup done by a request with the registry
+    """
+    clients.get_env_prefixes()
+    for _ in range(clients_per_request):
+        client = clients.get_bigquery_client()
+        if query:
+            client.query(query).result()
+
+
+def measure(function, iterations, *args):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def report(name, timings):
+    timings_ms = sorted(t * 1000 for t in timings)
+    p95 = timings_ms[int(len(timings_ms) * 0.95) - 1]
+    print(f"{name:<10} mean={statistics.mean(timings_ms):9.3f} ms  p50={statistics.median(timings_ms):9.3f} ms  p95={p95:9.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--clients-per-request", type=int, default=3, help="BigQuery clients a request used to create")
+    parser.add_argument("--query", default="", help="Query to run with every client (needs real credentials)")
+    args = parser.parse_args()
+
+    try:
+        google.auth.default()
+    except google.auth.exceptions.DefaultCredentialsError:
+        if args.query:
+            sys.exit("--query needs Application Default Credentials")
+        # Without ADC only the construction cost can be measured, with anonymous credentials
+        print("No Application Default Credentials found, using anonymous credentials\n")
+        os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "development")
+        google.auth.default = lambda *a, **k: (AnonymousCredentials(), os.environ["GOOGLE_CLOUD_PROJECT"])
+
+    # Warm up imports and the registry, the registry cost is paid once per process
+    legacy_request(1, "")
+    registry_request(1, "")
+
+    legacy = measure(legacy_request, args.iterations, args.clients_per_request, args.query)
+    registry = measure(registry_request, args.iterations, args.clients_per_request, args.query)
+
+    print(f"{args.iterations} requests, {args.clients_per_request} BigQuery clients per request")
+    report("legacy", legacy)
+    report("registry", registry)
+    print(f"setup removed per request: {(statistics.mean(legacy) - statistics.mean(registry)) * 1000:.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
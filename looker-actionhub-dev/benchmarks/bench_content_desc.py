@@ -0,0 +1,88 @@
+"""
+Benchmark of the CONTENT_DESC serialization of the F_LOOKER_SENT rows.
+
+Compares the per-row approach the actions used (to_dict(orient="records") and json.dumps on
+every record) with the columnar encoder of json_rows.py, on a synthetic audience with the
+columns of a Google Ads export. Both outputs are checked to be identical.
+
+Usage (from looker-actionhub-dev):
+    python benchmarks/bench_content_desc.py
+    python benchmarks/bench_content_desc.py --rows 100000 1000000 --repeat 3
+"""
+# Import libs
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+
+from json_rows import dataframe_to_json_rows
+
+
+def build_audience(rows, seed=0):
+    """
+    Builds a DataFrame like the chunks read from Looker, all the columns as strings and some nulls
+    """
+    rng = np.random.default_rng(seed)
+    ids = rng.integers(10**8, 10**9, size=rows).astype(str)
+    emails = pd.Series(ids, dtype=object) + "@example.com"
+    phones = pd.Series(rng.integers(600000000, 699999999, size=rows).astype(str), dtype=object)
+    names = pd.Series(rng.choice(["Ana", "José", "Zoë", "Marc", "O'Neil"], size=rows), dtype=object)
+
+    content = pd.DataFrame({
+        "HerokuID": ids.astype(object),
+        "Email": emails,
+        "PhoneNumber": "+34" + phones,
+        "FirstName": names,
+        "country": "ES"
+    })
+    # 10% of the phones are missing
+    content.loc[rng.random(rows) < 0.1, "PhoneNumber"] = None
+
+    return content
+
+
+def legacy_content_desc(content_bq):
+    content_desc = pd.Series(content_bq.to_dict(orient="records"), index=content_bq.index)
+    return content_desc.apply(lambda x: json.dumps(x))
+
+
+def columnar_content_desc(content_bq):
+    return dataframe_to_json_rows(content_bq)
+
+
+def best_of(function, content_bq, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(content_bq)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each approach, the best one is reported")
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        content_bq = build_audience(rows)
+
+        legacy_time, legacy = best_of(legacy_content_desc, content_bq, args.repeat)
+        columnar_time, columnar = best_of(columnar_content_desc, content_bq, args.repeat)
+
+        if not legacy.equals(columnar):
+            sys.exit(f"Outputs differ for {rows} rows")
+
+        print(f"{rows:>9} rows  legacy={legacy_time:8.3f} s  columnar={columnar_time:8.3f} s  speedup={legacy_time / columnar_time:5.1f}x")
+
+
+if __name__ == '__main__':
+    main()
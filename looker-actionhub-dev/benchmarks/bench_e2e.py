@@ -0,0 +1,209 @@
+"""
+Offline end-to-end benchmark of the execute routes (sftp_upload, adform_upload, googleads_upload).
+
+The real Flask routes run against the local stand-ins of benchmarks/standins.py: Looker CSVs of the
+requested size and shape are generated by a local HTTP server, the files go to a local SFTP server
+and BigQuery, S3, the Adform API and Google Ads are replaced by clients that only count what they
+receive. Each run is a fresh interpreter, so the peak RSS is the one of the action alone.
+
+For each action the median of the runs is reported: rows/s, wall time, seconds of each stage (from
+/metrics, see metrics.py) and peak RSS. With --save-baseline the results are stored in the baseline
+file, later runs are compared with it and --fail-on-regression exits with 1 when an action is slower
+or uses more memory than the baseline by more than --threshold.
+
+Usage (from looker-actionhub-dev):
+    python benchmarks/bench_e2e.py --rows 200000 --runs 3 --save-baseline
+    python benchmarks/bench_e2e.py --rows 200000 --actions sftp_upload --fail-on-regression
+"""
+# Import libs
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS_DIR = os.path.join(BASE_DIR, "benchmarks")
+
+ACTIONS = ["sftp_upload", "adform_upload", "googleads_upload"]
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, "baselines", "e2e.json")
+
+STAGE_SECONDS = re.compile(r'^actionhub_stage_duration_seconds_sum\{action="[^"]*",stage="([^"]*)"\} (\S+)$', re.MULTILINE)
+
+
+def build_request(action, csv_url):
+    """
+    Looker request of an action, as sent by a scheduled plan
+    """
+    scheduled_plan = {"download_url": csv_url, "title": "Benchmark plan", "type": "Look"}
+    if action == "sftp_upload":
+        form_params = {"path_sftp": "/Import/bench", "brand": "CLZ", "dataset_id": "bench", "table_id": "bench"}
+    elif action == "adform_upload":
+        form_params = {"segment_name": "bench_segment", "brand": "CLZ"}
+    else:
+        form_params = {"segment_name": "bench_segment", "brand": "CLZ", "country": "ES"}
+    return {"type": "query", "scheduled_plan": scheduled_plan, "form_params": form_params}
+
+
+def run_worker(action, rows, extra_columns, removed_users):
+    """
+    Runs one action in this interpreter and prints its measures as JSON
+    """
+    import resource
+    import time
+
+    sys.path.insert(0, BASE_DIR)
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from standins import install_standins
+
+    standins = install_standins(removed_users=removed_users)
+    shape = action.split("_")[0]
+
+    import app
+
+    client = app.my_api.test_client()
+    start = time.perf_counter()
+    response = client.post(f"/{action}/execute?mode=sync", json=build_request(action, standins.http.csv_url(shape, rows, extra_columns)))
+    wall = time.perf_counter() - start
+
+    stages = {stage: float(seconds) for stage, seconds in STAGE_SECONDS.findall(client.get("/metrics").get_data(as_text=True))}
+    looker = response.get_json()["looker"]
+
+    print(json.dumps({
+        "success": looker["success"],
+        "message": looker.get("message", ""),
+        "wall": wall,
+        "rows_per_second": rows / wall,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": stages,
+        "csv_bytes": standins.http.server.bytes_sent,
+        "sftp_bytes": standins.sftp.bytes_written,
+        "s3_bytes": standins.s3.bytes_uploaded,
+        "bigquery_rows": standins.bigquery.rows_loaded,
+        "googleads_operations": standins.google_ads.operations
+    }))
+    standins.close()
+
+
+def measure(action, rows, extra_columns, removed_users, runs):
+    """
+    Runs an action <runs> times, each in a fresh interpreter
+
+    :return                         Dict with the median of the measures
+    """
+    # Credentials are replaced by anonymous ones, the stand-ins never check them
+    env = {**os.environ, "GOOGLE_CLOUD_PROJECT": "dev-bench", "execute_mode": "sync"}
+    results = []
+    for _ in range(runs):
+        command = [sys.executable, os.path.abspath(__file__), "--worker", action, "--rows", str(rows), "--extra-columns", str(extra_columns), "--removed-users", str(removed_users)]
+        result = subprocess.run(command, capture_output=True, text=True, cwd=BASE_DIR, env=env)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1])
+        results.append(json.loads(result.stdout.strip().splitlines()[-1]))
+
+    failed = [result["message"] for result in results if not result["success"]]
+    if failed:
+        raise RuntimeError(failed[0])
+
+    stage_names = sorted({stage for result in results for stage in result["stages"]})
+    return {
+        "rows": rows,
+        "extra_columns": extra_columns,
+        "wall": statistics.median(result["wall"] for result in results),
+        "rows_per_second": statistics.median(result["rows_per_second"] for result in results),
+        "peak_rss_mb": statistics.median(result["peak_rss_mb"] for result in results),
+        "stages": {stage: statistics.median(result["stages"].get(stage, 0) for result in results) for stage in stage_names},
+        "transferred": {name: results[-1][name] for name in ("csv_bytes", "sftp_bytes", "s3_bytes", "bigquery_rows", "googleads_operations")}
+    }
+
+
+def baseline_key(action, rows, extra_columns):
+    return f"{action}:{rows}:{extra_columns}"
+
+
+def compare(result, baseline, threshold):
+    """
+    Regressions of a result against its baseline
+
+    :return                         List of messages, empty if there is no regression
+    """
+    regressions = []
+    if result["rows_per_second"] < baseline["rows_per_second"] * (1 - threshold):
+        regressions.append(f"rows/s {result['rows_per_second']:.0f} vs {baseline['rows_per_second']:.0f}")
+    if result["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + threshold):
+        regressions.append(f"peak RSS {result['peak_rss_mb']:.0f} MB vs {baseline['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+def print_result(action, result, baseline):
+    def versus(name, value, fmt):
+        if baseline is None or name not in baseline:
+            return ""
+        return f"  (baseline {format(baseline[name], fmt)})"
+
+    print(f"{action} ({result['rows']} rows, {result['extra_columns']} extra columns)")
+    print(f"  rows/s       {result['rows_per_second']:12.0f}{versus('rows_per_second', result['rows_per_second'], '.0f')}")
+    print(f"  wall         {result['wall']:12.3f} s{versus('wall', result['wall'], '.3f')}")
+    print(f"  peak RSS     {result['peak_rss_mb']:12.1f} MB{versus('peak_rss_mb', result['peak_rss_mb'], '.1f')}")
+    for stage, seconds in result["stages"].items():
+        print(f"    {stage:<18} {seconds:9.3f} s")
+    print("  " + ", ".join(f"{name}={value}" for name, value in result["transferred"].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--actions", nargs="*", default=ACTIONS, choices=ACTIONS)
+    parser.add_argument("--rows", type=int, default=100000, help="Rows of the Looker CSV")
+    parser.add_argument("--extra-columns", type=int, default=0, help="Columns added to the Looker CSV besides the ones the action uses")
+    parser.add_argument("--removed-users", type=int, default=1000, help="Users the Google Ads action removes from the list")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="Stores the results in the baseline file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Fraction of slowdown or memory growth reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exits with 1 when there are regressions")
+    parser.add_argument("--worker", choices=ACTIONS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.rows, args.extra_columns, args.removed_users)
+        return
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    regressions = {}
+    for action in args.actions:
+        key = baseline_key(action, args.rows, args.extra_columns)
+        try:
+            result = measure(action, args.rows, args.extra_columns, args.removed_users, args.runs)
+        except RuntimeError as e:
+            print(f"{action} failed: {e}")
+            regressions[action] = [f"failed: {e}"]
+            continue
+
+        print_result(action, result, baselines.get(key))
+        if key in baselines:
+            regressions[action] = compare(result, baselines[key], args.threshold)
+        if args.save_baseline:
+            baselines[key] = result
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"\nBaseline stored in {args.baseline}")
+
+    regressions = {action: messages for action, messages in regressions.items() if messages}
+    for action, messages in regressions.items():
+        print(f"REGRESSION {action}: {'; '.join(messages)}")
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
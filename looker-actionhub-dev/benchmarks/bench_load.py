@@ -0,0 +1,287 @@
+"""
+Load test of the execute routes: replays Looker payloads at several concurrency levels against the
+app served by waitress, with the services replaced by the stand-ins of benchmarks/standins.py.
+
+Payloads are recorded in production with payload_recording_rate > 0 (see payload_recorder.py), which
+logs a sample of the requests anonymized. `extract` takes them from a Cloud Logging export, e.g.
+    gcloud logging read 'textPayload:"Recorded Looker payload"' --format='value(textPayload)' > export.txt
+Without --payloads the replay sends the requests of benchmarks/bench_e2e.py, one action after the other.
+
+Each concurrency level runs against a fresh server process, so the memory is the one of an instance
+that received that burst: <concurrency> clients send --requests requests, each one waiting for the
+response before sending the next. For each level the latency percentiles, error and rejection (503)
+rates, throughput and the peak and mean RSS of the server are reported.
+
+Usage (from looker-actionhub-dev):
+    python benchmarks/bench_load.py extract export.txt payloads.jsonl
+    python benchmarks/bench_load.py replay --payloads payloads.jsonl --concurrency 1 8 32 80 --rows 20000
+    python benchmarks/bench_load.py replay --concurrency 8 80 --threads 80 --output curve.json
+"""
+# Import libs
+import argparse
+import copy
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS_DIR = os.path.join(BASE_DIR, "benchmarks")
+sys.path.insert(0, BASE_DIR)
+
+from bench_e2e import ACTIONS, build_request
+from payload_recorder import RECORD_PREFIX
+
+
+def extract_payloads(export_path, payloads_path):
+    """
+    Writes the payloads found in a log export as JSON lines
+
+    :return                         Number of payloads written
+    """
+    count = 0
+    with open(export_path) as export, open(payloads_path, "w") as payloads:
+        for line in export:
+            position = line.find(RECORD_PREFIX)
+            if position < 0:
+                continue
+            payload = json.loads(line[position + len(RECORD_PREFIX):])
+            payloads.write(json.dumps(payload) + "\n")
+            count += 1
+    return count
+
+
+def load_payloads(payloads_path):
+    if payloads_path is None:
+        return [{"action": action, "request": build_request(action, None)} for action in ACTIONS]
+
+    with open(payloads_path) as f:
+        payloads = [json.loads(line) for line in f if line.strip()]
+    return sorted(payloads, key=lambda payload: payload.get("received_at", ""))
+
+
+def serve(threads):
+    """
+    Serves the app on waitress with the stand-ins, prints the port and the URL of the stand-ins
+    """
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from standins import install_standins
+
+    standins = install_standins()
+
+    import app
+    from waitress import create_server
+
+    server = create_server(app.my_api, host="127.0.0.1", port=0, threads=threads, connection_limit=max(100, threads * 2))
+    print(json.dumps({"port": server.effective_port, "standins_url": standins.http.url}), flush=True)
+    server.run()
+
+
+class ServerProcess():
+    """
+    App served by waitress in a child process, with its memory sampled while it runs
+    """
+    def __init__(self, threads, sample_interval=0.1):
+        self.stderr = tempfile.NamedTemporaryFile(prefix="bench_load_", suffix=".log", delete=False)
+        env = {**os.environ, "GOOGLE_CLOUD_PROJECT": "dev-bench", "execute_mode": "sync"}
+        command = [sys.executable, os.path.abspath(__file__), "serve", "--threads", str(threads)]
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=self.stderr, text=True, cwd=BASE_DIR, env=env)
+
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError(f"The server did not start, see {self.stderr.name}")
+        info = json.loads(line)
+        self.url = f"http://127.0.0.1:{info['port']}"
+        self.standins_url = info["standins_url"]
+
+        self.sample_interval = sample_interval
+        self.samples = []
+        self.__stop = threading.Event()
+        self.__sampler = threading.Thread(target=self.__sample, name="rss-sampler", daemon=True)
+        self.__sampler.start()
+
+    def __status(self, field):
+        with open(f"/proc/{self.process.pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+        return 0
+
+    def __sample(self):
+        while not self.__stop.wait(self.sample_interval):
+            try:
+                self.samples.append(self.__status("VmRSS"))
+            except OSError:
+                return
+
+    def peak_rss_mb(self):
+        return self.__status("VmHWM")
+
+    def close(self):
+        self.__stop.set()
+        self.process.terminate()
+        self.process.wait(30)
+        self.stderr.close()
+        os.unlink(self.stderr.name)
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+def prepare_request(payload, number, standins_url, rows, extra_columns):
+    """
+    Request of a replayed payload, with the CSV served by the stand-ins. Each request gets its own
+    campaign and segment, otherwise the actions would skip the ones already sent today
+    """
+    request_json = copy.deepcopy(payload["request"])
+    shape = payload["action"].split("_")[0]
+    campaign_code = f"CMP_LOAD_{number}"
+    request_json["scheduled_plan"]["download_url"] = f"{standins_url}/looker/{shape}.csv?rows={rows}&extra_columns={extra_columns}&campaign={campaign_code}"
+    if "segment_name" in request_json.get("form_params", {}):
+        request_json["form_params"]["segment_name"] = f"{request_json['form_params']['segment_name']}_{number}"
+    return request_json
+
+
+def run_level(payloads, concurrency, total_requests, threads, rows, extra_columns, timeout):
+    """
+    Sends <total_requests> requests with <concurrency> clients to a fresh server
+
+    :return                         Dict with the measures of the level
+    """
+    server = ServerProcess(threads)
+    results = []
+    results_lock = threading.Lock()
+    counter = iter(range(total_requests))
+    counter_lock = threading.Lock()
+
+    def client():
+        session = requests.Session()
+        while True:
+            with counter_lock:
+                number = next(counter, None)
+            if number is None:
+                return
+
+            payload = payloads[number % len(payloads)]
+            request_json = prepare_request(payload, number, server.standins_url, rows, extra_columns)
+            start = time.perf_counter()
+            try:
+                response = session.post(f"{server.url}/{payload['action']}/execute", json=request_json, timeout=timeout)
+                if response.status_code == 503:
+                    outcome = "rejected"
+                elif response.status_code == 200 and response.json()["looker"]["success"]:
+                    outcome = "ok"
+                else:
+                    outcome = "error"
+            except requests.RequestException:
+                outcome = "error"
+
+            with results_lock:
+                results.append((payload["action"], outcome, time.perf_counter() - start))
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for _ in range(concurrency):
+                executor.submit(client)
+        wall = time.perf_counter() - start
+        peak_rss = server.peak_rss_mb()
+        samples = list(server.samples)
+    finally:
+        server.close()
+
+    latencies = [latency for _, outcome, latency in results if outcome == "ok"]
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "ok": len(latencies),
+        "error_rate": sum(outcome == "error" for _, outcome, _ in results) / len(results),
+        "rejected_rate": sum(outcome == "rejected" for _, outcome, _ in results) / len(results),
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "requests_per_second": len(results) / wall,
+        "rows_per_second": len(latencies) * rows / wall,
+        "peak_rss_mb": peak_rss,
+        "mean_rss_mb": sum(samples) / len(samples) if samples else None,
+        "by_action": {
+            action: {
+                "requests": sum(1 for name, _, _ in results if name == action),
+                "p95": percentile([latency for name, outcome, latency in results if name == action and outcome == "ok"], 0.95)
+            }
+            for action in sorted({name for name, _, _ in results})
+        }
+    }
+
+
+def print_levels(levels):
+    def seconds(value):
+        return f"{value:8.2f}" if value is not None else "       -"
+
+    print(f"{'conc':>5} {'reqs':>5} {'err%':>6} {'503%':>6} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'req/s':>7} {'rows/s':>9} {'peak MB':>8} {'mean MB':>8}")
+    for level in levels:
+        mean_rss = f"{level['mean_rss_mb']:8.1f}" if level["mean_rss_mb"] is not None else "       -"
+        print(f"{level['concurrency']:5d} {level['requests']:5d} {100 * level['error_rate']:6.1f} {100 * level['rejected_rate']:6.1f} "
+              f"{seconds(level['p50'])} {seconds(level['p95'])} {seconds(level['p99'])} {level['requests_per_second']:7.2f} "
+              f"{level['rows_per_second']:9.0f} {level['peak_rss_mb']:8.1f} {mean_rss}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    extract = commands.add_parser("extract", help="Extracts the recorded payloads from a log export")
+    extract.add_argument("export", help="Text export of the log entries")
+    extract.add_argument("payloads", help="JSON lines file written")
+
+    replay = commands.add_parser("replay", help="Replays payloads at several concurrency levels")
+    replay.add_argument("--payloads", help="JSON lines file written by extract, synthetic payloads by default")
+    replay.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 80], help="Concurrent clients of each level")
+    replay.add_argument("--requests", type=int, help="Requests of each level, 2 x concurrency by default")
+    replay.add_argument("--threads", type=int, default=int(os.environ.get("waitress_threads", "4")), help="waitress threads of the server")
+    replay.add_argument("--rows", type=int, default=20000, help="Rows of the CSV of each request")
+    replay.add_argument("--extra-columns", type=int, default=0)
+    replay.add_argument("--timeout", type=float, default=600, help="Seconds a request can take")
+    replay.add_argument("--output", help="JSON file the levels are written to")
+
+    serve_parser = commands.add_parser("serve", help=argparse.SUPPRESS)
+    serve_parser.add_argument("--threads", type=int, default=4)
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.threads)
+        return
+
+    if args.command == "extract":
+        print(f"{extract_payloads(args.export, args.payloads)} payloads written to {args.payloads}")
+        return
+
+    payloads = load_payloads(args.payloads)
+    print(f"{len(payloads)} payloads, {args.rows} rows each, {args.threads} waitress threads")
+    levels = []
+    for concurrency in args.concurrency:
+        levels.append(run_level(payloads, concurrency, args.requests or 2 * concurrency, args.threads, args.rows, args.extra_columns, args.timeout))
+    print_levels(levels)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"threads": args.threads, "rows": args.rows, "levels": levels}, f, indent=2)
+        print(f"\nLevels written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Cold-start benchmark: import time and memory of the service and of each module the actions load.
+
+Every measure runs in a fresh interpreter. For app the time to import it and to answer a first /list
+request is reported, then the cost of the pre-warm (prewarm.py). For each module the cumulative
+import time reported by `python -X importtime` is shown, with the memory of the interpreter after it.
+
+Usage (from looker-actionhub-dev):
+    python benchmarks/bench_startup.py --runs 5
+    python benchmarks/bench_startup.py --modules pandas google_ads
+"""
+# Import libs
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from prewarm import ACTION_MODULES
+
+
+# Credentials are replaced by anonymous ones, the benchmark never calls the APIs
+SETUP = """
+import os, resource, sys, time
+sys.path.insert(0, {base_dir!r})
+import google.auth
+from google.auth.credentials import AnonymousCredentials
+google.auth.default = lambda *a, **k: (AnonymousCredentials(), os.environ.get("GOOGLE_CLOUD_PROJECT", "development"))
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+"""
+
+APP_SCRIPT = SETUP + """
+start = time.perf_counter()
+import app
+imported = time.perf_counter() - start
+imported_rss = rss_mb()
+
+start = time.perf_counter()
+app.my_api.test_client().post("/list")
+first_list = time.perf_counter() - start
+
+import prewarm
+start = time.perf_counter()
+prewarm.prewarm()
+prewarmed = time.perf_counter() - start
+print(json.dumps({{"import": imported, "import_rss": imported_rss, "first_list": first_list, "prewarm": prewarmed, "prewarm_rss": rss_mb()}}))
+"""
+
+MODULE_SCRIPT = SETUP + """
+import {module}
+print(rss_mb())
+"""
+
+
+def run_python(script, *options):
+    env = {**os.environ, "log_batching": "true", "GOOGLE_CLOUD_PROJECT": "development"}
+    result = subprocess.run([sys.executable, *options, "-c", script], capture_output=True, text=True, cwd=BASE_DIR, env=env)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return result
+
+
+def measure_app(runs):
+    results = [json.loads(run_python("import json\n" + APP_SCRIPT.format(base_dir=BASE_DIR)).stdout.strip().splitlines()[-1]) for _ in range(runs)]
+    print(f"app ({runs} runs, median)")
+    for name, unit in (("import", "s"), ("import_rss", "MB"), ("first_list", "s"), ("prewarm", "s"), ("prewarm_rss", "MB")):
+        print(f"  {name:<12} {statistics.median(result[name] for result in results):9.3f} {unit}")
+
+
+def measure_module(module, runs):
+    timings = []
+    for _ in range(runs):
+        result = run_python(MODULE_SCRIPT.format(base_dir=BASE_DIR, module=module), "-X", "importtime")
+        # Last line of the import times is the module itself, its cumulative time includes its dependencies
+        line = [line for line in result.stderr.splitlines() if line.startswith("import time:") and line.rstrip().endswith(f" {module}")][-1]
+        timings.append(int(line.split("|")[1]) / 1e6)
+        rss = float(result.stdout.strip().splitlines()[-1])
+
+    print(f"  {module:<28} {statistics.median(timings):8.3f} s  {rss:8.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--modules", nargs="*", default=ACTION_MODULES, help="Modules to measure, the action modules by default")
+    args = parser.parse_args()
+
+    measure_app(args.runs)
+
+    print("\nmodules (cumulative import time in a fresh interpreter, memory after the import)")
+    for module in args.modules:
+        try:
+            measure_module(module, args.runs)
+        except RuntimeError as e:
+            print(f"  {module:<28} failed: {e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,611 @@
+"""
+Local stand-ins of the services the actions talk to, for the offline benchmarks.
+
+- StandInHttpServer: synthetic Looker CSVs of any size and shape, streamed as they are generated,
+  and the Adform token and DMP segments API.
+- StandInSftpServer: paramiko SFTP server accepting any password, that counts the bytes written.
+- StandInBigQueryClient: records the load jobs and answers the freshness, sent ledger, identity
+  join and Google Ads removal queries.
+- StandInS3Client: boto3 S3 client counting the parts and bytes uploaded.
+- StandInGoogleAdsClient: real Google Ads request types with services that only count operations.
+- StandInLoggingClient: Cloud Logging client counting the entries written by the batched loggers.
+
+install_standins() registers them in the client registry (clients.register_client) and points the
+env variables of the actions to the local servers.
+"""
+# Import libs
+import io
+import os
+import re
+import socket
+import stat
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import json
+import paramiko
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.api_core.exceptions import Conflict
+from google.auth.credentials import AnonymousCredentials
+from google.cloud.bigquery import SchemaField
+
+import clients
+
+
+CAMPAIGN_CODE = "CMP_BENCH"
+CSV_BLOCK_ROWS = 5000
+
+F_LOOKER_SENT_SCHEMA = [
+    SchemaField("SENT_DATE", "DATE"),
+    SchemaField("SENT_DATETIME", "DATETIME"),
+    SchemaField("CUSTOMER_CODE", "STRING"),
+    SchemaField("CAMPAIGN_CODE", "STRING"),
+    SchemaField("BRAND", "STRING"),
+    SchemaField("CHANNEL", "STRING"),
+    SchemaField("CONTENT_DESC", "STRING")
+]
+
+
+def csv_header(shape, extra_columns=0):
+    """
+    Header of the Looker CSV of an action
+    """
+    extra = [f"Attribute{i}" for i in range(extra_columns)]
+    if shape == "sftp":
+        return ["Row", "HerokuID", "CampaignID", "Email", "FirstName"] + extra
+    if shape == "adform":
+        return ["HerokuID"] + extra
+    if shape == "googleads":
+        return ["Row", "HerokuID", "Email", "PhoneNumber"] + extra
+    raise ValueError(f"Unknown CSV shape {shape}")
+
+
+def csv_rows(shape, start, end, extra_columns=0, campaign_code=CAMPAIGN_CODE):
+    """
+    Synthetic rows of the Looker CSV of an action, the same for the same row numbers. The SFTP and
+    Google Ads CSVs start with the row number, they are read with index_col=0. The first extra column
+    is a quoted text with a line break, as Looker exports the multi-line fields
+    """
+    lines = []
+    extra = "".join(f',"value {i}\nof row"' if i == 0 else f",value {i} of row" for i in range(extra_columns))
+    for i in range(start, end):
+        if shape == "sftp":
+            lines.append(f"{i},{1000000000 + i},{campaign_code},user{i}@example.com,Name{i % 997}{extra}\n")
+        elif shape == "adform":
+            lines.append(f"{1000000000 + i}{extra}\n")
+        else:
+            # A few users without phone number or email, as in the real audiences
+            email = f"User{i}@Example.com " if i % 10 else ""
+            phone = f"+34 6{i % 100000000:08d}" if i % 7 else ""
+            lines.append(f"{i},{1000000000 + i},{email},{phone}{extra}\n")
+    return "".join(lines)
+
+
+class _StandInHttpHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def __send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+
+        match = re.fullmatch(r"/looker/(\w+)\.csv", url.path)
+        if match:
+            fail_after = int(params["fail_after"]) if "fail_after" in params else None
+            self.__send_csv(match.group(1), int(params.get("rows", "1000")), int(params.get("extra_columns", "0")), params.get("campaign", CAMPAIGN_CODE), fail_after)
+        elif url.path == "/adform/v1/dmp/segments":
+            segments = self.server.adform_segments
+            self.__send_json(200, [segments[params["search"]]] if params.get("search") in segments else [])
+        else:
+            self.__send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+
+        if url.path == "/adform/token":
+            self.server.adform_token_requests += 1
+            self.__send_json(200, {"access_token": "bench-token", "expires_in": 3600})
+        elif url.path == "/adform/v1/dmp/segments":
+            segment = json.loads(body)
+            segment = {**segment, "refId": segment["RefId"], "id": len(self.server.adform_segments) + 1}
+            self.server.adform_segments[segment["refId"]] = segment
+            self.__send_json(201, segment)
+        else:
+            self.__send_json(404, {"error": "not found"})
+
+    def __send_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.server.bytes_sent += len(data)
+
+    def __send_csv(self, shape, rows, extra_columns, campaign_code, fail_after=None):
+        # Chunked, the CSV is generated while it is sent and never held in memory
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        self.__send_chunk(",".join(csv_header(shape, extra_columns)) + "\n")
+        for start in range(0, rows, CSV_BLOCK_ROWS):
+            if fail_after is not None and start >= fail_after:
+                # Connection dropped in the middle of the download
+                self.close_connection = True
+                return
+            self.__send_chunk(csv_rows(shape, start, min(start + CSV_BLOCK_ROWS, rows), extra_columns, campaign_code))
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class StandInHttpServer():
+    """
+    Looker CSV downloads (GET /looker/<sftp|adform|googleads>.csv?rows=N&extra_columns=K&campaign=C) and Adform API.
+    With &fail_after=M the connection is dropped once M rows are sent
+    """
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _StandInHttpHandler)
+        self.server.daemon_threads = True
+        self.server.adform_segments = {}
+        self.server.adform_token_requests = 0
+        self.server.bytes_sent = 0
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.__thread = threading.Thread(target=self.server.serve_forever, name="standin-http", daemon=True)
+        self.__thread.start()
+
+    def csv_url(self, shape, rows, extra_columns=0, campaign_code=CAMPAIGN_CODE):
+        return f"{self.url}/looker/{shape}.csv?rows={rows}&extra_columns={extra_columns}&campaign={campaign_code}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _SinkHandle(paramiko.SFTPHandle):
+    def __init__(self, sftp_server, path, flags=0):
+        super().__init__(flags)
+        self.sftp_server = sftp_server
+        self.path = path
+
+    def write(self, offset, data):
+        with self.sftp_server.lock:
+            self.sftp_server.files[self.path] = max(self.sftp_server.files.get(self.path, 0), offset + len(data))
+            self.sftp_server.bytes_written += len(data)
+        return paramiko.SFTP_OK
+
+    def stat(self):
+        attributes = paramiko.SFTPAttributes()
+        attributes.st_mode = stat.S_IFREG | 0o644
+        attributes.st_size = self.sftp_server.files.get(self.path, 0)
+        return attributes
+
+
+class _SinkSftpInterface(paramiko.SFTPServerInterface):
+    """
+    Any path is a directory, except the files written. The content of the files is discarded
+    """
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.sftp_server = server.sftp_server
+
+    def canonicalize(self, path):
+        return os.path.normpath("/" + path).replace("//", "/")
+
+    def stat(self, path):
+        path = self.canonicalize(path)
+        attributes = paramiko.SFTPAttributes()
+        if path in self.sftp_server.files:
+            attributes.st_mode = stat.S_IFREG | 0o644
+            attributes.st_size = self.sftp_server.files[path]
+        else:
+            attributes.st_mode = stat.S_IFDIR | 0o755
+        return attributes
+
+    lstat = stat
+
+    def list_folder(self, path):
+        return []
+
+    def chattr(self, path, attr):
+        path = self.canonicalize(path)
+        with self.sftp_server.lock:
+            if path not in self.sftp_server.files:
+                return paramiko.SFTP_NO_SUCH_FILE
+            if attr.st_size is not None:
+                self.sftp_server.files[path] = attr.st_size
+        return paramiko.SFTP_OK
+
+    def remove(self, path):
+        path = self.canonicalize(path)
+        with self.sftp_server.lock:
+            if self.sftp_server.files.pop(path, None) is None:
+                return paramiko.SFTP_NO_SUCH_FILE
+        return paramiko.SFTP_OK
+
+    def open(self, path, flags, attr):
+        path = self.canonicalize(path)
+        with self.sftp_server.lock:
+            self.sftp_server.files.setdefault(path, 0)
+            self.sftp_server.files_opened += 1
+        return _SinkHandle(self.sftp_server, path, flags)
+
+
+class _SftpAuth(paramiko.ServerInterface):
+    def __init__(self, sftp_server):
+        self.sftp_server = sftp_server
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == "session" else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class StandInSftpServer():
+    """
+    SFTP server on localhost that accepts any user and password and discards the content of the files
+    """
+    def __init__(self):
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.files = {}
+        self.files_opened = 0
+        self.bytes_written = 0
+        self.lock = threading.Lock()
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__socket.bind(("127.0.0.1", 0))
+        self.__socket.listen(16)
+        self.port = self.__socket.getsockname()[1]
+        self.__closed = False
+        threading.Thread(target=self.__accept, name="standin-sftp", daemon=True).start()
+
+    def __accept(self):
+        while not self.__closed:
+            try:
+                connection, _ = self.__socket.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, _SinkSftpInterface)
+            auth = _SftpAuth(self)
+            auth.sftp_server = self
+            transport.start_server(server=auth)
+
+    def close(self):
+        self.__closed = True
+        self.__socket.close()
+
+
+class _Row(tuple):
+    """
+    Row of a query result, accessed by position like bigquery.Row
+    """
+
+
+class StandInRowIterator():
+    def __init__(self, table, page_size=None, max_results=None):
+        if max_results is not None:
+            table = table.slice(0, max_results)
+        self.table = table
+        self.page_size = page_size or 100000
+        self.total_rows = table.num_rows
+
+    def __iter__(self):
+        columns = [column.to_pylist() for column in self.table.columns]
+        return (_Row(values) for values in zip(*columns))
+
+    def to_arrow_iterable(self, bqstorage_client=None, max_queue_size=None):
+        return iter(self.table.to_batches(max_chunksize=self.page_size))
+
+    def to_dataframe_iterable(self, bqstorage_client=None, dtypes=None, max_queue_size=None):
+        return (batch.to_pandas() for batch in self.to_arrow_iterable())
+
+    def to_dataframe(self, *args, **kwargs):
+        return self.table.to_pandas()
+
+
+class StandInQueryJob():
+    def __init__(self, table):
+        self.table = table
+
+    def result(self, page_size=None, max_results=None, **kwargs):
+        return StandInRowIterator(self.table, page_size, max_results)
+
+    def to_dataframe(self, *args, **kwargs):
+        return self.table.to_pandas()
+
+
+class StandInLoadJob():
+    def __init__(self, rows, job_id=None):
+        self.job_id = job_id
+        self.output_rows = rows
+
+    def result(self, *args, **kwargs):
+        return self
+
+
+class StandInBigQueryClient():
+    """
+    BigQuery client that keeps the rows loaded in F_LOOKER_SENT (customer, campaign and channel only)
+    and answers the queries of the actions from them
+    """
+    def __init__(self, removed_users=0):
+        """
+        :param removed_users:       Users returned by the Google Ads removal query
+        """
+        self.removed_users = removed_users
+        self.queries = []
+        self.load_jobs = 0
+        self.rows_loaded = 0
+        self.bytes_loaded = 0
+        self.jobs = {}
+        self.__sent = []
+        self.__lock = threading.Lock()
+
+    def get_table(self, table_ref):
+        return type("Table", (), {"schema": F_LOOKER_SENT_SCHEMA, "table_ref": table_ref})()
+
+    def __record_load(self, table, nbytes, job_id=None):
+        with self.__lock:
+            if job_id is not None and job_id in self.jobs:
+                raise Conflict(f"Already Exists: Job {job_id}")
+            if job_id is not None:
+                self.jobs[job_id] = StandInLoadJob(table.num_rows, job_id)
+            self.load_jobs += 1
+            self.rows_loaded += table.num_rows
+            self.bytes_loaded += nbytes
+            if {"CUSTOMER_CODE", "CAMPAIGN_CODE", "CHANNEL"} <= set(table.column_names):
+                self.__sent.append(table.select(["CUSTOMER_CODE", "CAMPAIGN_CODE", "CHANNEL"]))
+        return StandInLoadJob(table.num_rows)
+
+    def load_table_from_file(self, file_obj, table_ref, job_config=None, job_id=None, **kwargs):
+        data = file_obj.read()
+        return self.__record_load(pq.read_table(io.BytesIO(data)), len(data), job_id)
+
+    def get_job(self, job_id, **kwargs):
+        return self.jobs[job_id]
+
+    def load_table_from_dataframe(self, dataframe, table_ref, job_config=None, **kwargs):
+        table = pa.Table.from_pandas(dataframe, preserve_index=False)
+        return self.__record_load(table, table.nbytes)
+
+    def __sent_rows(self, channel, campaign_code):
+        with self.__lock:
+            tables = list(self.__sent)
+        if not tables:
+            return pa.table({"CUSTOMER_CODE": pa.array([], pa.string())})
+        table = pa.concat_tables(tables)
+        mask = pa.compute.and_(pa.compute.equal(table["CHANNEL"], channel), pa.compute.equal(table["CAMPAIGN_CODE"], campaign_code))
+        return table.filter(mask)
+
+    def query(self, sql, job_config=None, **kwargs):
+        with self.__lock:
+            self.queries.append(sql)
+
+        if "TABLES_LAST_UPDATE" in sql:
+            today = (datetime.now() + timedelta(hours=1)).date()
+            return StandInQueryJob(pa.table({"LAST_UPDATE_DATE": pa.array([today], pa.date32())}))
+
+        if "LAST_SENT_DATE" in sql:
+            return StandInQueryJob(pa.table({name: pa.array([], pa.string()) for name in ("CHANNEL", "BRAND", "CAMPAIGN_CODE")} | {"LAST_SENT_DATE": pa.array([], pa.date32())}))
+
+        if "M_MEDIA_KNOWN_IDENTITY" in sql and "F_LOOKER_SENT" in sql:
+            campaign_code = re.search(r"CAMPAIGN_CODE\s*=\s*'([^']*)'", sql).group(1)
+            customers = pa.compute.unique(self.__sent_rows("ADFORM", campaign_code)["CUSTOMER_CODE"])
+            external_codes = pa.compute.binary_join_element_wise("ext-", customers, "")
+            return StandInQueryJob(pa.table({"EXTERNAL_CODE": external_codes, "CAMPAIGN_CODE": pa.array([campaign_code] * len(customers), pa.string())}))
+
+        if "JSON_EXTRACT_SCALAR" in sql:
+            return StandInQueryJob(pa.table({
+                "email": pa.array([f"removed{i}@example.com" for i in range(self.removed_users)], pa.string()),
+                "phone_number": pa.array([f"+34 7{i:08d}" for i in range(self.removed_users)], pa.string())
+            }))
+
+        return StandInQueryJob(pa.table({"f0_": pa.array([], pa.string())}))
+
+
+class StandInS3Client():
+    """
+    boto3 S3 client that counts what is uploaded
+    """
+    def __init__(self):
+        self.objects = {}
+        self.parts = 0
+        self.bytes_uploaded = 0
+        self.__uploads = {}
+        self.__lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        with self.__lock:
+            self.objects[f"{Bucket}/{Key}"] = len(Body)
+            self.bytes_uploaded += len(Body)
+        return {"ETag": "put"}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        with self.__lock:
+            upload_id = f"upload-{len(self.__uploads) + 1}"
+            self.__uploads[upload_id] = 0
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        with self.__lock:
+            self.__uploads[UploadId] += len(Body)
+            self.parts += 1
+            self.bytes_uploaded += len(Body)
+        return {"ETag": f"part-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        with self.__lock:
+            self.objects[f"{Bucket}/{Key}"] = self.__uploads.pop(UploadId)
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        with self.__lock:
+            self.__uploads.pop(UploadId, None)
+        return {}
+
+
+class _StandInGoogleAdsService():
+    def __init__(self, client):
+        self.client = client
+
+    # GoogleAdsService
+    def search(self, customer_id, query):
+        user_list = type("UserList", (), {"id": 1234567890})()
+        return [type("Row", (), {"user_list": user_list})()]
+
+    # UserListService
+    def user_list_path(self, customer_id, user_list_id):
+        return f"customers/{customer_id}/userLists/{user_list_id}"
+
+    # OfflineUserDataJobService
+    def create_offline_user_data_job(self, customer_id, job):
+        with self.client.lock:
+            self.client.jobs += 1
+            return type("Response", (), {"resource_name": f"customers/{customer_id}/offlineUserDataJobs/{self.client.jobs}"})()
+
+    def add_offline_user_data_job_operations(self, request):
+        # Serialized like the real client would, it is part of the cost of an upload
+        size = request.ByteSize()
+        with self.client.lock:
+            self.client.requests += 1
+            self.client.operations += len(request.operations)
+            self.client.bytes_sent += size
+        time.sleep(self.client.request_latency)
+        return None
+
+    def run_offline_user_data_job(self, request):
+        return None
+
+
+class StandInGoogleAdsClient():
+    """
+    Google Ads client with the real request types and enums, whose services count the operations
+    instead of sending them
+    """
+    def __init__(self, request_latency=0.0):
+        """
+        :param request_latency:     Seconds each AddOfflineUserDataJobOperations request takes
+        """
+        from google.ads.googleads.client import GoogleAdsClient
+
+        self.request_latency = request_latency
+        self.jobs = 0
+        self.requests = 0
+        self.operations = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.__client = GoogleAdsClient(credentials=AnonymousCredentials(), developer_token="standin", use_proto_plus=False)
+        self.enums = self.__client.enums
+
+    def get_type(self, name, *args, **kwargs):
+        return self.__client.get_type(name, *args, **kwargs)
+
+    def get_service(self, name, *args, **kwargs):
+        return _StandInGoogleAdsService(self)
+
+
+class _StandInLogBatch():
+    def __init__(self, logging_client):
+        self.logging_client = logging_client
+        self.entries = 0
+
+    def log_text(self, text, **kwargs):
+        self.entries += 1
+
+    def commit(self):
+        with self.logging_client.lock:
+            self.logging_client.batches += 1
+            self.logging_client.entries += self.entries
+
+
+class _StandInCloudLogger():
+    def __init__(self, logging_client):
+        self.logging_client = logging_client
+
+    def batch(self):
+        return _StandInLogBatch(self.logging_client)
+
+    def log_text(self, text, **kwargs):
+        with self.logging_client.lock:
+            self.logging_client.entries += 1
+
+
+class StandInLoggingClient():
+    """
+    Cloud Logging client counting the entries and batches written
+    """
+    def __init__(self):
+        self.entries = 0
+        self.batches = 0
+        self.lock = threading.Lock()
+
+    def logger(self, name):
+        return _StandInCloudLogger(self)
+
+
+class StandIns():
+    """
+    The stand-ins of a benchmark run
+    """
+    def __init__(self, removed_users=0, googleads_latency=0.0):
+        self.http = StandInHttpServer()
+        self.sftp = StandInSftpServer()
+        self.bigquery = StandInBigQueryClient(removed_users=removed_users)
+        self.s3 = StandInS3Client()
+        self.google_ads = StandInGoogleAdsClient(request_latency=googleads_latency)
+        self.logging = StandInLoggingClient()
+
+    def close(self):
+        self.http.close()
+        self.sftp.close()
+
+
+def install_standins(removed_users=0, googleads_latency=0.0):
+    """
+    Starts the stand-ins, registers their clients and points the env variables of the actions to them.
+    Must be called before app is imported, the modules create their loggers when they are imported
+
+    :return                         StandIns
+    """
+    standins = StandIns(removed_users=removed_users, googleads_latency=googleads_latency)
+
+    os.environ.update({
+        "sfmcSftpHost": "127.0.0.1",
+        "sfmcSftpPort": str(standins.sftp.port),
+        "adform_api_url": f"{standins.http.url}/adform",
+        "adform_token_url": f"{standins.http.url}/adform/token",
+        "adform_client_id": "bench",
+        "adform_client_secret": "bench",
+        "ProviderTitle": "bench",
+        "DataProviderId": "1",
+        "CategoryId": "1",
+        "Ttl": "30",
+        "Fee": "0",
+        "Frequency": "1",
+        "Status": "active"
+    })
+
+    clients.register_client("credentials", (AnonymousCredentials(), "dev-bench"))
+    clients.register_client("logging", standins.logging)
+    clients.register_client("bigquery", standins.bigquery)
+    clients.register_client("bigquery_storage", False)
+    clients.register_client(f"s3:{os.environ.get('adform_aws_access_key', 'NOT FOUND')}", standins.s3)
+    clients.register_client("google_ads", standins.google_ads)
+    return standins
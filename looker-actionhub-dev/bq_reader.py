@@ -0,0 +1,95 @@
+# Import libs
+import os
+
+from clients import get_bigquery_client, get_bigquery_storage_client
+
+
+def query_scalar(query):
+    """
+    Runs a query that returns a single value. Only the first row is fetched, without dataframes
+
+    :param query:                   SQL query
+    :return                         First column of the first row, None if there are no rows
+    """
+    for row in get_bigquery_client().query(query).result(max_results=1):
+        return row[0]
+    return None
+
+
+def query_rows(query, job_config=None):
+    """
+    Runs a query with a small result and returns its rows
+
+    :param query:                   SQL query
+    :param job_config:              QueryJobConfig, with the query parameters
+    :return                         List of bigquery Row (tuple-like, also accessed by column name)
+    """
+    return list(get_bigquery_client().query(query, job_config=job_config).result())
+
+
+class QueryReader():
+    """
+    Streams the result of a query as Arrow record batches.
+
+    Results that fit in the first page are read from the query response. Larger ones are read through the
+    BigQuery Storage Read API when it is available, or page by page over the REST API otherwise, so the
+    whole result is never held in memory.
+    """
+    def __init__(self, query, page_size=100000, max_queue_size=2):
+        """
+        :param query:               SQL query
+        :param page_size:           Rows of each REST page (and of the first page)
+        :param max_queue_size:      Storage API batches buffered while the consumer is busy
+        """
+        self.query = query
+        self.page_size = page_size
+        self.max_queue_size = max_queue_size
+        self.rows_read = 0
+        self.batches_read = 0
+        self.__rows = None
+
+    def result(self):
+        """
+        Runs the query and waits for it to finish, the result is not fetched yet
+
+        :return                     bigquery RowIterator
+        """
+        if self.__rows is None:
+            self.__rows = get_bigquery_client().query(self.query).result(page_size=self.page_size)
+        return self.__rows
+
+    @property
+    def total_rows(self):
+        return self.result().total_rows
+
+    def iter_batches(self):
+        """
+        Yields the result as pyarrow.RecordBatch
+        """
+        for batch in self.result().to_arrow_iterable(bqstorage_client=get_bigquery_storage_client(), max_queue_size=self.max_queue_size):
+            self.rows_read += batch.num_rows
+            self.batches_read += 1
+            yield batch
+
+    def iter_dataframes(self):
+        """
+        Yields the result as pandas DataFrames, one per record batch
+        """
+        for batch in self.iter_batches():
+            yield batch.to_pandas()
+
+    def __iter__(self):
+        return self.iter_batches()
+
+
+def read_query(query, page_size=None):
+    """
+    Creates a reader configured from the env variables
+
+    :param page_size:               Rows of each REST page, bq_reader_page_size by default
+    """
+    return QueryReader(
+        query,
+        page_size = page_size or int(os.environ.get("bq_reader_page_size", "100000")),
+        max_queue_size = int(os.environ.get("bq_reader_max_queue_size", "2"))
+    )
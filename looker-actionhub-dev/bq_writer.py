@@ -0,0 +1,223 @@
+# Import libs
+import io
+import os
+import queue
+import threading
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.api_core.exceptions import Conflict
+from google.cloud import bigquery
+
+from clients import get_bigquery_client
+
+
+# Arrow types used to write the BigQuery column types in Parquet
+ARROW_TYPES = {
+    "STRING": pa.string(),
+    "JSON": pa.string(),
+    "BYTES": pa.binary(),
+    "INTEGER": pa.int64(),
+    "INT64": pa.int64(),
+    "FLOAT": pa.float64(),
+    "FLOAT64": pa.float64(),
+    "NUMERIC": pa.decimal128(38, 9),
+    "BIGNUMERIC": pa.decimal256(76, 38),
+    "BOOLEAN": pa.bool_(),
+    "BOOL": pa.bool_(),
+    "TIMESTAMP": pa.timestamp("us", tz="UTC"),
+    "DATETIME": pa.timestamp("us"),
+    "DATE": pa.date32(),
+    "TIME": pa.time64("us"),
+}
+
+
+class BigQueryBatchWriter():
+    """
+    Appends rows to a BigQuery table with a single load job per action instead of one per chunk.
+
+    The chunks are converted to Arrow record batches and buffered by a background thread, so the
+    caller does not wait for BigQuery. The buffer is committed with one Parquet load job when it
+    reaches <flush_bytes> and when the writer is closed.
+
+    With a job_id_prefix the id of each load job is the prefix and the rows committed before it, so a
+    retry loading the same rows again finds the job of the previous attempt instead of duplicating them.
+    """
+    def __init__(self, table_ref, flush_bytes=32 * 1024 * 1024, queue_size=4, job_id_prefix=None, on_commit=None, rows_offset=0):
+        """
+        :param table_ref:           Destination table (dataset.table or project.dataset.table)
+        :param flush_bytes:         Size of the buffered batches that triggers a load job
+        :param queue_size:          Chunks waiting to be converted before append() blocks
+        :param job_id_prefix:       Prefix of the load job ids, random ids if None
+        :param on_commit:           Function called with the rows committed after each load job, including rows_offset
+        :param rows_offset:         Rows of the delivery committed by a previous attempt
+        """
+        self.table_ref = table_ref
+        self.flush_bytes = flush_bytes
+        self.job_id_prefix = job_id_prefix
+        self.on_commit = on_commit
+        self.rows_offset = rows_offset
+        self.rows_appended = 0
+        self.rows_committed = 0
+        self.load_jobs = 0
+        self.__chunks = queue.Queue(maxsize=queue_size)
+        self.__batches = []
+        self.__buffered_bytes = 0
+        self.__arrow_schema = None
+        self.__error = None
+        self.__thread = None
+        self.__closed = False
+        self.__aborted = False
+        self.__closing = False
+
+    def __to_arrow(self, dataframe):
+        if self.__arrow_schema is None:
+            table = get_bigquery_client().get_table(self.table_ref)
+            self.__arrow_schema = {field.name: ARROW_TYPES.get(field.field_type) for field in table.schema}
+
+        fields = []
+        for column in dataframe.columns:
+            arrow_type = self.__arrow_schema.get(column)
+            if arrow_type is None:
+                # Column unknown by the table, BigQuery will report it when loading
+                arrow_type = pa.Array.from_pandas(dataframe[column]).type
+            fields.append(pa.field(column, arrow_type))
+
+        return pa.Table.from_pandas(dataframe, schema=pa.schema(fields), preserve_index=False)
+
+    def __commit(self):
+        if not self.__batches:
+            return
+
+        table = pa.Table.from_batches(self.__batches)
+        self.__batches = []
+        self.__buffered_bytes = 0
+
+        parquet_file = io.BytesIO()
+        pq.write_table(table, parquet_file, compression="snappy")
+        parquet_file.seek(0)
+
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            create_disposition="CREATE_NEVER",
+            write_disposition="WRITE_APPEND"
+        )
+        job_id = f"{self.job_id_prefix}_{self.rows_offset + self.rows_committed}" if self.job_id_prefix else None
+        try:
+            job = get_bigquery_client().load_table_from_file(parquet_file, self.table_ref, job_config=job_config, job_id=job_id)
+            job.result() # Wait to finish the job
+        except Conflict:
+            if job_id is None:
+                raise
+            # Loaded by a previous attempt that stopped before recording it, the rows are not loaded again
+            job = get_bigquery_client().get_job(job_id)
+            job.result()
+            if job.output_rows != table.num_rows:
+                raise
+
+        self.load_jobs += 1
+        self.rows_committed += table.num_rows
+        if self.on_commit is not None:
+            self.on_commit(self.rows_offset + self.rows_committed)
+
+    def __run(self):
+        try:
+            while True:
+                dataframe = self.__chunks.get()
+                if dataframe is None:
+                    if not self.__aborted:
+                        self.__commit()
+                    return
+                if self.__aborted:
+                    continue
+
+                table = self.__to_arrow(dataframe)
+                self.__batches.extend(table.to_batches())
+                self.__buffered_bytes += table.nbytes
+
+                # Size-based flush, keeps the memory used by the buffer bounded
+                if self.__buffered_bytes >= self.flush_bytes:
+                    self.__commit()
+
+        except Exception as e:
+            self.__error = e
+            # Drain the queue so the producer is never blocked on a dead writer
+            while True:
+                try:
+                    if self.__chunks.get_nowait() is None:
+                        return
+                except queue.Empty:
+                    return
+
+    def __raise_if_failed(self):
+        if self.__error is not None:
+            raise self.__error
+
+    def append(self, dataframe):
+        """
+        Enqueues a chunk of rows. Returns as soon as the chunk is queued
+
+        :param dataframe:           DataFrame with the columns of the table
+        """
+        self.__raise_if_failed()
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name="bigquery-writer", daemon=True)
+            self.__thread.start()
+
+        self.__chunks.put(dataframe)
+        self.rows_appended += len(dataframe)
+
+    def close(self):
+        """
+        Commits the buffered rows and waits until all the load jobs are finished
+
+        :return                     Number of rows written in the table
+        """
+        if not self.__closed:
+            self.__closed = True
+            if self.__thread is not None:
+                if not self.__closing:
+                    self.__chunks.put(None)
+                self.__thread.join()
+
+        self.__raise_if_failed()
+        return self.rows_committed
+
+    def start_close(self):
+        """
+        Starts committing the buffered rows without waiting for the load jobs, so the caller can do other
+        work meanwhile. close() must still be called to wait for them
+        """
+        if not self.__closed and not self.__closing:
+            self.__closing = True
+            if self.__thread is not None:
+                self.__chunks.put(None)
+
+    def abort(self):
+        """
+        Stops the writer without committing the buffered rows. Does nothing if it is already closed
+        """
+        if not self.__closed:
+            self.__closed = True
+            self.__aborted = True
+            if self.__thread is not None:
+                self.__chunks.put(None)
+
+
+def new_bigquery_writer(table_ref, job_id_prefix=None, on_commit=None, rows_offset=0):
+    """
+    Creates a writer configured from the env variables
+
+    :param table_ref:               Destination table (dataset.table or project.dataset.table)
+    :param job_id_prefix:           Prefix of the load job ids, random ids if None
+    :param on_commit:               Function called with the rows committed after each load job, including rows_offset
+    :param rows_offset:             Rows of the delivery committed by a previous attempt
+    """
+    return BigQueryBatchWriter(
+        table_ref,
+        flush_bytes = int(os.environ.get("bq_writer_flush_bytes", str(32 * 1024 * 1024))),
+        queue_size = int(os.environ.get("bq_writer_queue_size", "4")),
+        job_id_prefix = job_id_prefix,
+        on_commit = on_commit,
+        rows_offset = rows_offset
+    )
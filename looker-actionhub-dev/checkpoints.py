@@ -0,0 +1,369 @@
+# Import libs
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import fsspec
+import pandas as pd
+from google.cloud import bigquery
+
+from clients import get_bigquery_client, get_logger
+
+
+logger = get_logger('looker-actionhub')
+
+
+class CheckpointMismatch(Exception):
+    """
+    Raised when the CSV downloaded again does not start with the rows delivered by the interrupted attempt
+    """
+
+
+def delivery_run_key(action, request_json, date_str):
+    """
+    Identifies the delivery of a scheduled plan on a date, the same for all the attempts (retries) of it
+
+    :param action:                  Name of the action
+    :param request_json:            Request sent by Looker. The download URL changes between attempts, it is not used
+    :param date_str:                Date of the delivery (YYYYMMDD)
+    """
+    scheduled_plan = request_json.get("scheduled_plan") or {}
+    identity = {
+        "action": action,
+        "scheduled_plan_id": scheduled_plan.get("scheduled_plan_id"),
+        "title": scheduled_plan.get("title"),
+        "form_params": request_json.get("form_params") or {},
+        "date": date_str
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode("utf-8")).hexdigest()[:40]
+
+
+class DeliveryDigest():
+    """
+    Running digest of the rows (or bytes) of the CSV, to check that a new download starts with the same
+    content as the one of the interrupted attempt. Splitting the same rows in other chunks gives the same digest
+    """
+    def __init__(self):
+        self.__hash = hashlib.sha256()
+
+    def update_rows(self, dataframe):
+        if len(dataframe):
+            self.__hash.update(pd.util.hash_pandas_object(dataframe, index=True).to_numpy().tobytes())
+
+    def update_bytes(self, data):
+        self.__hash.update(data)
+
+    def copy(self):
+        digest = DeliveryDigest()
+        digest.__hash = self.__hash.copy()
+        return digest
+
+    def hexdigest(self):
+        return self.__hash.hexdigest()
+
+
+class DeliveryCheckpoint():
+    """
+    Progress of a delivery to the SFTP server and BigQuery: rows (or bytes in passthrough mode) already
+    in the SFTP file and rows already loaded in BigQuery, with the digest of the CSV up to each point.
+
+    The content downloaded again by a retry is passed to track_rows/track_bytes, which check it against
+    the checkpoint and tell which part of it was not delivered yet.
+    """
+    def __init__(self, store, run_key, state=None, sftp_interval=5):
+        """
+        :param store:               CheckpointStore the checkpoint is saved to
+        :param run_key:             Key of the delivery, see delivery_run_key
+        :param state:               State saved by a previous attempt, None for a new delivery
+        :param sftp_interval:       Seconds between the saves of the SFTP progress at least
+        """
+        self.store = store
+        self.run_key = run_key
+        self.sftp_interval = sftp_interval
+        self.__sftp_saved_at = 0
+        self.is_resumed = state is not None
+        self.state = state or {
+            "mode": None,
+            "sent_datetime": None,
+            "file_path": None,
+            "sftp_position": 0,
+            "sftp_bytes": 0,
+            "sftp_digest": None,
+            "bq_rows": 0,
+            "bq_digest": None,
+            "completed": False
+        }
+        self.__digest = DeliveryDigest()
+        self.__position = 0
+        self.__digests = {0: self.__digest.hexdigest()}
+        self.__digests_lock = threading.Lock()
+        self.__lock = threading.Lock()
+
+    @property
+    def completed(self):
+        return self.state["completed"]
+
+    @property
+    def sent_datetime(self):
+        return datetime.fromisoformat(self.state["sent_datetime"]) if self.state["sent_datetime"] else None
+
+    @property
+    def file_path(self):
+        return self.state["file_path"]
+
+    @property
+    def sftp_position(self):
+        return self.state["sftp_position"]
+
+    @property
+    def sftp_bytes(self):
+        return self.state["sftp_bytes"]
+
+    @property
+    def bq_rows(self):
+        return self.state["bq_rows"]
+
+    def save(self, **fields):
+        """
+        Updates the checkpoint and saves it. A failure is logged, it never stops the delivery
+        """
+        with self.__lock:
+            self.state.update(fields)
+            self.state["updated_at"] = datetime.now().replace(microsecond=0).isoformat()
+            try:
+                self.store.save(self.run_key, self.state)
+            except Exception as e:
+                logger.log_text(f"Checkpoint {self.run_key} could not be saved: {str(e)}", severity='WARNING')
+
+    def start(self, mode, sent_datetime, file_path):
+        """
+        Records how a new delivery is done. A resumed delivery keeps the ones of the first attempt
+        """
+        if not self.is_resumed:
+            self.save(mode=mode, sent_datetime=sent_datetime.isoformat(), file_path=file_path)
+
+    def __verify(self, position, length, digest_at):
+        for name in ("sftp", "bq"):
+            point = self.state["sftp_position"] if name == "sftp" else self.state["bq_rows"]
+            expected = self.state[f"{name}_digest"]
+            if expected is not None and position < point <= position + length and digest_at(point) != expected:
+                raise CheckpointMismatch(f"The CSV is not the same as in the interrupted attempt of {self.run_key}")
+
+    def track_rows(self, chunk):
+        """
+        Adds the next chunk of the CSV
+
+        :param chunk:               DataFrame with the next rows of the CSV
+        :return                     Tuple (sftp_start, bq_start), positions in the chunk of the first rows not
+                                    yet in the SFTP file and in BigQuery. Raises CheckpointMismatch
+        """
+        start = self.__position
+
+        def digest_at(point):
+            digest = self.__digest.copy()
+            digest.update_rows(chunk.iloc[:point - start])
+            return digest.hexdigest()
+
+        self.__verify(start, len(chunk), digest_at)
+        self.__digest.update_rows(chunk)
+        self.__position += len(chunk)
+        with self.__digests_lock:
+            self.__digests[self.__position] = self.__digest.hexdigest()
+
+        return (
+            min(len(chunk), max(0, self.state["sftp_position"] - start)),
+            min(len(chunk), max(0, self.state["bq_rows"] - start))
+        )
+
+    def track_bytes(self, block):
+        """
+        Adds the next block of the CSV, passthrough mode
+
+        :param block:               Next bytes of the CSV
+        :return                     Position in the block of the first byte not yet in the SFTP file. Raises CheckpointMismatch
+        """
+        start = self.__position
+
+        def digest_at(point):
+            digest = self.__digest.copy()
+            digest.update_bytes(block[:point - start])
+            return digest.hexdigest()
+
+        self.__verify(start, len(block), digest_at)
+        self.__digest.update_bytes(block)
+        self.__position += len(block)
+        with self.__digests_lock:
+            self.__digests[self.__position] = self.__digest.hexdigest()
+
+        return min(len(block), max(0, self.state["sftp_position"] - start))
+
+    @property
+    def position(self):
+        """
+        Rows (or bytes in passthrough mode) of the CSV tracked so far
+        """
+        return self.__position
+
+    def record_sftp(self, position, file_bytes, force=False):
+        """
+        Records that the SFTP file has the content of the CSV up to <position> and <file_bytes> bytes.
+        Saved at most every sftp_interval seconds unless forced
+        """
+        if not force and time.monotonic() - self.__sftp_saved_at < self.sftp_interval:
+            return
+        self.__sftp_saved_at = time.monotonic()
+
+        with self.__digests_lock:
+            digest = self.__digests.get(position)
+        self.save(sftp_position=position, sftp_bytes=file_bytes, sftp_digest=digest)
+
+    def record_bigquery(self, rows):
+        """
+        Records that the first <rows> rows of the CSV are loaded in BigQuery
+        """
+        with self.__digests_lock:
+            digest = self.__digests.get(rows)
+        self.save(bq_rows=rows, bq_digest=digest)
+
+    def complete(self):
+        self.save(completed=True)
+
+
+class CheckpointStore():
+    """
+    Checkpoints of the deliveries as JSON files. The store can be a local directory or any fsspec URL
+    (gs://bucket/prefix needs gcsfs), which survives the recycling of the instances
+    """
+    def __init__(self, uri, sftp_interval=5):
+        """
+        :param uri:                 Local directory or fsspec URL where the checkpoints are kept
+        :param sftp_interval:       Seconds between the saves of the SFTP progress of a delivery at least
+        """
+        self.uri = uri.rstrip("/")
+        self.sftp_interval = sftp_interval
+        self.fs, self.root = fsspec.core.url_to_fs(self.uri)
+        self.is_local = "file" in (self.fs.protocol if isinstance(self.fs.protocol, (tuple, list)) else (self.fs.protocol,))
+
+    def __path(self, run_key):
+        return f"{self.root}/{run_key}.json"
+
+    def load(self, run_key):
+        """
+        Returns the checkpoint of a delivery, a new one if no attempt saved it
+        """
+        path = self.__path(run_key)
+        if not self.fs.exists(path):
+            return DeliveryCheckpoint(self, run_key, sftp_interval=self.sftp_interval)
+
+        with self.fs.open(path, "r") as checkpoint_file:
+            return DeliveryCheckpoint(self, run_key, json.load(checkpoint_file), sftp_interval=self.sftp_interval)
+
+    def save(self, run_key, state):
+        data = json.dumps(state).encode("utf-8")
+        path = self.__path(run_key)
+        if not self.is_local:
+            self.fs.pipe_file(path, data)
+            return
+
+        # Written aside and renamed, a crash never leaves a truncated checkpoint
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as checkpoint_file:
+            checkpoint_file.write(data)
+        os.replace(tmp_path, path)
+
+    def delete(self, run_key):
+        path = self.__path(run_key)
+        if self.fs.exists(path):
+            self.fs.rm(path)
+
+
+def get_checkpoint_store():
+    """
+    Returns the store configured in the checkpoint_store_uri env variable, None if it is not configured
+    """
+    uri = os.environ.get("checkpoint_store_uri", "")
+    if uri == "":
+        return None
+
+    return CheckpointStore(uri, sftp_interval=float(os.environ.get("checkpoint_sftp_interval", "5")))
+
+
+def open_checkpoint(action, request_json, date_str):
+    """
+    Loads the checkpoint of the delivery of a request, a new one if it is the first attempt
+
+    :return                         DeliveryCheckpoint, None if the checkpoints are disabled or the store failed
+    """
+    checkpoint_store = get_checkpoint_store()
+    if checkpoint_store is None:
+        return None
+
+    try:
+        return checkpoint_store.load(delivery_run_key(action, request_json, date_str))
+    except Exception as e:
+        logger.log_text(f"Checkpoint of {action} could not be loaded, the delivery will not be resumable: {str(e)}", severity='WARNING')
+        return None
+
+
+def resume_sftp_file(sftp, checkpoint, file_path):
+    """
+    Leaves the SFTP file with the content recorded by the checkpoint: what was written after it is
+    truncated. If the file lost part of it the SFTP delivery starts over
+
+    :param sftp:                    paramiko SFTPClient
+    :return                         Bytes already in the file
+    """
+    try:
+        size = sftp.stat(file_path).st_size
+    except IOError:
+        size = None
+
+    offset = checkpoint.sftp_bytes
+    if size is None or size < offset:
+        if checkpoint.sftp_position > 0:
+            logger.log_text(f"SFTP file {file_path} does not have the content of checkpoint {checkpoint.run_key}, writing it again", severity='WARNING')
+        checkpoint.save(sftp_position=0, sftp_bytes=0, sftp_digest=None)
+        offset = 0
+
+    if size is not None and size != offset:
+        sftp.truncate(file_path, offset)
+    return offset
+
+
+def discard_delivery(checkpoint, sftp=None, table_ref=None, channel=None, brand=None):
+    """
+    Removes what an interrupted attempt delivered, and its checkpoint, so the delivery starts over
+
+    :param sftp:                    paramiko SFTPClient, to remove the SFTP file
+    :param table_ref:               Table the rows were loaded in, None if they were not loaded in BigQuery
+    :param channel:                 CHANNEL of the rows loaded
+    :param brand:                   BRAND of the rows loaded
+    """
+    if sftp is not None and checkpoint.file_path:
+        try:
+            sftp.remove(checkpoint.file_path)
+        except IOError:
+            pass
+
+    # The rows of the attempt are the only ones with its SENT_DATETIME
+    if table_ref is not None and checkpoint.sent_datetime is not None:
+        client = get_bigquery_client()
+        # The parameter takes the type of the column, DATETIME or TIMESTAMP depending on the table
+        sent_datetime_type = next((field.field_type for field in client.get_table(table_ref).schema if field.name == "SENT_DATETIME"), "DATETIME")
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("sent_datetime", sent_datetime_type, checkpoint.sent_datetime),
+            bigquery.ScalarQueryParameter("channel", "STRING", channel),
+            bigquery.ScalarQueryParameter("brand", "STRING", brand)
+        ])
+        client.query(f"""
+            DELETE FROM `{table_ref}`
+            WHERE SENT_DATETIME = @sent_datetime
+                AND CHANNEL = @channel
+                AND BRAND = @brand
+        """, job_config=job_config).result()
+
+    checkpoint.store.delete(checkpoint.run_key)
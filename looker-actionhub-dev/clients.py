@@ -0,0 +1,216 @@
+# Import libs
+import os
+import threading
+
+import google.auth
+import google.auth.exceptions
+import requests
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+
+from batched_logging import new_batched_logger
+
+
+# Size of the HTTP connection pools, a request slot should never wait for a free connection
+HTTP_POOL_MAXSIZE = int(os.environ.get("http_pool_maxsize", "32"))
+
+_lock = threading.RLock()
+_clients = {}
+
+
+def _get_or_create(name, factory):
+    """
+    Returns the client registered with <name>, creating it with <factory> the first time
+
+    :param name:                    Name of the client in the registry
+    :param factory:                 Function without arguments that creates the client
+    :return                         The shared client
+    """
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            # Another thread may have created it while waiting for the lock
+            client = _clients.get(name)
+            if client is None:
+                client = factory()
+                _clients[name] = client
+
+    return client
+
+
+def register_client(name, client):
+    """
+    Replaces a client of the registry, e.g. to point the actions to local stand-ins
+
+    :param name:                    Name of the client (credentials, bigquery, logging, google_ads, http...)
+    :param client:                  Object to return for that name
+    """
+    with _lock:
+        _clients[name] = client
+
+
+def reset_clients():
+    """
+    Drops all the clients of the registry, they are created again on next use
+    """
+    with _lock:
+        _clients.clear()
+
+
+def _mount_pool(session):
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _default_credentials():
+    try:
+        credentials, project_id = google.auth.default()
+    except google.auth.exceptions.DefaultCredentialsError:
+        # Probably running a local development server.
+        credentials = None
+        project_id = os.environ.get('GOOGLE_CLOUD_PROJECT', 'development')
+
+    return credentials, project_id
+
+
+def get_credentials():
+    """
+    Default credentials of the process, resolved once
+
+    :return                         Tuple (credentials, project_id). Credentials are None when running locally without ADC
+    """
+    return _get_or_create("credentials", _default_credentials)
+
+
+def get_project_id():
+    """Find the GCP project ID when running on Cloud Run."""
+    return get_credentials()[1]
+
+
+def get_env_prefixes():
+    """
+    Project and dataset prefixes of the environment the service is running in
+
+    :return                         Tuple (prefix_project, prefix_dataset)
+    """
+    def resolve():
+        project_id = get_project_id()
+        if "dev-" in project_id:
+            return "dev-", "dev_"
+        elif "test-" in project_id:
+            return "test-", "test_"
+        else:
+            return "prod-", ""
+
+    return _get_or_create("env_prefixes", resolve)
+
+
+def get_http_session():
+    """
+    Shared requests.Session with a pooled keep-alive transport, for plain HTTP calls
+    """
+    return _get_or_create("http", lambda: _mount_pool(requests.Session()))
+
+
+def get_bigquery_client():
+    """
+    Shared BigQuery client. Its authorized HTTP session is pooled so concurrent requests reuse warm connections
+    """
+    def create():
+        from google.cloud import bigquery
+
+        credentials, project_id = get_credentials()
+        if credentials is None:
+            return bigquery.Client()
+
+        return bigquery.Client(project=project_id, credentials=credentials, _http=_mount_pool(AuthorizedSession(credentials)))
+
+    return _get_or_create("bigquery", create)
+
+
+def get_bigquery_storage_client():
+    """
+    Shared BigQuery Storage Read API client, None when google-cloud-bigquery-storage is not installed
+    or bigquery_storage_enabled is false. Large query results are read through it as Arrow streams
+    """
+    def create():
+        if os.environ.get("bigquery_storage_enabled", "true").lower() != "true":
+            return False
+        try:
+            from google.cloud import bigquery_storage
+        except ImportError:
+            return False
+
+        credentials, _ = get_credentials()
+        return bigquery_storage.BigQueryReadClient(credentials=credentials)
+
+    # False is kept in the registry, so the import is only tried once
+    return _get_or_create("bigquery_storage", create) or None
+
+
+def get_logging_client():
+    """
+    Shared Cloud Logging client
+    """
+    def create():
+        from google.cloud import logging
+
+        return logging.Client()
+
+    return _get_or_create("logging", create)
+
+
+def get_logger(log_name):
+    """
+    Cloud Logging logger of the shared client. Unless log_batching is false the entries are queued
+    and written in batches from a background thread, see batched_logging.py
+
+    :param log_name:                Name of the log
+    """
+    def create():
+        if os.environ.get("log_batching", "true").lower() != "true":
+            return get_logging_client().logger(log_name)
+
+        # The Cloud Logging client is created by the writer thread, importing a module never waits for it
+        return new_batched_logger(
+            lambda: get_logging_client().logger(log_name),
+            max_entries = int(os.environ.get("log_buffer_size", "10000")),
+            batch_size = int(os.environ.get("log_batch_size", "500")),
+            flush_interval = float(os.environ.get("log_flush_interval", "1"))
+        )
+
+    return _get_or_create(f"logger:{log_name}", create)
+
+
+def get_google_ads_client():
+    """
+    Shared Google Ads client. Credentials are loaded form the environment variables
+    """
+    def create():
+        # Imported here: the Google Ads SDK is heavy and only the Google Ads action needs it
+        from google.ads.googleads.client import GoogleAdsClient
+
+        os.environ["GOOGLE_ADS_USE_PROTO_PLUS"] = "False"
+        return GoogleAdsClient.load_from_env()
+
+    return _get_or_create("google_ads", create)
+
+
+def get_s3_client(access_key, secret_key):
+    """
+    Shared boto3 S3 client of a pair of AWS keys. boto3 clients are thread safe, its connection pool
+    is sized for the parallel multipart uploads
+
+    :param access_key:              AWS access key id
+    :param secret_key:              AWS secret access key
+    """
+    def create():
+        import boto3
+        from botocore.config import Config
+
+        config = Config(max_pool_connections=HTTP_POOL_MAXSIZE, retries={"max_attempts": 5, "mode": "standard"})
+        return boto3.client("s3", aws_access_key_id=access_key, aws_secret_access_key=secret_key, config=config)
+
+    return _get_or_create(f"s3:{access_key}", create)
@@ -0,0 +1,144 @@
+# Import libs
+import csv
+import io
+import os
+from contextlib import contextmanager
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+from clients import get_http_session
+
+
+# Values pd.read_csv reads as missing by default, so the rows loaded in BigQuery do not change
+PANDAS_NULL_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"
+]
+
+# Columns of the chunks are Arrow strings held by pandas, not Python objects
+STRING_DTYPE = pd.StringDtype("pyarrow")
+
+
+class _HeaderReader(io.RawIOBase):
+    """
+    File-like object that reads the header line of a CSV ahead and replays it, the Arrow reader needs
+    the names of the columns to read all of them as strings
+    """
+    def __init__(self, source, block_size):
+        self.__source = source
+        self.__buffer = b""
+        while b"\n" not in self.__buffer:
+            block = source.read(block_size)
+            if not block:
+                # Header without line end, the Arrow reader needs one to find the columns
+                self.__buffer += b"\n" if self.__buffer else b""
+                break
+            self.__buffer += block
+
+        first_line = self.__buffer.split(b"\n", 1)[0].decode("utf-8", errors="replace")
+        self.column_names = next(csv.reader([first_line]), [])
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if self.__buffer:
+            data = self.__buffer if size < 0 else self.__buffer[:size]
+            self.__buffer = self.__buffer[len(data):]
+            return data
+        return self.__source.read(size)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def _to_dataframe(table, index_col, offset):
+    dataframe = table.to_pandas(types_mapper={pa.string(): STRING_DTYPE}.get)
+    if index_col is not None:
+        return dataframe.set_index(dataframe.columns[index_col])
+
+    # The index goes on across the chunks, as in pd.read_csv
+    dataframe.index = pd.RangeIndex(offset, offset + len(dataframe))
+    return dataframe
+
+
+def read_csv_chunks(source, chunksize=100000, index_col=None, usecols=None, keep_default_na=True, block_size=None, use_threads=True):
+    """
+    Parses a CSV with the Arrow reader, as the source is read, in chunks of string[pyarrow] columns.
+    Gives the same chunks as pd.read_csv(source, dtype=str, chunksize=chunksize, ...) without a Python
+    object per value: the columns are converted to Arrow by the BigQuery writer and the identifier
+    hashing without copies
+
+    :param source:                  Binary file-like object with the CSV
+    :param chunksize:               Rows of each chunk
+    :param index_col:               Position of the column used as index, as in pd.read_csv
+    :param usecols:                 Names of the columns read, all of them if None
+    :param keep_default_na:         If False no value is missing, empty values are empty strings
+    :param block_size:              Bytes parsed at once, env csv_block_size (1 MB) by default
+    :param use_threads:             Parses the columns of each block in parallel
+    :return                         Iterator of DataFrames
+    """
+    if block_size is None:
+        block_size = int(os.environ.get("csv_block_size", str(1024 * 1024)))
+
+    reader = _HeaderReader(source, block_size)
+    convert_options = pa_csv.ConvertOptions(
+        column_types={name: pa.string() for name in reader.column_names},
+        null_values=PANDAS_NULL_VALUES if keep_default_na else [],
+        strings_can_be_null=keep_default_na,
+        quoted_strings_can_be_null=keep_default_na,
+        include_columns=usecols
+    )
+    read_options = pa_csv.ReadOptions(block_size=block_size, use_threads=use_threads)
+    # Looker quotes the text with line breaks, the blocks are split at the line ends out of quotes
+    parse_options = pa_csv.ParseOptions(newlines_in_values=True)
+
+    if not reader.column_names:
+        return
+
+    # The batches follow the blocks, they are regrouped in chunks of <chunksize> rows
+    batches = []
+    rows = 0
+    offset = 0
+    with pa_csv.open_csv(io.BufferedReader(reader, buffer_size=block_size), read_options=read_options, parse_options=parse_options, convert_options=convert_options) as csv_reader:
+        schema = csv_reader.schema
+        for batch in csv_reader:
+            batches.append(batch)
+            rows += batch.num_rows
+            while rows >= chunksize:
+                table = pa.Table.from_batches(batches, schema=schema)
+                yield _to_dataframe(table.slice(0, chunksize), index_col, offset)
+                batches = table.slice(chunksize).to_batches()
+                rows -= chunksize
+                offset += chunksize
+
+    if rows > 0 or offset == 0:
+        # A CSV with only the header gives an empty chunk, as pd.read_csv does
+        yield _to_dataframe(pa.Table.from_batches(batches, schema=schema), index_col, offset)
+
+
+@contextmanager
+def open_csv_url(url, timeout=(10, 300)):
+    """
+    Streams the CSV of a URL (download of Looker) as a binary file-like object
+
+    :param url:                     URL of the CSV
+    :param timeout:                 Connect and read timeout, in seconds
+    """
+    with get_http_session().get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        # Compressed responses are decompressed as they are read
+        response.raw.decode_content = True
+        yield response.raw
+
+
+def read_csv_url_chunks(url, chunksize=100000, **options):
+    """
+    Downloads and parses the CSV of a URL in chunks, see read_csv_chunks
+    """
+    with open_csv_url(url) as source:
+        yield from read_csv_chunks(source, chunksize=chunksize, **options)
@@ -0,0 +1,156 @@
+# Import libs
+import os
+import threading
+from datetime import datetime, timedelta
+
+from bq_reader import query_scalar
+
+
+def get_time_now():
+    """
+    Current date and time UTC+1, the reference time used by all the actions
+    """
+    return (datetime.now() + timedelta(hours=1)).replace(microsecond=0)
+
+
+class _InFlightQuery():
+    """
+    Query being executed by one request while the others wait for its result
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class FreshnessGate():
+    """
+    Process-wide cache of the last update date of the activation layer (TABLES_LAST_UPDATE).
+
+    The date only changes once a day, so the result is cached until midnight once the layer is
+    updated, and for a short TTL while it is not. Concurrent misses are coalesced in a single query.
+    """
+    def __init__(self, not_updated_ttl=300):
+        """
+        :param not_updated_ttl:     Seconds a "not updated yet" result is cached
+        """
+        self.not_updated_ttl = not_updated_ttl
+        self.__lock = threading.Lock()
+        self.__cache = {}
+        self.__in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def __query_last_update(self, prefix_project, prefix_dataset):
+        query = f"""
+            SELECT
+                MIN(LAST_UPDATE_DATE)
+            FROM
+                `{prefix_project}cross-cloud4marketing.{prefix_dataset}clz_c4m_curated.TABLES_LAST_UPDATE`
+            WHERE
+                DATASET_NAME = '{prefix_dataset}clz_c4m_public_activation'
+            """
+        # Run query and extract result
+        return query_scalar(query).strftime("%Y%m%d")
+
+    def __expiration(self, date_last_update_str, time_now):
+        next_midnight = datetime.combine(time_now.date() + timedelta(days=1), datetime.min.time())
+
+        # Once updated today the date can not change until the day rolls over
+        if date_last_update_str >= time_now.strftime("%Y%m%d"):
+            return next_midnight
+
+        return min(time_now + timedelta(seconds=self.not_updated_ttl), next_midnight)
+
+    def get_last_update(self, prefix_project, prefix_dataset):
+        """
+        Returns the date the activation layer was last updated
+
+        :param prefix_project:      Project prefix. Depends on the environment (dev, test, prod)
+        :param prefix_dataset:      Dataset prefix. Depends on the environment
+        :return                     Last update date as a string with format YYYYMMDD
+        """
+        key = (prefix_project, prefix_dataset)
+
+        with self.__lock:
+            cached = self.__cache.get(key)
+            if cached is not None and get_time_now() < cached[1]:
+                self.hits += 1
+                return cached[0]
+
+            in_flight = self.__in_flight.get(key)
+            is_leader = in_flight is None
+            if is_leader:
+                in_flight = _InFlightQuery()
+                self.__in_flight[key] = in_flight
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        # Another request is already running the query, wait for its result
+        if not is_leader:
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.result
+
+        try:
+            date_last_update_str = self.__query_last_update(prefix_project, prefix_dataset)
+            with self.__lock:
+                self.__cache[key] = (date_last_update_str, self.__expiration(date_last_update_str, get_time_now()))
+            in_flight.result = date_last_update_str
+            return date_last_update_str
+
+        except Exception as e:
+            in_flight.error = e
+            with self.__lock:
+                self.errors += 1
+            raise
+
+        finally:
+            with self.__lock:
+                del self.__in_flight[key]
+            in_flight.done.set()
+
+    def check(self, prefix_project, prefix_dataset):
+        """
+        Checks if the tables in activation layer have been updated today.
+
+        :param prefix_project:      Project prefix. Depends on the environment (dev, test, prod)
+        :param prefix_dataset:      Dataset prefix. Depends on the environment
+        :return                     Tuple (is_updated, date_last_update_str, date_today_str)
+        """
+        date_now = get_time_now().date()
+        timedelta_days = os.environ.get("days_check_updates", "0") # timedelta must be 0 in production (current date)
+        date_today = date_now - timedelta(days=int(timedelta_days)) # for test purposes maybe we want to allow another date different from the current date
+        date_today_str = date_today.strftime("%Y%m%d")
+
+        date_last_update_str = self.get_last_update(prefix_project, prefix_dataset)
+
+        return date_last_update_str >= date_today_str, date_last_update_str, date_today_str
+
+    def invalidate(self):
+        """
+        Drops the cached dates, the next check queries BigQuery again
+        """
+        with self.__lock:
+            self.__cache.clear()
+
+    def stats(self):
+        """
+        Returns the cache counters
+        """
+        with self.__lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "errors": self.errors,
+                "cached_keys": len(self.__cache)
+            }
+
+
+# Shared by all the actions of the process
+freshness_gate = FreshnessGate(not_updated_ttl=int(os.environ.get("freshness_cache_ttl", "300")))
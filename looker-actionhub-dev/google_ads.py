@@ -1,26 +1,116 @@
-import hashlib
 import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from google.cloud import logging
-
-from google.ads.googleads.client import GoogleAdsClient
+import numpy as np
 from google.ads.googleads.errors import GoogleAdsException
 
+from clients import get_google_ads_client, get_logger
+from identifiers import DIGEST_SIZE, HashedIdentifiers, identifier_engine
+
+
+logger = get_logger('looker-actionhub')
+
+# Estimated serialized size of an operation and of each of its hashed identifiers, used to split the requests
+OPERATION_BYTES = 8
+IDENTIFIER_BYTES = 70
+
+_google_ads_customers = None
+_google_ads_customers_lock = threading.Lock()
+
 
-logger = logging.Client().logger('looker-actionhub')
+def get_google_ads_customers():
+    """
+    Returns the Google Ads account of each brand and country, the file is read once per process
+    """
+    global _google_ads_customers
+    with _google_ads_customers_lock:
+        if _google_ads_customers is None:
+            with open('config/google_ads_customers.json') as json_file:
+                _google_ads_customers = json.load(json_file)
+        return _google_ads_customers
+
+
+def _is_not_found(ex):
+    # The user list was removed or the id is not valid for the account
+    if ex.error.code().name == "NOT_FOUND":
+        return True
+    return any("NOT_FOUND" in str(error.error_code) or "INVALID_USER_LIST" in str(error.error_code) for error in ex.failure.errors)
+
+
+class SegmentCache():
+    """
+    Process-wide cache of the user list id of each segment name and Google Ads account.
+
+    User lists are almost never renamed or removed, the entries are kept for <ttl> seconds and
+    dropped as soon as the API reports that the user list does not exist.
+    """
+    def __init__(self, ttl=21600):
+        """
+        :param ttl:                 Seconds a segment id is kept
+        """
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.__segments = {}
+        self.__lock = threading.Lock()
+
+    def get(self, customer_id, segment_name):
+        """
+        Returns the cached user list id of a segment, None if it is not cached or expired
+        """
+        with self.__lock:
+            entry = self.__segments.get((customer_id, segment_name))
+            if entry is not None and entry[1] > time.monotonic():
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def put(self, customer_id, segment_name, segment_id):
+        with self.__lock:
+            self.__segments[(customer_id, segment_name)] = (segment_id, time.monotonic() + self.ttl)
+
+    def invalidate(self, customer_id, segment_id):
+        """
+        Drops the segments of an account with a user list id
+        """
+        with self.__lock:
+            for key in [key for key, entry in self.__segments.items() if key[0] == customer_id and str(entry[0]) == str(segment_id)]:
+                del self.__segments[key]
+                self.invalidations += 1
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "cached_segments": len(self.__segments)
+            }
+
+
+segment_cache = SegmentCache(ttl = int(os.environ.get("googleads_segment_cache_ttl", "21600")))
 
 
 class GoogleAdsSession():
     def __init__(self, brand, country):
         
-        os.environ["GOOGLE_ADS_USE_PROTO_PLUS"] = "False"
-        
-        # Credentials are loaded form the environment variables
-        self.client = GoogleAdsClient.load_from_env()
+        # Shared client, credentials are loaded form the environment variables once per process
+        self.client = get_google_ads_client()
+        self.country = country
+        self.__services = {}
+        self.__services_lock = threading.Lock()
+
+        # Limits of each AddOfflineUserDataJobOperationsRequest and requests sent at the same time
+        self.max_identifiers_per_request = int(os.environ.get("googleads_max_identifiers_per_request", "100000"))
+        self.max_request_bytes = int(os.environ.get("googleads_max_request_bytes", str(8 * 1024 * 1024)))
+        self.upload_workers = int(os.environ.get("googleads_upload_workers", "4"))
     
-        with open('config/google_ads_customers.json') as json_file:
-            google_ads_customers = json.load(json_file)
+        google_ads_customers = get_google_ads_customers()
         
         if(brand in google_ads_customers and country in google_ads_customers[brand]):
            self.customer_id = google_ads_customers[brand][country]
@@ -30,6 +120,19 @@ class GoogleAdsSession():
             raise Exception(error_message)
 
 
+    def get_service(self, name):
+        """
+        Returns a service client of the session. Each call to GoogleAdsClient.get_service opens a new
+        channel, they are created once and shared by the requests using the session
+
+        :param self:                Instance of the class
+        :param name:                Name of the service (GoogleAdsService, UserListService...)
+        """
+        with self.__services_lock:
+            if name not in self.__services:
+                self.__services[name] = self.client.get_service(name)
+            return self.__services[name]
+
 
     def search_segment(self, segment_name):
         """
@@ -39,7 +142,11 @@ class GoogleAdsSession():
         :param segment_name:        Name of the segment to search
         :return segment_id:         Google Ads segment id, None if the segment does not exist
         """
-        ga_service = self.client.get_service("GoogleAdsService")
+        segment_id = segment_cache.get(self.customer_id, segment_name)
+        if segment_id is not None:
+            return segment_id
+
+        ga_service = self.get_service("GoogleAdsService")
 
         # Construct the query to search for the user list by name
         query = f"""
@@ -64,6 +171,7 @@ class GoogleAdsSession():
 
             if not isEmpty:
                 logger.log_text(f"SEGMENT ALREADY EXISTS => {segment_name} : {segment_id} ", severity='DEFAULT')
+                segment_cache.put(self.customer_id, segment_name, segment_id)
                 return segment_id
             else:
                 logger.log_text(f"SEGMENT DOES NOT EXIST => {segment_name}", severity='DEFAULT')                
@@ -88,7 +196,7 @@ class GoogleAdsSession():
         """
         
         try:
-            user_list_service = self.client.get_service("UserListService")
+            user_list_service = self.get_service("UserListService")
             user_list_operation = self.client.get_type("UserListOperation")
             user_list = user_list_operation.create
             user_list.name = segment_name
@@ -103,6 +211,7 @@ class GoogleAdsSession():
             )
 
             logger.log_text(f"NEW SEGMENT CREATED => {segment_name}:{response.results[0].resource_name}", severity='DEFAULT') 
+            segment_cache.put(self.customer_id, segment_name, response.results[0].resource_name.split("/")[3])
 
             return response
         
@@ -123,12 +232,12 @@ class GoogleAdsSession():
         """
         try:
             # Step 1: Create an Offline User Data Job 
-            offline_user_data_job_service = self.client.get_service("OfflineUserDataJobService")
+            offline_user_data_job_service = self.get_service("OfflineUserDataJobService")
 
             offline_user_data_job  = self.client.get_type("OfflineUserDataJob")
             offline_user_data_job.type_ = self.client.enums.OfflineUserDataJobTypeEnum.CUSTOMER_MATCH_USER_LIST
 
-            offline_user_data_job.customer_match_user_list_metadata.user_list = self.client.get_service("UserListService").user_list_path(
+            offline_user_data_job.customer_match_user_list_metadata.user_list = self.get_service("UserListService").user_list_path(
                 self.customer_id, segment_id
             )
 
@@ -147,6 +256,123 @@ class GoogleAdsSession():
         
         except GoogleAdsException as ex:
             logger.log_text(f"ERROR => Request create_offline_user_data_job_service failed with status: {ex.error.code().name}. Error message: {ex.error}", severity='ERROR') 
+            if _is_not_found(ex):
+                segment_cache.invalidate(self.customer_id, segment_id)
+
+
+    def hash_users(self, users, email_column, phone_column):
+        """
+        Normalizes and hashes the emails and phone numbers of a chunk of users, column by column
+
+        :param self:                        Instance of the class
+        :param users:                       DataFrame with the users
+        :param email_column:                Name of the email column
+        :param phone_column:                Name of the phone number column
+        :return                             HashedIdentifiers of the emails and of the phone numbers
+        """
+        if email_column in users.columns:
+            hashed_emails = identifier_engine.hash_emails(users[email_column])
+        else:
+            hashed_emails = HashedIdentifiers(np.zeros((len(users), DIGEST_SIZE), dtype=np.uint8), np.zeros(len(users), dtype=bool))
+
+        if phone_column in users.columns:
+            hashed_phone_numbers = identifier_engine.hash_phone_numbers(users[phone_column], self.country)
+        else:
+            hashed_phone_numbers = HashedIdentifiers(np.zeros((len(users), DIGEST_SIZE), dtype=np.uint8), np.zeros(len(users), dtype=bool))
+
+        return hashed_emails, hashed_phone_numbers
+
+
+    def hash_identifiers(self, users, email_column, phone_column):
+        """
+        Normalizes and hashes the emails and phone numbers of a chunk of users, column by column
+
+        :param self:                        Instance of the class
+        :param users:                       DataFrame with the users
+        :param email_column:                Name of the email column
+        :param phone_column:                Name of the phone number column
+        :return                             Lists of hex SHA-256 of the emails and phone numbers, None when missing or not valid
+        """
+        hashed_emails, hashed_phone_numbers = self.hash_users(users, email_column, phone_column)
+        return hashed_emails.hex(), hashed_phone_numbers.hex()
+
+
+    def build_operation_requests(self, hashed_emails, hashed_phone_numbers, job_resource_name, remove=False):
+        """
+        Builds the requests to add create or remove operations to a job. The operations are created in place
+        in the repeated fields of the requests, and split so each request stays within the identifiers and
+        bytes allowed by the API
+
+        :param self:                        Instance of the class
+        :param hashed_emails:               Hashed emails, None for the users without email
+        :param hashed_phone_numbers:        Hashed phone numbers, None for the users without phone number
+        :param job_resource_name:           Resource name of the OfflineUserDataJobService to use
+        :param remove:                      True to build remove operations, False to build create operations
+        :return                             List of AddOfflineUserDataJobOperationsRequest
+        """
+        requests = []
+        request = None
+        request_identifiers = 0
+        request_bytes = 0
+
+        for hashed_email, hashed_phone_number in zip(hashed_emails, hashed_phone_numbers):
+            identifiers = []
+            if hashed_email is not None:
+                identifiers.append(("hashed_email", hashed_email))
+            if hashed_phone_number is not None:
+                identifiers.append(("hashed_phone_number", hashed_phone_number))
+            if not identifiers:
+                continue
+
+            operation_bytes = OPERATION_BYTES + IDENTIFIER_BYTES * len(identifiers)
+            if request is None or request_identifiers + len(identifiers) > self.max_identifiers_per_request or request_bytes + operation_bytes > self.max_request_bytes:
+                request = self.client.get_type("AddOfflineUserDataJobOperationsRequest")
+                request.resource_name = job_resource_name
+                request.enable_partial_failure = True
+                requests.append(request)
+                request_identifiers = 0
+                request_bytes = len(job_resource_name) + OPERATION_BYTES
+
+            operation = request.operations.add()
+            user_data = operation.remove if remove else operation.create
+
+            # UserIdentifier is a oneof, each identifier of the user goes in its own UserIdentifier
+            for field, value in identifiers:
+                user_data.user_identifiers.add(**{field: value})
+
+            request_identifiers += len(identifiers)
+            request_bytes += operation_bytes
+
+        return requests
+
+
+    def submit_operation_requests(self, requests, action):
+        """
+        Sends the requests of a job concurrently
+
+        :param self:                        Instance of the class
+        :param requests:                    Requests built by build_operation_requests
+        :param action:                      Name of the action, used in the logs
+        :return                             True if all the requests succeeded
+        """
+        if not requests:
+            return True
+
+        # The service client is thread safe, all the workers share its channel
+        offline_user_data_job_service = self.get_service("OfflineUserDataJobService")
+
+        def submit(request):
+            try:
+                offline_user_data_job_service.add_offline_user_data_job_operations(request)
+                return True
+            except GoogleAdsException as ex:
+                logger.log_text(f"ERROR => Request {action} failed with status: {ex.error.code().name}. Error message: {ex.error}", severity='ERROR') 
+                return False
+
+        with ThreadPoolExecutor(max_workers=min(self.upload_workers, len(requests))) as executor:
+            results = list(executor.map(submit, requests))
+
+        return all(results)
 
 
     def upsert_user_in_segment(self, users_to_add, job_resource_name):
@@ -161,46 +387,10 @@ class GoogleAdsSession():
         
         logger.log_text(f"Upserting users in segment using the job {job_resource_name}")
 
-        try:
-        
-            # Prepare the operations to add users to the user list
-            operations = [] 
-            users_to_add.columns = users_to_add.columns.str.strip()
-            
-            for index, row in users_to_add.iterrows():
-                user_data_job = self.client.get_type("OfflineUserDataJobOperation")
-                user_identifier = self.client.get_type("UserIdentifier")
-                user_data = self.client.get_type("UserData")
-
-                # Set the user identifiers
-                if 'Email' in users_to_add.columns and row['Email'] is not None and row['Email'] != "": 
-                    user_identifier.hashed_email = hashlib.sha256(str(row['Email']).strip().lower().encode('utf-8')).hexdigest()
-
-                if 'PhoneNumber' in users_to_add.columns and row['PhoneNumber'] is not None and str(row['PhoneNumber']) != "":
-                    user_identifier.hashed_phone_number = hashlib.sha256(str(row['PhoneNumber']).replace("'", "").strip().lower().encode('utf-8')).hexdigest()
-    
-                user_data.user_identifiers.append(user_identifier)
-                user_data_job.create.CopyFrom(user_data)
-
-                operations.append(user_data_job)
-
-            add_offline_user_data_job_operations_request = self.client.get_type("AddOfflineUserDataJobOperationsRequest")
-            add_offline_user_data_job_operations_request.resource_name = job_resource_name
-            add_offline_user_data_job_operations_request.operations.extend(operations)
-            add_offline_user_data_job_operations_request.enable_partial_failure = True
-            
-            # Creates the OfflineUserDataJobService client.
-            offline_user_data_job_service = self.client.get_service("OfflineUserDataJobService")
-  
-            offline_user_data_job_service.add_offline_user_data_job_operations(add_offline_user_data_job_operations_request)
+        users_to_add.columns = users_to_add.columns.str.strip()
+        hashed_emails, hashed_phone_numbers = self.hash_identifiers(users_to_add, 'Email', 'PhoneNumber')
 
-            logger.log_text(f"Users have been added to job with ID {job_resource_name}.", severity = "INFO")
-                 
-            return True
-        
-        except GoogleAdsException as ex:
-            logger.log_text(f"ERROR => Request upsert_user_in_segment failed with status: {ex.error.code().name}. Error message: {ex.error}", severity='ERROR') 
-            return False
+        return self.submit_users(hashed_emails, hashed_phone_numbers, job_resource_name)
 
 
     def remove_user_in_segment(self, users_to_remove, job_resource_name):
@@ -214,43 +404,30 @@ class GoogleAdsSession():
         
         logger.log_text(f"Removing users from segment using the job {job_resource_name}")
         
-        try:
+        hashed_emails, hashed_phone_numbers = self.hash_identifiers(users_to_remove, 'email', 'phone_number')
 
-            operations = []
-            for index, row in users_to_remove.iterrows():
-                user_data_job = self.client.get_type("OfflineUserDataJobOperation")
-                user_identifier = self.client.get_type("UserIdentifier")
-                user_data = self.client.get_type("UserData")
-                    
-                # Set the user identifiers
-                if row['email'] is not None and str(row['email']) != "": 
-                    user_identifier.hashed_email = hashlib.sha256(str(row['email']).strip().lower().encode('utf-8')).hexdigest()
-
-                if row['phone_number'] is not None and str(row['phone_number']) != "":
-                    user_identifier.hashed_phone_number = hashlib.sha256(str(row['phone_number']).replace("'", "").strip().lower().encode('utf-8')).hexdigest()
-    
-                user_data.user_identifiers.append(user_identifier)
-                user_data_job.remove.CopyFrom(user_data)
+        return self.submit_users(hashed_emails, hashed_phone_numbers, job_resource_name, remove=True)
 
-                operations.append(user_data_job)
 
-            add_offline_user_data_job_operations_request = self.client.get_type("AddOfflineUserDataJobOperationsRequest")
-            add_offline_user_data_job_operations_request.resource_name = job_resource_name
-            add_offline_user_data_job_operations_request.operations.extend(operations)
-            add_offline_user_data_job_operations_request.enable_partial_failure = True
-            
-            # Creates the OfflineUserDataJobService client.
-            offline_user_data_job_service = self.client.get_service("OfflineUserDataJobService")
-  
-            offline_user_data_job_service.add_offline_user_data_job_operations(add_offline_user_data_job_operations_request)
+    def submit_users(self, hashed_emails, hashed_phone_numbers, job_resource_name, remove=False):
+        """
+        Adds the operations of already hashed users to a job
 
-            logger.log_text(f"Users have been added to job with ID {job_resource_name}.", severity = "INFO")
-            
-            return True
-        
-        except GoogleAdsException as ex:
-            logger.log_text(f"ERROR => Request remove_user_in_segment failed with status: {ex.error.code().name}. Error message: {ex.error}", severity='ERROR') 
-            return False
+        :param self:                        Instance of the class
+        :param hashed_emails:               Hex hashed emails, None for the users without email
+        :param hashed_phone_numbers:        Hex hashed phone numbers, None for the users without phone number
+        :param job_resource_name:           Resource name of the OfflineUserDataJobService to use
+        :param remove:                      True to remove the users, False to add them
+        :return                             True if all the requests succeeded
+        """
+        action = "remove_user_in_segment" if remove else "upsert_user_in_segment"
+        requests = self.build_operation_requests(hashed_emails, hashed_phone_numbers, job_resource_name, remove=remove)
+        success = self.submit_operation_requests(requests, action)
+
+        if success:
+            logger.log_text(f"Users have been {'removed from' if remove else 'added to'} job with ID {job_resource_name} in {len(requests)} requests.", severity = "INFO")
+
+        return success
 
 
     def run_offline_user_data_job(self, job_resource_name):
@@ -264,8 +441,28 @@ class GoogleAdsSession():
         run_request = self.client.get_type("RunOfflineUserDataJobRequest")
         run_request.resource_name = job_resource_name
 
-        offline_user_data_job_service = self.client.get_service("OfflineUserDataJobService")
+        offline_user_data_job_service = self.get_service("OfflineUserDataJobService")
         offline_user_data_job_service.run_offline_user_data_job(run_request)
 
         logger.log_text(f"Job with ID {job_resource_name} running", severity = "INFO")
         
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_google_ads_session(brand, country):
+    """
+    Returns the process-wide session of a Google Ads account. The sessions are created on first use
+    and reused by all the requests, with their service clients
+
+    :param brand:                   Brand of the account (CLZ, INT...)
+    :param country:                 Country of the account (ES, FR...)
+    :return                         GoogleAdsSession, raises if the brand and country have no account
+    """
+    with _sessions_lock:
+        key = (brand, country)
+        if key not in _sessions:
+            _sessions[key] = GoogleAdsSession(brand, country)
+        return _sessions[key]
@@ -0,0 +1,304 @@
+# Import libs
+import hashlib
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+# Country calling codes used to convert national phone numbers to E.164
+COUNTRY_CALLING_CODES = {
+    "AT": "43", "BE": "32", "BR": "55", "CA": "1", "CH": "41", "CZ": "420", "DE": "49", "DK": "45",
+    "ES": "34", "FI": "358", "FR": "33", "GB": "44", "GR": "30", "HU": "36", "IE": "353", "IT": "39",
+    "JP": "81", "MX": "52", "NL": "31", "NO": "47", "PL": "48", "PT": "351", "RO": "40", "SE": "46",
+    "SK": "421", "UA": "380", "UK": "44", "US": "1"
+}
+
+# Countries whose national numbers keep the leading 0 after the country code
+COUNTRIES_KEEPING_TRUNK_PREFIX = {"IT"}
+
+DIGEST_SIZE = 32
+
+
+# Processes of the hashing pool when they are not configured, each one takes memory of the instance
+MAX_DEFAULT_POOL_WORKERS = 4
+
+
+def available_cpus():
+    """
+    CPUs the process can use: the CPUs it is allowed to run on, limited by the CPU quota of its
+    cgroup (the CPU limit of the container), which os.cpu_count() ignores
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+
+    # cgroup v2 (cpu.max: "<quota> <period>") and cgroup v1 (cfs_quota_us, cfs_period_us)
+    quota_files = [("/sys/fs/cgroup/cpu.max", None), ("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us")]
+    for quota_path, period_path in quota_files:
+        try:
+            with open(quota_path) as quota_file:
+                values = quota_file.read().split()
+            if period_path is not None:
+                with open(period_path) as period_file:
+                    values.append(period_file.read().strip())
+        except (OSError, ValueError):
+            continue
+        if len(values) >= 2 and values[0] not in ("max", "-1"):
+            cpus = min(cpus, max(1, int(int(values[0]) / int(values[1]))))
+        break
+
+    return max(1, cpus)
+
+
+def _sha256_block(values):
+    # Runs in the pool workers, returns the digests concatenated to keep the IPC small
+    return b"".join(hashlib.sha256(value.encode("utf-8")).digest() for value in values)
+
+
+def _to_arrow_strings(values):
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        values = values.cast(pa.string())
+        return values.combine_chunks() if isinstance(values, pa.ChunkedArray) else values
+
+    try:
+        # Pandas Series, numpy arrays and lists of strings, None and NaN are converted to nulls.
+        # Series of string[pyarrow] (csv_ingest) give their Arrow chunks without copying them
+        values = pa.array(values, type=pa.string(), from_pandas=True)
+        return values.combine_chunks() if isinstance(values, pa.ChunkedArray) else values
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Anything that is not a string is treated as missing
+        values = values.tolist() if hasattr(values, "tolist") else list(values)
+        return pa.array([value if isinstance(value, str) else None for value in values], type=pa.string())
+
+
+def _mask_to_numpy(mask):
+    if isinstance(mask, pa.ChunkedArray):
+        mask = mask.combine_chunks()
+    return pc.fill_null(mask, False).to_numpy(zero_copy_only=False)
+
+
+def normalize_emails(values):
+    """
+    Normalizes a column of emails with the rules of utils.normalize_email: trim, lowercase,
+    remove the characters not allowed in the local and domain parts, collapse consecutive dots
+    in the local part and trim the dots of both parts
+
+    :param values:                  Emails as a pandas Series, list or Arrow array
+    :return                         (Arrow array of normalized emails, numpy mask of the valid ones)
+    """
+    emails = pc.utf8_lower(pc.utf8_trim_whitespace(_to_arrow_strings(values)))
+
+    # Only values with exactly one @ can be split in local and domain parts
+    is_splittable = pc.equal(pc.count_substring(emails, "@"), 1)
+    parts = pc.extract_regex(pc.if_else(is_splittable, emails, None), r"^(?P<local>[^@]*)@(?P<domain>.*)$")
+    local_part = pc.struct_field(parts, [0])
+    domain_part = pc.struct_field(parts, [1])
+
+    local_part = pc.replace_substring_regex(local_part, r"[^a-zA-Z0-9.!#$%&'*+/=?^_`{|}~-]", "")
+    domain_part = pc.replace_substring_regex(domain_part, r"[^a-zA-Z0-9.-]", "")
+    local_part = pc.utf8_trim(pc.replace_substring_regex(local_part, r"\.\.+", "."), ".")
+    domain_part = pc.utf8_trim(domain_part, ".")
+
+    normalized = pc.binary_join_element_wise(local_part, "@", domain_part, "")
+    valid = pc.and_(pc.greater(pc.utf8_length(local_part), 0), pc.greater(pc.utf8_length(domain_part), 0))
+
+    return normalized, _mask_to_numpy(valid)
+
+
+def normalize_phone_numbers(values, country=None):
+    """
+    Normalizes a column of phone numbers to E.164 (+<country code><number>). Numbers without
+    international prefix (+ or 00) are completed with the calling code of the country
+
+    :param values:                  Phone numbers as a pandas Series, list or Arrow array
+    :param country:                 Country of the numbers without international prefix (ES, FR...)
+    :return                         (Arrow array of normalized numbers, numpy mask of the valid ones)
+    """
+    phones = pc.utf8_trim_whitespace(_to_arrow_strings(values))
+    # Keep the digits and the + (numbers come as '+34 600-00-00-00, (600) 000 000...)
+    phones = pc.replace_substring_regex(phones, r"[^0-9+]", "")
+    phones = pc.replace_substring_regex(phones, r"^00", "+")
+
+    is_international = pc.starts_with(phones, "+")
+    digits = pc.replace_substring_regex(phones, r"[^0-9]", "")
+
+    calling_code = COUNTRY_CALLING_CODES.get((country or "").upper())
+    if calling_code is None:
+        national = pa.nulls(len(digits), type=pa.string())
+    else:
+        if country.upper() not in COUNTRIES_KEEPING_TRUNK_PREFIX:
+            digits_national = pc.replace_substring_regex(digits, r"^0", "")
+        else:
+            digits_national = digits
+        national = pc.binary_join_element_wise(f"+{calling_code}", digits_national, "")
+
+    normalized = pc.if_else(is_international, pc.binary_join_element_wise("+", digits, ""), national)
+    valid = pc.match_substring_regex(normalized, r"^\+[1-9][0-9]{7,14}$")
+
+    return normalized, _mask_to_numpy(valid)
+
+
+class HashedIdentifiers():
+    """
+    SHA-256 digests of a column of identifiers, as a (rows, 32) uint8 array and a mask of the
+    rows that had a valid identifier. Invalid rows have a zero digest
+    """
+    def __init__(self, digests, valid):
+        self.digests = digests
+        self.valid = valid
+
+    def __len__(self):
+        return len(self.valid)
+
+    def hex(self):
+        """
+        Returns the digests as hex strings, the format the Google Ads API expects
+
+        :return                     List with a hex string per row, None for the invalid rows
+        """
+        hex_digests = np.frombuffer(self.digests.tobytes().hex().encode("ascii"), dtype=f"S{DIGEST_SIZE * 2}")
+        hex_digests = hex_digests.astype(object)
+        hex_digests[~self.valid] = None
+        return [None if value is None else value.decode("ascii") for value in hex_digests]
+
+
+class IdentifierEngine():
+    """
+    Normalizes and hashes whole columns of identifiers for Customer Match.
+
+    Large batches are hashed on a process pool. The digests of the identifiers already seen can be
+    kept in an LRU cache, so audiences sent every day are only sent to the pool once per instance.
+    """
+    def __init__(self, cache_size=0, pool_min_rows=200000, pool_workers=None):
+        """
+        :param cache_size:          Digests kept in the cache, 0 disables it. A lookup costs about
+                                    the same as hashing in-process, it pays off when the pool is used
+        :param pool_min_rows:       Identifiers to hash from which the process pool is used
+        :param pool_workers:        Processes of the pool, defaults to the CPUs of the container (at most
+                                    MAX_DEFAULT_POOL_WORKERS). 1 disables the pool
+        """
+        self.cache_size = cache_size
+        self.pool_min_rows = pool_min_rows
+        self.pool_workers = pool_workers if pool_workers is not None else min(available_cpus(), MAX_DEFAULT_POOL_WORKERS)
+        self.hits = 0
+        self.misses = 0
+        self.__cache = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__pool = None
+
+    def __get_pool(self):
+        with self.__lock:
+            if self.__pool is None:
+                # forkserver, forking a process with running threads is not safe
+                self.__pool = ProcessPoolExecutor(max_workers=self.pool_workers, mp_context=multiprocessing.get_context("forkserver"))
+            return self.__pool
+
+    def __sha256(self, values):
+        if self.pool_workers > 1 and len(values) >= self.pool_min_rows:
+            block_size = -(-len(values) // (self.pool_workers * 4))
+            blocks = [values[i:i + block_size] for i in range(0, len(values), block_size)]
+            return b"".join(self.__get_pool().map(_sha256_block, blocks))
+
+        return _sha256_block(values)
+
+    def hash(self, normalized, valid):
+        """
+        Hashes normalized identifiers with SHA-256
+
+        :param normalized:          Arrow array or list of normalized identifiers
+        :param valid:               numpy mask of the identifiers to hash
+        :return                     HashedIdentifiers
+        """
+        if isinstance(normalized, (pa.Array, pa.ChunkedArray)):
+            values = normalized.to_numpy(zero_copy_only=False)
+        else:
+            values = np.asarray(normalized, dtype=object)
+        digests = np.zeros((len(values), DIGEST_SIZE), dtype=np.uint8)
+        rows = np.flatnonzero(valid)
+
+        if self.cache_size > 0:
+            # Look up the cache, only the identifiers never seen are hashed
+            missing_rows = []
+            missing_values = []
+            with self.__lock:
+                for row, value in zip(rows.tolist(), values[rows].tolist()):
+                    digest = self.__cache.get(value)
+                    if digest is None:
+                        missing_rows.append(row)
+                        missing_values.append(value)
+                    else:
+                        self.__cache.move_to_end(value)
+                        digests[row] = np.frombuffer(digest, dtype=np.uint8)
+        else:
+            missing_rows = rows
+            missing_values = values[rows].tolist()
+
+        with self.__lock:
+            self.hits += len(rows) - len(missing_rows)
+            self.misses += len(missing_rows)
+
+        if missing_values:
+            new_digests = np.frombuffer(self.__sha256(missing_values), dtype=np.uint8).reshape(-1, DIGEST_SIZE)
+            digests[missing_rows] = new_digests
+
+            if self.cache_size > 0:
+                with self.__lock:
+                    # Only the most recent identifiers fit when the batch is bigger than the cache
+                    for value, digest in zip(missing_values[-self.cache_size:], new_digests[-self.cache_size:]):
+                        self.__cache[value] = digest.tobytes()
+                    while len(self.__cache) > self.cache_size:
+                        self.__cache.popitem(last=False)
+
+        return HashedIdentifiers(digests, valid)
+
+    def hash_emails(self, values):
+        """
+        Normalizes and hashes a column of emails
+
+        :param values:              Emails as a pandas Series, list or Arrow array
+        :return                     HashedIdentifiers
+        """
+        return self.hash(*normalize_emails(values))
+
+    def hash_phone_numbers(self, values, country=None):
+        """
+        Normalizes to E.164 and hashes a column of phone numbers
+
+        :param values:              Phone numbers as a pandas Series, list or Arrow array
+        :param country:             Country of the numbers without international prefix
+        :return                     HashedIdentifiers
+        """
+        return self.hash(*normalize_phone_numbers(values, country))
+
+    def stats(self):
+        """
+        Returns the cache counters
+        """
+        with self.__lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "cached": len(self.__cache),
+                "cache_size": self.cache_size,
+                "pool_workers": self.pool_workers
+            }
+
+
+def new_identifier_engine():
+    """
+    Creates an engine configured from the env variables
+    """
+    pool_workers = os.environ.get("hash_pool_workers")
+    return IdentifierEngine(
+        cache_size = int(os.environ.get("hash_cache_size", "0")),
+        pool_min_rows = int(os.environ.get("hash_pool_min_rows", "200000")),
+        pool_workers = int(pool_workers) if pool_workers else None
+    )
+
+
+# Engine shared by all the requests of the instance
+identifier_engine = new_identifier_engine()
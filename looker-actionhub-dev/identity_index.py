@@ -0,0 +1,384 @@
+# Import libs
+import hashlib
+import json
+import os
+import shutil
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from bq_reader import read_query
+from clients import get_bigquery_client, get_logger
+from freshness import freshness_gate
+
+
+logger = get_logger('looker-actionhub')
+
+# Keys are the SHA-256 of the customer code, handled as 4 uint64 words
+KEY_WORDS = 4
+EMPTY_SLOT = -1
+
+
+def customer_keys(customer_codes):
+    """
+    Computes the keys of a list of customer codes, the same value M_MEDIA_KNOWN_IDENTITY holds in base64
+
+    :param customer_codes:          Iterable of customer codes (converted to string)
+    :return                         (n, 4) uint64 array
+    """
+    digests = b"".join(hashlib.sha256(str(customer_code).encode("utf-8")).digest() for customer_code in customer_codes)
+    return np.frombuffer(digests, dtype=np.uint64).reshape(-1, KEY_WORDS)
+
+
+def _binary_keys(digests):
+    # The values of a binary array of 32-byte digests are contiguous in its data buffer
+    offsets = np.frombuffer(digests.buffers()[1], dtype=np.int32, count=len(digests) + 1, offset=digests.offset * 4)
+    data = np.frombuffer(digests.buffers()[2], dtype=np.uint8) if len(digests) else np.zeros(0, dtype=np.uint8)
+    return np.ascontiguousarray(data[offsets[0]:offsets[-1]]).view(np.uint64).reshape(-1, KEY_WORDS)
+
+
+def _build_slots(keys):
+    # Open addressing with linear probing, load factor <= 0.5
+    capacity = 1 << max(int(2 * len(keys) - 1).bit_length(), 4)
+    mask = np.uint64(capacity - 1)
+    slots = np.full(capacity, EMPTY_SLOT, dtype=np.int64)
+
+    pending = np.arange(len(keys), dtype=np.int64)
+    positions = (keys[:, 0] & mask).astype(np.int64)
+    while pending.size:
+        is_free = slots[positions[pending]] == EMPTY_SLOT
+        candidates = pending[is_free]
+        # Several keys may want the same free slot, the first one takes it
+        taken_positions, first = np.unique(positions[candidates], return_index=True)
+        slots[taken_positions] = candidates[first]
+
+        placed = np.zeros(len(keys), dtype=bool)
+        placed[candidates[first]] = True
+        pending = pending[~placed[pending]]
+        positions[pending] = (positions[pending] + 1) & (capacity - 1)
+
+    return slots
+
+
+class IdentityIndex():
+    """
+    Read-only index of customer key -> Adform EXTERNAL_CODEs, memory-mapped from a directory.
+
+    The keys are unique and sorted, each one has a range of external code ids (CSR layout). An open
+    addressing table over the keys resolves a whole column of customers with a few vectorized probes.
+    """
+    def __init__(self, path):
+        """
+        :param path:                Directory written by build_identity_index
+        """
+        self.path = path
+        with open(os.path.join(path, "metadata.json")) as metadata_file:
+            self.metadata = json.load(metadata_file)
+        self.keys = np.load(os.path.join(path, "keys.npy"), mmap_mode="r")
+        self.starts = np.load(os.path.join(path, "starts.npy"), mmap_mode="r")
+        self.pair_codes = np.load(os.path.join(path, "pair_codes.npy"), mmap_mode="r")
+        self.slots = np.load(os.path.join(path, "slots.npy"), mmap_mode="r")
+        code_offsets = np.load(os.path.join(path, "code_offsets.npy"), mmap_mode="r")
+        code_data = np.memmap(os.path.join(path, "codes.bin"), dtype=np.uint8, mode="r") if self.metadata["code_bytes"] > 0 else np.zeros(0, dtype=np.uint8)
+        self.codes = pa.LargeStringArray.from_buffers(len(code_offsets) - 1, pa.py_buffer(code_offsets), pa.py_buffer(code_data))
+
+    def find(self, keys):
+        """
+        Finds the position of each key in the index
+
+        :param keys:                (n, 4) uint64 array
+        :return                     Array with the position of each key, -1 if it is not in the index
+        """
+        positions = np.full(len(keys), EMPTY_SLOT, dtype=np.int64)
+        if len(self.keys) == 0:
+            return positions
+
+        mask = len(self.slots) - 1
+        probes = (keys[:, 0] & np.uint64(mask)).astype(np.int64)
+        pending = np.arange(len(keys), dtype=np.int64)
+        while pending.size:
+            candidates = self.slots[probes[pending]]
+            is_empty = candidates == EMPTY_SLOT
+            is_match = ~is_empty & (self.keys[np.maximum(candidates, 0)] == keys[pending]).all(axis=1)
+            positions[pending[is_match]] = candidates[is_match]
+
+            pending = pending[~is_empty & ~is_match]
+            probes[pending] = (probes[pending] + 1) & mask
+
+        return positions
+
+    def lookup_code_ids(self, customer_codes):
+        """
+        Resolves a column of customer codes to the ids of their external codes
+
+        :param customer_codes:      Iterable of customer codes
+        :return                     Array of external code ids, with repetitions
+        """
+        positions = self.find(customer_keys(customer_codes))
+        positions = positions[positions >= 0]
+        if positions.size == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        # Expand the range of codes of each key
+        starts = self.starts[positions]
+        lengths = self.starts[positions + 1] - starts
+        pair_ids = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return self.pair_codes[pair_ids].astype(np.int64)
+
+    def external_codes(self, code_ids):
+        """
+        Returns the external codes of a list of ids as an Arrow array
+        """
+        return self.codes.take(pa.array(code_ids, type=pa.int64()))
+
+
+def _write_index(path, keys, code_ids, codes, metadata):
+    """
+    Writes the files of an index from its pairs (customer key, external code id)
+    """
+    os.makedirs(path, exist_ok=True)
+
+    # Sort the pairs by key, drop the repeated ones and group the codes of each key
+    order = np.lexsort(tuple(keys[:, word] for word in reversed(range(KEY_WORDS))))
+    keys = keys[order]
+    code_ids = code_ids[order].astype(np.int64)
+    is_new_key = np.ones(len(keys), dtype=bool)
+    is_new_key[1:] = (keys[1:] != keys[:-1]).any(axis=1)
+    key_ids = np.cumsum(is_new_key) - 1
+    unique_keys = np.ascontiguousarray(keys[is_new_key])
+
+    pairs = np.unique(key_ids * max(len(codes), 1) + code_ids)
+    pair_keys = pairs // max(len(codes), 1)
+    pair_codes = (pairs % max(len(codes), 1)).astype(np.int32)
+    starts = np.searchsorted(pair_keys, np.arange(len(unique_keys) + 1))
+
+    codes = codes.cast(pa.large_string())
+    offsets = np.frombuffer(codes.buffers()[1], dtype=np.int64, count=len(codes) + 1, offset=codes.offset * 8)
+    data = codes.buffers()[2]
+    code_bytes = int(offsets[-1] - offsets[0]) if len(codes) else 0
+
+    np.save(os.path.join(path, "keys.npy"), unique_keys)
+    np.save(os.path.join(path, "starts.npy"), starts.astype(np.int64))
+    np.save(os.path.join(path, "pair_codes.npy"), pair_codes)
+    np.save(os.path.join(path, "slots.npy"), _build_slots(unique_keys))
+    np.save(os.path.join(path, "code_offsets.npy"), (offsets - offsets[0]) if len(codes) else np.zeros(1, dtype=np.int64))
+    with open(os.path.join(path, "codes.bin"), "wb") as codes_file:
+        if code_bytes > 0:
+            codes_file.write(memoryview(data)[int(offsets[0]):int(offsets[-1])])
+
+    metadata = {**metadata, "customers": int(len(unique_keys)), "pairs": int(len(pairs)), "codes": int(len(codes)), "code_bytes": code_bytes}
+    with open(os.path.join(path, "metadata.json"), "w") as metadata_file:
+        json.dump(metadata, metadata_file)
+
+
+class IdentityIndexManager():
+    """
+    Keeps the identity index of each environment in sync with M_MEDIA_KNOWN_IDENTITY.
+
+    The index of a day is built in the background once the freshness gate reports the activation layer
+    as updated. Until it is ready the callers fall back to the BigQuery join. With <delta_column> the
+    rebuilds only read the customers changed since the previous one, whose pairs replace the ones of
+    the current index. Deleted rows are not in the delta: when the pairs of the merged index do not
+    match the ones of the table the index is rebuilt from the whole table.
+    """
+    def __init__(self, directory, delta_column="", full_rebuild_days=7):
+        """
+        :param directory:           Local directory of the indexes (the volume must fit them)
+        :param delta_column:        TIMESTAMP column of M_MEDIA_KNOWN_IDENTITY with the last change of each row
+        :param full_rebuild_days:   Days after which the index is rebuilt from the whole table
+        """
+        self.directory = directory
+        self.delta_column = delta_column
+        self.full_rebuild_days = full_rebuild_days
+        self.builds = 0
+        self.errors = 0
+        self.__indexes = {}
+        self.__building = set()
+        self.__lock = threading.Lock()
+
+    def __table(self, prefix_project, prefix_dataset):
+        return f"`{prefix_project}cross-cloud4marketing.{prefix_dataset}clz_c4m_normalized.M_MEDIA_KNOWN_IDENTITY`"
+
+    def __query(self, prefix_project, prefix_dataset, changed_since=None):
+        table = self.__table(prefix_project, prefix_dataset)
+        where = "WHERE EXTERNAL_CODE IS NOT NULL AND CUSTOMER_CODE IS NOT NULL"
+        if changed_since is not None:
+            # All the current rows of the customers with a change, so their remapped codes replace the
+            # ones in the index. Margin for the rows written while the previous build was running
+            where += f"""
+                AND CUSTOMER_CODE IN (
+                    SELECT CUSTOMER_CODE FROM {table}
+                    WHERE {self.delta_column} >= TIMESTAMP_SUB(TIMESTAMP('{changed_since}'), INTERVAL 1 HOUR)
+                )"""
+
+        return f"""
+            SELECT
+                FROM_BASE64(CUSTOMER_CODE) AS CUSTOMER_KEY,
+                EXTERNAL_CODE
+            FROM {table}
+            {where}
+        """
+
+    def __count_pairs(self, prefix_project, prefix_dataset):
+        # Pairs the index must have, the rows deleted from the table are not in the delta of the changes
+        rows = get_bigquery_client().query(f"""
+            SELECT COUNT(*) AS PAIRS
+            FROM (
+                SELECT DISTINCT CUSTOMER_CODE, EXTERNAL_CODE
+                FROM {self.__table(prefix_project, prefix_dataset)}
+                WHERE EXTERNAL_CODE IS NOT NULL AND CUSTOMER_CODE IS NOT NULL
+                    AND BYTE_LENGTH(FROM_BASE64(CUSTOMER_CODE)) = 32
+            )
+        """).result()
+        return next(iter(rows))["PAIRS"]
+
+    def __read_pairs(self, prefix_project, prefix_dataset, changed_since=None):
+        reader = read_query(self.__query(prefix_project, prefix_dataset, changed_since))
+
+        key_batches = []
+        code_batches = []
+        for batch in reader.iter_batches():
+            # Customer codes that are not a base64 SHA-256 can never match, they are dropped
+            batch = batch.filter(pc.equal(pc.binary_length(batch.column(0)), 32))
+            key_batches.append(_binary_keys(batch.column(0)))
+            code_batches.append(batch.column(1).cast(pa.large_string()))
+
+        keys = np.concatenate(key_batches) if key_batches else np.zeros((0, KEY_WORDS), dtype=np.uint64)
+        codes = pa.chunked_array(code_batches, type=pa.large_string()).combine_chunks() if code_batches else pa.array([], type=pa.large_string())
+        return keys, codes
+
+    def __merge(self, previous, changed_keys, changed_codes):
+        """
+        Pairs of the previous index without the customers that changed, followed by their current pairs.
+        The codes of the previous index keep their ids, the new ones are appended to its dictionary
+        """
+        is_kept = np.ones(len(previous.keys), dtype=bool)
+        positions = previous.find(changed_keys)
+        is_kept[positions[positions >= 0]] = False
+
+        key_ids = np.repeat(np.arange(len(previous.keys)), np.diff(np.asarray(previous.starts)))
+        is_pair_kept = is_kept[key_ids]
+        keys = np.concatenate([np.asarray(previous.keys)[key_ids[is_pair_kept]], changed_keys])
+        del key_ids
+
+        # Codes already in the dictionary keep their id, only the new ones are added to it
+        code_ids = pc.index_in(changed_codes, value_set=previous.codes)
+        is_new_code = pc.is_null(code_ids)
+        new_codes = changed_codes.filter(is_new_code).dictionary_encode()
+        new_code_ids = new_codes.indices.to_numpy(zero_copy_only=False).astype(np.int64) + len(previous.codes)
+        changed_code_ids = pc.fill_null(code_ids, -1).to_numpy(zero_copy_only=False).astype(np.int64)
+        changed_code_ids[is_new_code.to_numpy(zero_copy_only=False)] = new_code_ids
+
+        code_ids = np.concatenate([np.asarray(previous.pair_codes)[is_pair_kept].astype(np.int64), changed_code_ids])
+        codes = pa.concat_arrays([previous.codes, new_codes.dictionary.cast(pa.large_string())])
+        return keys, code_ids, codes
+
+    def __build(self, prefix_project, prefix_dataset, date_last_update, force_full=False):
+        env = f"{prefix_project}{prefix_dataset}".strip("-_") or "default"
+        started_at = datetime.utcnow().replace(microsecond=0)
+        try:
+            previous = self.__indexes.get((prefix_project, prefix_dataset))
+            is_delta = (
+                not force_full and previous is not None and self.delta_column != ""
+                and started_at - datetime.fromisoformat(previous.metadata["full_build_at"]) < timedelta(days=self.full_rebuild_days)
+            )
+
+            if is_delta:
+                changed_keys, changed_codes = self.__read_pairs(prefix_project, prefix_dataset, previous.metadata["built_at"])
+                keys, code_ids, codes = self.__merge(previous, changed_keys, changed_codes)
+                del changed_keys, changed_codes
+            else:
+                keys, codes = self.__read_pairs(prefix_project, prefix_dataset)
+                encoded = codes.dictionary_encode()
+                code_ids = encoded.indices.to_numpy(zero_copy_only=False)
+                codes = encoded.dictionary
+
+            path = os.path.join(self.directory, env, f"{date_last_update}_{started_at.strftime('%H%M%S')}")
+            _write_index(path, keys, code_ids, codes, {
+                "date_last_update": date_last_update,
+                "built_at": started_at.isoformat(),
+                "full_build_at": previous.metadata["full_build_at"] if is_delta else started_at.isoformat(),
+                "delta": is_delta
+            })
+            del keys, code_ids, codes
+            index = IdentityIndex(path)
+
+            if is_delta and index.metadata["pairs"] != self.__count_pairs(prefix_project, prefix_dataset):
+                # Rows were deleted from the table, only a full build removes them from the index
+                logger.log_text(f"Identity index {date_last_update} delta does not match M_MEDIA_KNOWN_IDENTITY, rebuilding it from the whole table", severity='INFO')
+                shutil.rmtree(path, ignore_errors=True)
+                self.__build(prefix_project, prefix_dataset, date_last_update, force_full=True)
+                return
+
+            with self.__lock:
+                self.__indexes[(prefix_project, prefix_dataset)] = index
+                self.builds += 1
+
+            # Older versions are removed, the files stay readable for the lookups still using them
+            for name in os.listdir(os.path.dirname(path)):
+                if os.path.join(os.path.dirname(path), name) != path:
+                    shutil.rmtree(os.path.join(os.path.dirname(path), name), ignore_errors=True)
+
+            logger.log_text(f"Identity index {date_last_update} built ({'delta' if is_delta else 'full'}): {index.metadata['customers']} customers, {index.metadata['codes']} external codes", severity='INFO')
+
+        except Exception as e:
+            with self.__lock:
+                self.errors += 1
+            logger.log_text(f"ERROR => Identity index build failed: {str(e)}", severity='ERROR')
+
+        finally:
+            with self.__lock:
+                self.__building.discard((prefix_project, prefix_dataset))
+
+    def get(self, prefix_project, prefix_dataset):
+        """
+        Returns the index built from the last update of the activation layer. If it is not built yet a build is
+        started in the background and None is returned
+
+        :param prefix_project:      Project prefix. Depends on the environment (dev, test, prod)
+        :param prefix_dataset:      Dataset prefix. Depends on the environment
+        :return                     IdentityIndex, None if it is not ready
+        """
+        is_updated, date_last_update, _ = freshness_gate.check(prefix_project, prefix_dataset)
+        key = (prefix_project, prefix_dataset)
+
+        with self.__lock:
+            index = self.__indexes.get(key)
+            if index is not None and index.metadata["date_last_update"] == date_last_update:
+                return index
+
+            # Only built from an updated activation layer, and once at a time
+            if is_updated and key not in self.__building:
+                self.__building.add(key)
+                threading.Thread(target=self.__build, args=(prefix_project, prefix_dataset, date_last_update), name="identity-index", daemon=True).start()
+
+        return None
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "builds": self.builds,
+                "errors": self.errors,
+                "building": len(self.__building),
+                "indexes": {f"{key[0]}{key[1]}": index.metadata for key, index in self.__indexes.items()}
+            }
+
+
+def new_identity_index_manager():
+    """
+    Creates the manager configured from the env variables, None if the index is disabled
+    """
+    if os.environ.get("identity_index_enabled", "false").lower() != "true":
+        return None
+
+    return IdentityIndexManager(
+        os.environ.get("identity_index_dir", "/tmp/identity_index"),
+        delta_column = os.environ.get("identity_index_delta_column", ""),
+        full_rebuild_days = int(os.environ.get("identity_index_full_rebuild_days", "7"))
+    )
+
+
+identity_index_manager = new_identity_index_manager()
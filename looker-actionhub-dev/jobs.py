@@ -0,0 +1,173 @@
+# Import libs
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from clients import get_logger
+from metrics import current_trace
+
+
+logger = get_logger('looker-actionhub')
+
+# Job being executed by the current worker thread, used to report the progress from inside the actions
+_current = threading.local()
+
+
+class Job():
+    """
+    Execution of an action in the background, with its progress and outcome
+    """
+    def __init__(self, action):
+        self.id = uuid.uuid4().hex
+        self.action = action
+        self.status = "queued"
+        self.stage = "queued"
+        self.rows_processed = 0
+        self.success = None
+        self.message = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        """
+        Returns the public representation of the job
+        """
+        return {
+            "id": self.id,
+            "action": self.action,
+            "status": self.status,
+            "stage": self.stage,
+            "rows_processed": self.rows_processed,
+            "success": self.success,
+            "message": self.message,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+class JobManager():
+    """
+    Runs actions on a bounded pool of worker threads and keeps their status in memory.
+
+    The status of a job is only known by the instance that runs it.
+    """
+    def __init__(self, max_workers=2, max_queued=20, retention_seconds=86400):
+        """
+        :param max_workers:         Number of actions executed at the same time
+        :param max_queued:          Number of jobs allowed to wait for a free worker, new jobs are rejected beyond that
+        :param retention_seconds:   Seconds the finished jobs are kept to be queried
+        """
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.retention_seconds = retention_seconds
+        self.__lock = threading.Lock()
+        self.__jobs = {}
+        self.__pending = 0
+        self.__executor = None
+
+    def __evict(self):
+        limit = time.time() - self.retention_seconds
+        for job_id in [job.id for job in self.__jobs.values() if job.finished_at is not None and job.finished_at < limit]:
+            del self.__jobs[job_id]
+
+    def submit(self, action, function, request_json):
+        """
+        Enqueues the execution of an action
+
+        :param action:              Name of the action (sftp_upload, adform_upload...)
+        :param function:            Function running the action, receives the Looker request and returns the Looker response
+        :param request_json:        Request sent by Looker
+        :return                     The Job created, None if the queue is full
+        """
+        with self.__lock:
+            if self.__pending >= self.max_workers + self.max_queued:
+                return None
+
+            if self.__executor is None:
+                self.__executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="action-worker")
+
+            self.__evict()
+            job = Job(action)
+            self.__jobs[job.id] = job
+            self.__pending += 1
+
+        self.__executor.submit(self.__run, job, function, request_json)
+        logger.log_text(f"Job {job.id} queued for action {action}", severity='INFO')
+
+        return job
+
+    def __run(self, job, function, request_json):
+        _current.job = job
+        job.status = "running"
+        job.stage = "started"
+        job.started_at = time.time()
+
+        try:
+            response = function(request_json)
+            job.success = response["looker"]["success"]
+            job.message = response["looker"].get("message")
+            job.status = "succeeded" if job.success else "failed"
+
+        except Exception as e:
+            job.success = False
+            job.message = str(e)
+            job.status = "failed"
+            logger.log_text(f"ERROR => Job {job.id} failed: {traceback.format_exc()}", severity='ERROR')
+
+        finally:
+            job.stage = "finished"
+            job.finished_at = time.time()
+            _current.job = None
+            with self.__lock:
+                self.__pending -= 1
+
+        logger.log_text(f"Job {job.id} {job.status} after {job.finished_at - job.started_at:.1f}s, {job.rows_processed} rows processed", severity='INFO')
+
+    def get(self, job_id):
+        """
+        Returns a job by its id
+
+        :param job_id:              Id returned when the job was submitted
+        :return                     The Job, None if it does not exist or was evicted
+        """
+        with self.__lock:
+            return self.__jobs.get(job_id)
+
+
+def report_stage(stage):
+    """
+    Reports the stage the current action is in, to its background job and to its trace
+    """
+    job = getattr(_current, "job", None)
+    if job is not None:
+        job.stage = stage
+
+    trace = current_trace()
+    if trace is not None:
+        trace.start_stage(stage)
+
+
+def report_rows(rows):
+    """
+    Adds rows to the rows processed by the current action and its current stage
+    """
+    job = getattr(_current, "job", None)
+    if job is not None:
+        job.rows_processed += rows
+
+    trace = current_trace()
+    if trace is not None:
+        trace.current.rows += rows
+
+
+def report_bytes(size):
+    """
+    Adds bytes to the bytes transferred by the current stage of the action
+    """
+    trace = current_trace()
+    if trace is not None:
+        trace.current.bytes += size
@@ -0,0 +1,132 @@
+# Import libs
+import json
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+# Characters json.dumps escapes with the default ensure_ascii=True: quotes, backslashes,
+# control characters, DEL and everything outside ASCII
+NEEDS_ESCAPE_REGEX = r'["\\\x00-\x1f]|[^\x00-\x7e]'
+
+
+def _key_json(key):
+    # Same conversion of the key json.dumps does (numbers, booleans and None become strings)
+    return json.dumps({key: 0})[1:-4]
+
+
+def _literal(text):
+    # Scalar broadcast to all the rows by binary_join_element_wise
+    return pa.scalar(text, type=pa.large_string())
+
+
+def _encode_values(values):
+    # Per value fallback, only used for the values that are not plain ASCII strings
+    return pa.array([json.dumps(value) for value in values], type=pa.large_string())
+
+
+def _encode_strings(column):
+    """
+    Encodes a string column as JSON values: "value" for plain strings, null for nulls
+    """
+    column = column.cast(pa.large_string())
+    encoded = pc.binary_join_element_wise(_literal('"'), column, _literal('"'), _literal(""))
+
+    needs_escape = pc.fill_null(pc.match_substring_regex(column, NEEDS_ESCAPE_REGEX), False)
+    if pc.any(needs_escape).as_py():
+        escaped = _encode_values(column.filter(needs_escape).to_pylist())
+        encoded = pc.replace_with_mask(encoded, needs_escape, escaped)
+
+    return pc.fill_null(encoded, "null")
+
+
+def _encode_column(column):
+    """
+    Encodes an Arrow column as JSON values, as json.dumps would encode each value
+    """
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        return _encode_strings(column)
+
+    if pa.types.is_null(column.type):
+        return pa.array(["null"] * len(column), type=pa.large_string())
+
+    if pa.types.is_integer(column.type):
+        return pc.fill_null(column.cast(pa.large_string()), "null")
+
+    if pa.types.is_boolean(column.type):
+        return pc.fill_null(pc.if_else(column, "true", "false").cast(pa.large_string()), "null")
+
+    # Floats (NaN, Infinity) and any other type go through json.dumps
+    return _encode_values(column.to_pylist())
+
+
+def encode_json_rows(table):
+    """
+    Serializes every row of an Arrow table as a JSON object, without building a Python
+    object per row. The strings are the same json.dumps(row_dict) produces with the default
+    settings, keys in column order.
+
+    :param table:                   pyarrow Table or RecordBatch
+    :return                         pyarrow large_string array with one JSON object per row
+    """
+    if table.num_columns == 0:
+        return pa.array(["{}"] * table.num_rows, type=pa.large_string())
+
+    parts = []
+    for i, name in enumerate(table.column_names):
+        separator = "{" if i == 0 else ", "
+        parts.append(_literal(f"{separator}{_key_json(name)}: "))
+        parts.append(_encode_column(table.column(i)))
+    parts.append(_literal("}"))
+
+    return pc.binary_join_element_wise(*parts, _literal(""))
+
+
+def _encode_series(series):
+    """
+    Encodes a DataFrame column as JSON values, as json.dumps would encode each value of to_dict()
+    """
+    if isinstance(series.dtype, (pd.StringDtype, pd.ArrowDtype)):
+        # Columns backed by Arrow (csv_ingest) are encoded without converting them to objects
+        return _encode_column(pa.array(series.array))
+
+    if series.dtype == object:
+        try:
+            # NaN is not converted to null, so the column only goes through Arrow if it holds strings and None
+            column = pa.array(series.to_numpy(), type=pa.large_string(), from_pandas=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Mixed types, the values are encoded one by one
+            return _encode_values(series.tolist())
+        return _encode_strings(column)
+
+    if pd.api.types.is_integer_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+        return _encode_column(pa.Array.from_pandas(series))
+
+    # Floats (NaN, Infinity), dates... are encoded as Python objects, like to_dict() does
+    return _encode_values(series.tolist())
+
+
+def dataframe_to_json_rows(dataframe):
+    """
+    Serializes every row of a DataFrame as a JSON object. Produces the same strings as
+    dataframe.to_dict(orient="records") followed by json.dumps on each record
+
+    :param dataframe:               DataFrame to serialize, None values are encoded as null
+    :return                         Series of JSON strings with the index of the DataFrame
+    """
+    if len(dataframe.columns) == 0:
+        return pd.Series(["{}"] * len(dataframe), index=dataframe.index, dtype=object)
+
+    parts = []
+    for i, (name, series) in enumerate(dataframe.items()):
+        separator = "{" if i == 0 else ", "
+        parts.append(_literal(f"{separator}{_key_json(name)}: "))
+        parts.append(_encode_series(series))
+    parts.append(_literal("}"))
+
+    json_rows = pc.binary_join_element_wise(*parts, _literal(""))
+    return pd.Series(json_rows.to_numpy(zero_copy_only=False), index=dataframe.index, dtype=object)
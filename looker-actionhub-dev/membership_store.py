@@ -0,0 +1,285 @@
+# Import libs
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+
+import fsspec
+import numpy as np
+
+from bq_reader import query_rows
+from clients import get_logger
+
+
+logger = get_logger('looker-actionhub')
+
+# A member is the SHA-256 of its email followed by the SHA-256 of its phone number, zeros when missing
+DIGEST_SIZE = 32
+KEY_SIZE = DIGEST_SIZE * 2
+KEY_DTYPE = np.dtype(f"S{KEY_SIZE}")
+
+
+def membership_keys(hashed_emails, hashed_phone_numbers):
+    """
+    Builds the membership keys of a chunk of users
+
+    :param hashed_emails:           HashedIdentifiers of the emails
+    :param hashed_phone_numbers:    HashedIdentifiers of the phone numbers
+    :return                         Array of keys of the users with at least one valid identifier
+    """
+    keys = np.hstack([hashed_emails.digests, hashed_phone_numbers.digests])
+    keys = keys[hashed_emails.valid | hashed_phone_numbers.valid]
+    return np.ascontiguousarray(keys).view(KEY_DTYPE).ravel()
+
+
+def sort_keys(keys):
+    """
+    Sorts the keys and removes the duplicates
+    """
+    return np.unique(np.asarray(keys, dtype=KEY_DTYPE))
+
+
+def keys_to_hex(keys):
+    """
+    Splits the keys in hashed emails and hashed phone numbers in the hex format of the Google Ads API
+
+    :param keys:                    Array of membership keys
+    :return                         (list of hashed emails, list of hashed phone numbers), None when missing
+    """
+    digests = np.asarray(keys, dtype=KEY_DTYPE).view(np.uint8).reshape(-1, 2, DIGEST_SIZE)
+    hashed = []
+    for i in range(2):
+        column = digests[:, i, :]
+        is_missing = ~column.any(axis=1)
+        hex_digests = np.frombuffer(column.tobytes().hex().encode("ascii"), dtype=f"S{DIGEST_SIZE * 2}").astype(object)
+        hex_digests[is_missing] = None
+        hashed.append([None if value is None else value.decode("ascii") for value in hex_digests])
+
+    return hashed[0], hashed[1]
+
+
+def drop_kept_identifiers(keys_to_remove, current):
+    """
+    Removes from the keys to remove the emails and phone numbers that are still in the audience.
+    The remove and add jobs are processed by Google Ads asynchronously, in any order: a member whose
+    phone number changed is removed with the same email it is added with, and could lose it
+
+    :param keys_to_remove:          Keys of the members to remove
+    :param current:                 Keys of the audience sent today
+    :return                         Keys to remove with the identifiers still in use zeroed, the keys left
+                                    without identifiers are dropped
+    """
+    if len(keys_to_remove) == 0 or len(current) == 0:
+        return keys_to_remove
+
+    digest_dtype = np.dtype(f"S{DIGEST_SIZE}")
+    removed = np.asarray(keys_to_remove, dtype=KEY_DTYPE).view(np.uint8).reshape(-1, 2, DIGEST_SIZE).copy()
+    kept = np.asarray(current, dtype=KEY_DTYPE).view(np.uint8).reshape(-1, 2, DIGEST_SIZE)
+    for i in range(2):
+        is_kept = np.isin(np.ascontiguousarray(removed[:, i, :]).view(digest_dtype).ravel(), np.ascontiguousarray(kept[:, i, :]).view(digest_dtype).ravel())
+        removed[is_kept, i, :] = 0
+
+    removed = removed[removed.reshape(len(removed), -1).any(axis=1)]
+    return np.ascontiguousarray(removed).reshape(len(removed), KEY_SIZE).view(KEY_DTYPE).ravel()
+
+
+def diff_members(current, previous):
+    """
+    Compares two sorted arrays of keys with a merge (binary search of each key in the other array)
+
+    :param current:                 Sorted keys of the audience sent today
+    :param previous:                Sorted keys of the last snapshot
+    :return                         (keys to add, keys to remove), both sorted
+    """
+    def missing_in(keys, other):
+        if len(other) == 0:
+            return np.ones(len(keys), dtype=bool)
+        positions = np.searchsorted(other, keys)
+        found = other[np.minimum(positions, len(other) - 1)] == keys
+        return ~found
+
+    return current[missing_in(current, previous)], previous[missing_in(previous, current)]
+
+
+def full_refresh_interval(ttl, full_refresh_days=7, ttl_margin_days=2):
+    """
+    Time after which the whole audience is uploaded again. The members only sent in the delta uploads
+    would expire otherwise, so it is capped at the membership TTL of the segment minus a margin
+
+    :param ttl:                     Membership TTL of the segment, in days
+    :param full_refresh_days:       Days between full uploads when the TTL allows it
+    :param ttl_margin_days:         Days before the TTL the whole audience is uploaded
+    :return                         timedelta, 0 when every upload must be full
+    """
+    return timedelta(days=min(full_refresh_days, max(int(ttl) - ttl_margin_days, 0)))
+
+
+class MembershipSnapshot():
+    """
+    Members of a segment the last time it was uploaded
+    """
+    def __init__(self, keys, full_refresh_at, updated_at, sent_at=None):
+        """
+        :param keys:                Sorted membership keys, memory-mapped
+        :param full_refresh_at:     Last time the whole audience was uploaded, it renews the membership TTL
+        :param updated_at:          Last time the snapshot was saved
+        :param sent_at:             SENT_DATETIME of the F_LOOKER_SENT rows of the upload, None in older snapshots
+        """
+        self.keys = keys
+        self.full_refresh_at = full_refresh_at
+        self.updated_at = updated_at
+        self.sent_at = sent_at
+
+
+def is_last_upload(snapshot, table, brand, segment_name):
+    """
+    Checks that no upload of the segment was sent after the one of the snapshot, e.g. by an instance
+    with its own local store. One query of the F_LOOKER_SENT rows since the date of the snapshot
+
+    :param snapshot:                MembershipSnapshot
+    :param table:                   F_LOOKER_SENT table (project.dataset.table)
+    :return                         True if the snapshot has the members of the last upload
+    """
+    from google.cloud import bigquery
+
+    if snapshot.sent_at is None:
+        return False
+
+    query = f"""
+        SELECT COUNT(*) AS UPLOADS
+        FROM `{table}`
+        WHERE SENT_DATE >= @sent_date
+            AND SENT_DATETIME > @sent_at
+            AND CHANNEL = 'GOOGLEADS'
+            AND BRAND = @brand
+            AND CAMPAIGN_CODE = @segment_name
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("sent_date", "DATE", snapshot.sent_at.date()),
+        bigquery.ScalarQueryParameter("sent_at", "DATETIME", snapshot.sent_at),
+        bigquery.ScalarQueryParameter("brand", "STRING", brand),
+        bigquery.ScalarQueryParameter("segment_name", "STRING", segment_name)
+    ])
+    rows = query_rows(query, job_config=job_config)
+    return len(rows) == 0 or rows[0][0] == 0
+
+
+class MembershipStore():
+    """
+    Stores a snapshot of the members of each (brand, country, segment) as a sorted .npy array with a
+    metadata JSON next to it.
+
+    The store can be a local directory or any fsspec URL (gs://bucket/prefix needs gcsfs). Remote
+    snapshots are copied to a local cache directory before they are memory-mapped.
+    """
+    def __init__(self, uri, cache_dir="/tmp/membership_snapshots"):
+        """
+        :param uri:                 Local directory or fsspec URL where the snapshots are kept
+        :param cache_dir:           Local directory of the copies of remote snapshots
+        """
+        self.uri = uri.rstrip("/")
+        self.cache_dir = cache_dir
+        self.fs, self.root = fsspec.core.url_to_fs(self.uri)
+        self.is_local = "file" in (self.fs.protocol if isinstance(self.fs.protocol, (tuple, list)) else (self.fs.protocol,))
+        self.__lock = threading.Lock()
+
+    def __name(self, brand, country, segment_name):
+        # Segment names are free text, the hash keeps the paths valid
+        segment_hash = hashlib.sha256(segment_name.encode("utf-8")).hexdigest()[:32]
+        return f"{brand}/{country}/{segment_hash}"
+
+    def __local_keys_path(self, name):
+        if self.is_local:
+            return f"{self.root}/{name}.npy"
+        return os.path.join(self.cache_dir, f"{name}.npy")
+
+    def load(self, brand, country, segment_name):
+        """
+        Loads the last snapshot of a segment
+
+        :return                     MembershipSnapshot, None if the segment has no snapshot
+        """
+        name = self.__name(brand, country, segment_name)
+        metadata_path = f"{self.root}/{name}.json"
+        if not self.fs.exists(metadata_path):
+            return None
+
+        with self.fs.open(metadata_path, "r") as metadata_file:
+            metadata = json.load(metadata_file)
+
+        local_path = self.__local_keys_path(name)
+        with self.__lock:
+            if not self.is_local:
+                # The copy is reused while the remote snapshot is the same version
+                local_metadata_path = os.path.join(self.cache_dir, f"{name}.json")
+                is_cached = os.path.exists(local_path) and os.path.exists(local_metadata_path)
+                if is_cached:
+                    with open(local_metadata_path) as local_metadata_file:
+                        is_cached = json.load(local_metadata_file).get("version") == metadata["version"]
+                if not is_cached:
+                    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                    self.fs.get(f"{self.root}/{name}.npy", local_path)
+                    with open(local_metadata_path, "w") as local_metadata_file:
+                        json.dump(metadata, local_metadata_file)
+
+        keys = np.load(local_path, mmap_mode="r")
+        if len(keys) != metadata["members"]:
+            logger.log_text(f"Membership snapshot {name} is corrupted, ignoring it", severity='WARNING')
+            return None
+
+        return MembershipSnapshot(
+            keys=keys,
+            full_refresh_at=datetime.fromisoformat(metadata["full_refresh_at"]),
+            updated_at=datetime.fromisoformat(metadata["updated_at"]),
+            sent_at=datetime.fromisoformat(metadata["sent_at"]) if metadata.get("sent_at") else None
+        )
+
+    def save(self, brand, country, segment_name, keys, full_refresh_at, sent_at=None):
+        """
+        Replaces the snapshot of a segment
+
+        :param keys:                Sorted membership keys
+        :param full_refresh_at:     Last time the whole audience was uploaded
+        :param sent_at:             SENT_DATETIME of the F_LOOKER_SENT rows of the upload
+        """
+        name = self.__name(brand, country, segment_name)
+        updated_at = datetime.now().replace(microsecond=0)
+        metadata = {
+            "brand": brand,
+            "country": country,
+            "segment_name": segment_name,
+            "members": int(len(keys)),
+            "version": updated_at.strftime("%Y%m%d%H%M%S%f") + hashlib.sha256(np.asarray(keys, dtype=KEY_DTYPE).tobytes()).hexdigest()[:16],
+            "full_refresh_at": full_refresh_at.isoformat(),
+            "updated_at": updated_at.isoformat(),
+            "sent_at": sent_at.isoformat() if sent_at is not None else None
+        }
+
+        local_path = self.__local_keys_path(name)
+        with self.__lock:
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            # Written aside and renamed, a snapshot memory-mapped by another request is never modified
+            tmp_path = f"{local_path}.{os.getpid()}.{threading.get_ident()}.tmp.npy"
+            np.save(tmp_path, np.asarray(keys, dtype=KEY_DTYPE))
+            os.replace(tmp_path, local_path)
+
+            if not self.is_local:
+                self.fs.put(local_path, f"{self.root}/{name}.npy")
+                with open(os.path.join(self.cache_dir, f"{name}.json"), "w") as local_metadata_file:
+                    json.dump(metadata, local_metadata_file)
+
+            # The metadata is written last, it is what makes the new snapshot visible
+            with self.fs.open(f"{self.root}/{name}.json", "w") as metadata_file:
+                json.dump(metadata, metadata_file)
+
+
+def get_membership_store():
+    """
+    Returns the store configured in the membership_store_uri env variable, None if it is not configured
+    """
+    uri = os.environ.get("membership_store_uri", "")
+    if uri == "":
+        return None
+
+    return MembershipStore(uri, cache_dir=os.environ.get("membership_store_cache_dir", "/tmp/membership_snapshots"))
@@ -0,0 +1,251 @@
+# Import libs
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from admission import get_memory_usage
+from clients import get_logger
+
+
+logger = get_logger('looker-actionhub')
+
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+MEMORY_BUCKETS = tuple(2 ** exponent * 1024 * 1024 for exponent in range(5, 14))
+
+# Trace of the action being executed by the current thread
+_current = threading.local()
+
+
+class Histogram():
+    """
+    Cumulative histogram with fixed buckets, as exposed by Prometheus
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels, **extra):
+    labels = {**dict(labels), **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class MetricsRegistry():
+    """
+    Counters, gauges and histograms of the process, rendered in the Prometheus text format
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__metrics = {}
+
+    def __get(self, kind, name, help_text, labels, factory):
+        with self.__lock:
+            metric = self.__metrics.setdefault(name, {"kind": kind, "help": help_text, "series": {}})
+            key = tuple(sorted(labels.items()))
+            if key not in metric["series"]:
+                metric["series"][key] = factory()
+            return metric, key
+
+    def inc(self, name, help_text, value=1, **labels):
+        metric, key = self.__get("counter", name, help_text, labels, lambda: 0)
+        with self.__lock:
+            metric["series"][key] += value
+
+    def set(self, name, help_text, value, **labels):
+        metric, key = self.__get("gauge", name, help_text, labels, lambda: 0)
+        with self.__lock:
+            metric["series"][key] = value
+
+    def add(self, name, help_text, value, **labels):
+        metric, key = self.__get("gauge", name, help_text, labels, lambda: 0)
+        with self.__lock:
+            metric["series"][key] += value
+
+    def observe(self, name, help_text, value, buckets=DURATION_BUCKETS, **labels):
+        metric, key = self.__get("histogram", name, help_text, labels, lambda: Histogram(buckets))
+        with self.__lock:
+            metric["series"][key].observe(value)
+
+    def render(self):
+        """
+        Returns all the metrics in the Prometheus text exposition format (version 0.0.4)
+        """
+        lines = []
+        with self.__lock:
+            for name, metric in sorted(self.__metrics.items()):
+                lines.append(f"# HELP {name} {metric['help']}")
+                lines.append(f"# TYPE {name} {metric['kind']}")
+                for labels, value in sorted(metric["series"].items()):
+                    if metric["kind"] != "histogram":
+                        lines.append(f"{name}{_labels(labels)} {value}")
+                        continue
+
+                    cumulative = 0
+                    for bound, count in zip(value.buckets + ("+Inf",), value.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {value.sum}")
+                    lines.append(f"{name}_count{_labels(labels)} {value.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class Span():
+    """
+    Stage of an action, with the rows and bytes it processed and the peak memory of the instance while it ran
+    """
+    def __init__(self, stage):
+        self.stage = stage
+        self.started_at = time.monotonic()
+        self.duration = None
+        self.rows = 0
+        self.bytes = 0
+        self.peak_memory = 0
+
+    def to_dict(self):
+        return {
+            "stage": self.stage,
+            "duration": round(self.duration, 3) if self.duration is not None else None,
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "peak_memory_mb": self.peak_memory // (1024 * 1024)
+        }
+
+
+class ActionTrace():
+    """
+    Spans of a run of an action. A new span starts each time the action reports a new stage
+    """
+    def __init__(self, action):
+        self.action = action
+        self.started_at = time.monotonic()
+        self.success = None
+        self.spans = [Span("prepare")]
+
+    @property
+    def current(self):
+        return self.spans[-1]
+
+    def start_stage(self, stage):
+        if stage == self.current.stage:
+            return
+        self.current.duration = time.monotonic() - self.current.started_at
+        self.spans.append(Span(stage))
+
+    def sample_memory(self, memory):
+        span = self.current
+        span.peak_memory = max(span.peak_memory, memory)
+
+
+class MemorySampler():
+    """
+    Samples the memory of the instance while there are actions running, for the peak memory of the spans
+    """
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self.__traces = set()
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def __run(self):
+        while True:
+            with self.__lock:
+                traces = list(self.__traces)
+                if not traces:
+                    self.__thread = None
+                    return
+
+            memory = get_memory_usage()
+            for trace in traces:
+                trace.sample_memory(memory)
+            time.sleep(self.interval)
+
+    def add(self, trace):
+        with self.__lock:
+            self.__traces.add(trace)
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name="memory-sampler", daemon=True)
+                self.__thread.start()
+
+    def remove(self, trace):
+        with self.__lock:
+            self.__traces.discard(trace)
+
+
+memory_sampler = MemorySampler(interval = float(os.environ.get("metrics_memory_sample_interval", "0.25")))
+
+
+def _record(trace, status):
+    duration = time.monotonic() - trace.started_at
+    registry.inc("actionhub_action_runs_total", "Runs of each action by outcome", action=trace.action, status=status)
+    registry.observe("actionhub_action_duration_seconds", "Duration of the runs of each action", duration, action=trace.action, status=status)
+
+    for span in trace.spans:
+        registry.observe("actionhub_stage_duration_seconds", "Duration of each stage of the actions", span.duration, action=trace.action, stage=span.stage)
+        registry.inc("actionhub_stage_rows_total", "Rows processed in each stage of the actions", span.rows, action=trace.action, stage=span.stage)
+        registry.inc("actionhub_stage_bytes_total", "Bytes transferred in each stage of the actions", span.bytes, action=trace.action, stage=span.stage)
+        registry.observe("actionhub_stage_peak_memory_bytes", "Peak memory of the instance during each stage of the actions", span.peak_memory, buckets=MEMORY_BUCKETS, action=trace.action, stage=span.stage)
+
+    logger.log_text(f"Action {trace.action} {status} in {duration:.1f}s => {json.dumps([span.to_dict() for span in trace.spans])}", severity='INFO')
+
+
+@contextmanager
+def trace_action(action):
+    """
+    Traces a run of an action executed by the current thread. The spans are added to the histograms
+    and logged when the run finishes. Set <trace>.success with the outcome of the run
+    """
+    trace = ActionTrace(action)
+    trace.sample_memory(get_memory_usage())
+    _current.trace = trace
+    memory_sampler.add(trace)
+    registry.add("actionhub_actions_in_progress", "Runs of each action in progress", 1, action=action)
+    status = "error"
+    try:
+        yield trace
+        status = "success" if trace.success else "failed"
+    finally:
+        _current.trace = None
+        memory_sampler.remove(trace)
+        registry.add("actionhub_actions_in_progress", "Runs of each action in progress", -1, action=action)
+        trace.sample_memory(get_memory_usage())
+        trace.current.duration = time.monotonic() - trace.current.started_at
+        _record(trace, status)
+
+
+def current_trace():
+    """
+    Returns the trace of the action run by the current thread, None outside an action
+    """
+    return getattr(_current, "trace", None)
+
+
+def render_metrics():
+    """
+    Returns the metrics of the process in the Prometheus text format
+    """
+    registry.set("actionhub_memory_usage_bytes", "Memory used by the instance", get_memory_usage())
+    return registry.render()
@@ -0,0 +1,74 @@
+# Import libs
+import hashlib
+import json
+import os
+import random
+from datetime import datetime, timezone
+
+from clients import get_logger
+
+
+logger = get_logger('looker-actionhub')
+
+# Prefix of the log entries with a recorded payload, benchmarks/bench_load.py extracts them from a log export
+RECORD_PREFIX = "Recorded Looker payload => "
+
+# Form fields kept as they are, the values of the other fields are replaced by a hash
+SAFE_FORM_PARAMS = {"brand", "country", "ttl", "dataset_id", "table_id"}
+
+
+def _pseudonym(value):
+    return "anon-" + hashlib.sha256(str(value).encode("utf-8")).hexdigest()[:12]
+
+
+def anonymize_payload(action, request_json):
+    """
+    Copy of a Looker request without the download URL (it carries a token) nor names of segments,
+    plans or paths. The same value always gets the same pseudonym, so the replays keep the
+    repetitions of the original traffic
+
+    :param action:                  Name of the action
+    :param request_json:            Request sent by Looker
+    :return                         Dict with the action, the time it was received and the anonymized request
+    """
+    scheduled_plan = request_json.get("scheduled_plan") or {}
+    form_params = request_json.get("form_params") or {}
+
+    return {
+        "action": action,
+        "received_at": datetime.now(timezone.utc).isoformat(),
+        "request": {
+            "type": request_json.get("type"),
+            "scheduled_plan": {
+                "type": scheduled_plan.get("type"),
+                "title": _pseudonym(scheduled_plan["title"]) if scheduled_plan.get("title") else None,
+                "download_url": None
+            },
+            "form_params": {name: value if name in SAFE_FORM_PARAMS else _pseudonym(value) for name, value in form_params.items()}
+        }
+    }
+
+
+class PayloadRecorder():
+    """
+    Logs a sample of the requests of the execute routes, anonymized, to replay them in load tests
+    """
+    def __init__(self, rate=0.0):
+        """
+        :param rate:                Fraction of the requests recorded, 0 disables the recording
+        """
+        self.rate = rate
+        self.recorded = 0
+
+    def record(self, action, request_json):
+        if self.rate <= 0 or not isinstance(request_json, dict) or random.random() >= self.rate:
+            return
+
+        try:
+            logger.log_text(RECORD_PREFIX + json.dumps(anonymize_payload(action, request_json)), severity='INFO')
+            self.recorded += 1
+        except Exception as e:
+            logger.log_text(f"Payload of {action} could not be recorded: {str(e)}", severity='WARNING')
+
+
+payload_recorder = PayloadRecorder(rate = float(os.environ.get("payload_recording_rate", "0")))
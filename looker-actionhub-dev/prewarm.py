@@ -0,0 +1,81 @@
+# Import libs
+import importlib
+import os
+import threading
+import time
+
+from clients import get_bigquery_client, get_logger, get_logging_client
+
+
+logger = get_logger('looker-actionhub')
+
+# Modules imported by the actions on their first run, heaviest first
+ACTION_MODULES = [
+    "google_ads",
+    "pandas",
+    "bq_writer",
+    "csv_ingest",
+    "identity_index",
+    "json_rows",
+    "membership_store",
+    "sftp_pipeline",
+    "sftp_pool",
+    "adform",
+    "s3_upload",
+    "boto3",
+    "googleapiclient.discovery"
+]
+
+
+def prewarm(modules=None):
+    """
+    Imports the modules of the actions and creates the shared clients, so the first run of each
+    action does not pay for them
+
+    :param modules:                 Names of the modules to import, ACTION_MODULES by default
+    :return                         Dict module -> seconds taken to import it (None if it failed)
+    """
+    timings = {}
+    for module in modules or ACTION_MODULES:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(module)
+            timings[module] = time.perf_counter() - start
+        except Exception as e:
+            timings[module] = None
+            logger.log_text(f"Pre-warm of {module} failed: {str(e)}", severity='WARNING')
+
+    for name, create in (("bigquery", get_bigquery_client), ("logging", get_logging_client)):
+        start = time.perf_counter()
+        try:
+            create()
+            timings[f"client:{name}"] = time.perf_counter() - start
+        except Exception as e:
+            timings[f"client:{name}"] = None
+            logger.log_text(f"Pre-warm of the {name} client failed: {str(e)}", severity='WARNING')
+
+    return timings
+
+
+def start_prewarm():
+    """
+    Starts the pre-warm in a background thread when prewarm_enabled is true. It waits prewarm_delay
+    seconds, so it runs once the server is accepting requests. prewarm_modules (comma separated)
+    overrides the modules imported
+    """
+    if os.environ.get("prewarm_enabled", "false").lower() != "true":
+        return None
+
+    delay = float(os.environ.get("prewarm_delay", "1"))
+    modules = [module.strip() for module in os.environ.get("prewarm_modules", "").split(",") if module.strip()]
+
+    def run():
+        time.sleep(delay)
+        start = time.perf_counter()
+        timings = prewarm(modules or None)
+        summary = ", ".join(f"{module}={timing:.2f}s" if timing is not None else f"{module}=failed" for module, timing in timings.items())
+        logger.log_text(f"Pre-warm done in {time.perf_counter() - start:.2f}s => {summary}", severity='INFO')
+
+    thread = threading.Thread(target=run, name="prewarm", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,162 @@
+# Import libs
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+# S3 rejects multipart parts smaller than 5 MiB, except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class S3MultipartUpload():
+    """
+    Streams a file to S3, uploading its parts in parallel while the content is still being generated.
+
+    Memory is bounded by the part size and the number of parts in flight, not by the size of the file.
+    Files smaller than a part are uploaded with a single PutObject. The content can be gzipped on the fly.
+    """
+    def __init__(self, s3_client, bucket, key, part_size=8 * 1024 * 1024, max_workers=4, compress=False):
+        """
+        :param s3_client:           boto3 S3 client
+        :param bucket:              Destination bucket
+        :param key:                 Destination key
+        :param part_size:           Bytes of each part, at least 5 MiB
+        :param max_workers:         Parts uploaded at the same time
+        :param compress:            True to gzip the content
+        """
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.max_workers = max_workers
+        self.bytes_written = 0
+        self.bytes_uploaded = 0
+        self.__compressor = zlib.compressobj(wbits=31) if compress else None
+        self.__buffer = bytearray()
+        self.__upload_id = None
+        self.__parts = []
+        self.__futures = []
+        self.__executor = None
+        # Parts waiting or being uploaded, write() blocks when all are taken
+        self.__slots = threading.BoundedSemaphore(max_workers + 1)
+        self.__closed = False
+
+    def __upload_part(self, part_number, body):
+        try:
+            response = self.s3_client.upload_part(
+                Bucket=self.bucket, Key=self.key, UploadId=self.__upload_id, PartNumber=part_number, Body=body
+            )
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+        finally:
+            self.__slots.release()
+
+    def __submit_part(self, body):
+        if self.__upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+            self.__upload_id = response["UploadId"]
+            self.__executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="s3-upload")
+
+        # Fail fast if a previous part could not be uploaded
+        for future in self.__futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+        self.__slots.acquire()
+        part_number = len(self.__futures) + 1
+        self.__futures.append(self.__executor.submit(self.__upload_part, part_number, bytes(body)))
+        self.bytes_uploaded += len(body)
+
+    def __flush(self, final=False):
+        while len(self.__buffer) >= self.part_size:
+            self.__submit_part(self.__buffer[:self.part_size])
+            del self.__buffer[:self.part_size]
+
+        if final and self.__buffer and self.__upload_id is not None:
+            self.__submit_part(self.__buffer)
+            self.__buffer = bytearray()
+
+    def write(self, data):
+        """
+        Appends content to the file. Blocks while all the upload slots are taken
+
+        :param data:                String (encoded as UTF-8) or bytes
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.bytes_written += len(data)
+
+        if self.__compressor is not None:
+            data = self.__compressor.compress(data)
+        self.__buffer += data
+        self.__flush()
+
+    def close(self):
+        """
+        Uploads the remaining content and completes the upload
+
+        :return                     Bytes uploaded to S3
+        """
+        if self.__closed:
+            return self.bytes_uploaded
+        self.__closed = True
+
+        try:
+            if self.__compressor is not None:
+                self.__buffer += self.__compressor.flush()
+
+            if self.__upload_id is None:
+                # Smaller than a part, a single request is enough
+                self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.__buffer))
+                self.bytes_uploaded += len(self.__buffer)
+                return self.bytes_uploaded
+
+            self.__flush(final=True)
+            self.__parts = [future.result() for future in self.__futures]
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.__upload_id, MultipartUpload={"Parts": self.__parts}
+            )
+            return self.bytes_uploaded
+
+        except Exception:
+            self.__abort_upload()
+            raise
+
+        finally:
+            if self.__executor is not None:
+                self.__executor.shutdown(wait=False)
+
+    def __abort_upload(self):
+        if self.__upload_id is not None:
+            for future in self.__futures:
+                future.cancel()
+            # A part still uploading would be kept by S3 if it finished after the abort
+            wait(self.__futures)
+            # The parts already uploaded are deleted by S3, nothing is left in the bucket
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.__upload_id)
+            self.__upload_id = None
+
+    def abort(self):
+        """
+        Cancels the upload. Does nothing if the upload is already closed
+        """
+        if not self.__closed:
+            self.__closed = True
+            self.__abort_upload()
+            if self.__executor is not None:
+                self.__executor.shutdown(wait=False)
+
+
+def new_s3_upload(s3_client, bucket, key):
+    """
+    Creates an upload configured from the env variables. With s3_upload_gzip the key gets the .gz extension
+    """
+    compress = os.environ.get("s3_upload_gzip", "false").lower() == "true"
+    return S3MultipartUpload(
+        s3_client,
+        bucket,
+        f"{key}.gz" if compress else key,
+        part_size = int(os.environ.get("s3_upload_part_size", str(8 * 1024 * 1024))),
+        max_workers = int(os.environ.get("s3_upload_workers", "4")),
+        compress = compress
+    )
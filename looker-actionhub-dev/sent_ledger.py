@@ -0,0 +1,224 @@
+# Import libs
+import os
+import threading
+import time
+
+from bq_reader import query_rows
+from clients import get_logger
+
+
+logger = get_logger('looker-actionhub')
+
+
+class SentLedger():
+    """
+    In-memory ledger of the last date each (CHANNEL, BRAND, CAMPAIGN_CODE) was sent, mirroring F_LOOKER_SENT.
+
+    The ledger is bulk-loaded with a single grouped query on first use, updated in-process every time
+    rows are written to F_LOOKER_SENT and refreshed in the background to pick up the rows written by
+    other instances. A check of a date the ledger does not have yet runs one keyed query, so a send of
+    another instance is not missed between two refreshes.
+    """
+    def __init__(self, prefix_project, prefix_dataset, lookback_days=7, refresh_interval=300):
+        """
+        :param prefix_project:      Project prefix. Depends on the environment (dev, test, prod)
+        :param prefix_dataset:      Dataset prefix. Depends on the environment
+        :param lookback_days:       Days of F_LOOKER_SENT loaded in the ledger. Only today's date is used by the checks
+        :param refresh_interval:    Seconds between background reloads, bounds how stale the rows
+                                    written by other instances can be
+        """
+        self.dataset_id = f"{prefix_dataset}clz_c4m_public_activation"
+        self.table_id = "F_LOOKER_SENT"
+        self.table = f"{prefix_project}cross-cloud4marketing.{self.dataset_id}.{self.table_id}"
+        self.lookback_days = lookback_days
+        self.refresh_interval = refresh_interval
+        self.__lock = threading.Lock()
+        self.__load_lock = threading.Lock()
+        self.__last_sent = {}
+        self.__loaded_at = None
+        self.__refresher = None
+        self.loads = 0
+        self.lookups = 0
+        self.key_loads = 0
+        self.records = 0
+
+    def load(self):
+        """
+        Loads the last sent date of every key with one grouped query and merges it in the ledger
+        """
+        query = f"""
+            SELECT
+                CHANNEL,
+                BRAND,
+                CAMPAIGN_CODE,
+                MAX(SENT_DATE) AS LAST_SENT_DATE
+            FROM
+                `{self.table}`
+            WHERE
+                SENT_DATE >= DATE_SUB(CURRENT_DATE(), INTERVAL {self.lookback_days} DAY)
+            GROUP BY
+                CHANNEL, BRAND, CAMPAIGN_CODE
+            """
+        rows = query_rows(query)
+
+        with self.__lock:
+            for channel, brand, campaign_code, last_sent_date in rows:
+                self.__merge((channel, brand, campaign_code), last_sent_date.strftime("%Y%m%d"))
+            self.__loaded_at = time.time()
+            self.loads += 1
+
+    def load_key(self, channel, brand, campaign_code, sent_date):
+        """
+        Checks in BigQuery if rows were sent on a date for a key and merges it in the ledger.
+        One query on a single date of a single key, for the rows written by other instances since the last refresh
+        """
+        from google.cloud import bigquery
+
+        query = f"""
+            SELECT
+                CHANNEL,
+                BRAND,
+                CAMPAIGN_CODE,
+                MAX(SENT_DATE) AS LAST_SENT_DATE
+            FROM
+                `{self.table}`
+            WHERE
+                SENT_DATE = @sent_date
+                AND CHANNEL = @channel
+                AND BRAND = @brand
+                AND CAMPAIGN_CODE = @campaign_code
+            GROUP BY
+                CHANNEL, BRAND, CAMPAIGN_CODE
+            """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("sent_date", "DATE", sent_date),
+            bigquery.ScalarQueryParameter("channel", "STRING", channel),
+            bigquery.ScalarQueryParameter("brand", "STRING", brand),
+            bigquery.ScalarQueryParameter("campaign_code", "STRING", campaign_code)
+        ])
+        rows = query_rows(query, job_config=job_config)
+
+        with self.__lock:
+            for channel, brand, campaign_code, last_sent_date in rows:
+                self.__merge((channel, brand, campaign_code), last_sent_date.strftime("%Y%m%d"))
+            self.key_loads += 1
+
+    def __merge(self, key, date_str):
+        # Never move a date backwards, the rows recorded in-process may not be visible to the query yet
+        if date_str > self.__last_sent.get(key, "00000000"):
+            self.__last_sent[key] = date_str
+
+    def __refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.load()
+            except Exception as e:
+                logger.log_text(f"ERROR => Refresh of the sent ledger failed: {str(e)}", severity='WARNING')
+
+    def ensure_loaded(self):
+        """
+        Loads the ledger if it was never loaded and starts the background refresh
+        """
+        if self.__loaded_at is not None:
+            return
+
+        with self.__load_lock:
+            # Another request may have loaded it while waiting for the lock
+            if self.__loaded_at is not None:
+                return
+
+            self.load()
+            self.__refresher = threading.Thread(target=self.__refresh_loop, name="sent-ledger-refresh", daemon=True)
+            self.__refresher.start()
+
+    def last_sent(self, channel, brand, campaign_code, sent_date=None):
+        """
+        Returns the last date rows were sent for a channel, brand and campaign
+
+        :param channel:             Channel to which the data were sent (MKT, ADFORM, GOOGLEADS...)
+        :param brand:               Brand code
+        :param campaign_code:       Campaign / segment used
+        :param sent_date:           Date checked in BigQuery (see load_key) when the ledger has an older one,
+                                    so a send of another instance is not missed until the next refresh
+        :return                     Last sent date as a string with format YYYYMMDD, "00000000" if never sent
+        """
+        self.ensure_loaded()
+
+        key = (channel, brand, campaign_code)
+        with self.__lock:
+            self.lookups += 1
+            last_sent_str = self.__last_sent.get(key, "00000000")
+
+        if sent_date is None or last_sent_str >= sent_date.strftime("%Y%m%d"):
+            return last_sent_str
+
+        self.load_key(channel, brand, campaign_code, sent_date)
+        with self.__lock:
+            return self.__last_sent.get(key, "00000000")
+
+    def record(self, channel, brand, campaign_code, sent_date):
+        """
+        Records in the ledger rows that have just been written to F_LOOKER_SENT
+
+        :param channel:             Channel to which the data were sent (MKT, ADFORM, GOOGLEADS...)
+        :param brand:               Brand code
+        :param campaign_code:       Campaign / segment used
+        :param sent_date:           SENT_DATE of the rows written
+        """
+        with self.__lock:
+            self.__merge((channel, brand, campaign_code), sent_date.strftime("%Y%m%d"))
+            self.records += 1
+
+    def is_ledger_table(self, table_ref):
+        """
+        Checks if a table reference (dataset.table or project.dataset.table) points to the ledger table
+        """
+        parts = table_ref.replace(":", ".").split(".")
+        return [part.upper() for part in parts[-2:]] == [self.dataset_id.upper(), self.table_id]
+
+    def stats(self):
+        """
+        Returns the ledger counters
+        """
+        with self.__lock:
+            return {
+                "keys": len(self.__last_sent),
+                "loads": self.loads,
+                "lookups": self.lookups,
+                "key_loads": self.key_loads,
+                "records": self.records,
+                "loaded_at": self.__loaded_at
+            }
+
+
+_sent_ledgers = {}
+_sent_ledgers_lock = threading.Lock()
+
+
+def get_sent_ledger(prefix_project, prefix_dataset):
+    """
+    Returns the process-wide ledger of the F_LOOKER_SENT table of the environment
+
+    :param prefix_project:          Project prefix. Depends on the environment (dev, test, prod)
+    :param prefix_dataset:          Dataset prefix. Depends on the environment
+    :return                         SentLedger instance, loaded on first use
+    """
+    with _sent_ledgers_lock:
+        key = (prefix_project, prefix_dataset)
+        if key not in _sent_ledgers:
+            _sent_ledgers[key] = SentLedger(
+                prefix_project,
+                prefix_dataset,
+                lookback_days = int(os.environ.get("sent_ledger_lookback_days", "7")),
+                refresh_interval = int(os.environ.get("sent_ledger_refresh_seconds", "300"))
+            )
+        return _sent_ledgers[key]
+
+
+def sent_ledgers_stats():
+    """
+    Returns the counters of all the ledgers created in the process
+    """
+    with _sent_ledgers_lock:
+        return {ledger.table: ledger.stats() for ledger in _sent_ledgers.values()}
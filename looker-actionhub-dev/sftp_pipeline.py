@@ -0,0 +1,251 @@
+# Import libs
+import csv
+import io
+import os
+import queue
+import threading
+
+from clients import get_http_session
+from csv_ingest import read_csv_chunks
+
+
+class PipelineAborted(Exception):
+    """
+    Raised in a stage when another stage of the pipeline failed or the pipeline was aborted
+    """
+
+
+class _Marker():
+    """
+    Item of the write queue calling a function once the data queued before it is written
+    """
+    def __init__(self, callback):
+        self.callback = callback
+
+
+class _QueueReader(io.RawIOBase):
+    """
+    Read-only file-like object over the blocks produced by the download stage
+    """
+    def __init__(self, pipeline):
+        self.__pipeline = pipeline
+        self.__buffer = memoryview(b"")
+        self.__eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self.__buffer) and not self.__eof:
+            block = self.__pipeline.next_block()
+            if block is None:
+                self.__eof = True
+            else:
+                self.__buffer = memoryview(block)
+
+        n = min(len(b), len(self.__buffer))
+        b[:n] = self.__buffer[:n]
+        self.__buffer = self.__buffer[n:]
+        return n
+
+
+class SftpUploadPipeline():
+    """
+    Streams the Looker CSV to a file in the SFTP server.
+
+    The download, the CSV re-encoding and the SFTP writes run concurrently, connected by bounded
+    queues: the download and the writes run in their own threads and the parsing/re-encoding in
+    the caller thread. Throughput is limited by the slowest stage and memory by the queue sizes.
+    """
+    def __init__(self, url_download, queue_size=4, block_size=1024 * 1024, timeout=(10, 300)):
+        """
+        :param url_download:        URL of the CSV generated by Looker
+        :param queue_size:          Items allowed in each queue (downloaded blocks, encoded chunks)
+        :param block_size:          Bytes of each downloaded block
+        :param timeout:             Connect and read timeout of the download, in seconds
+        """
+        self.url_download = url_download
+        self.block_size = block_size
+        self.timeout = timeout
+        self.bytes_downloaded = 0
+        self.bytes_written = 0
+        self.__downloaded = queue.Queue(maxsize=queue_size)
+        self.__to_write = queue.Queue(maxsize=queue_size)
+        self.__pending_blocks = []
+        self.__abort = threading.Event()
+        self.__error = None
+        self.__download_thread = None
+        self.__write_thread = None
+
+    def __fail(self, error):
+        if self.__error is None:
+            self.__error = error
+        self.__abort.set()
+
+    def __raise_if_aborted(self):
+        if self.__abort.is_set():
+            if self.__error is not None:
+                raise self.__error
+            raise PipelineAborted("SFTP upload pipeline aborted")
+
+    def __put(self, target, item):
+        # Blocks while the queue is full, but gives up as soon as another stage fails
+        while True:
+            self.__raise_if_aborted()
+            try:
+                target.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def __get(self, source):
+        while True:
+            self.__raise_if_aborted()
+            try:
+                return source.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+    def __download(self):
+        try:
+            with get_http_session().get(self.url_download, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                for block in response.iter_content(chunk_size=self.block_size):
+                    self.bytes_downloaded += len(block)
+                    self.__put(self.__downloaded, block)
+            self.__put(self.__downloaded, None)
+        except PipelineAborted:
+            pass
+        except Exception as e:
+            self.__fail(e)
+
+    def __write(self, sftp_file):
+        try:
+            while True:
+                data = self.__get(self.__to_write)
+                if data is None:
+                    return
+                if isinstance(data, _Marker):
+                    sftp_file.flush()
+                    data.callback(self.bytes_written)
+                    continue
+                sftp_file.write(data)
+                self.bytes_written += len(data)
+        except PipelineAborted:
+            pass
+        except Exception as e:
+            self.__fail(e)
+
+    def start_download(self):
+        """
+        Starts downloading the Looker CSV in the background
+        """
+        self.__download_thread = threading.Thread(target=self.__download, name="sftp-download", daemon=True)
+        self.__download_thread.start()
+
+    def start_writer(self, sftp_file):
+        """
+        Starts writing to the SFTP file in the background
+
+        :param sftp_file:           File opened in the SFTP server
+        """
+        self.__write_thread = threading.Thread(target=self.__write, args=(sftp_file,), name="sftp-write", daemon=True)
+        self.__write_thread.start()
+
+    def next_block(self):
+        """
+        Returns the next downloaded block, None once the download is complete
+        """
+        if self.__pending_blocks:
+            return self.__pending_blocks.pop(0)
+
+        return self.__get(self.__downloaded)
+
+    def peek_first_row(self):
+        """
+        Reads the header and the first row of the CSV without consuming them
+
+        :return                     First row as a dict, None if the CSV has no rows
+        """
+        head = b"".join(block for block in self.__pending_blocks if block is not None)
+        is_complete = None in self.__pending_blocks
+        while head.count(b"\n") < 2 and not is_complete:
+            block = self.__get(self.__downloaded)
+            self.__pending_blocks.append(block)
+            if block is None:
+                is_complete = True
+            else:
+                head += block
+
+        return next(csv.DictReader(io.StringIO(head.decode("utf-8", errors="replace"))), None)
+
+    def iter_chunks(self, chunksize=100000):
+        """
+        Parses the downloaded CSV in chunks, as the download progresses
+
+        :param chunksize:           Rows of each chunk
+        :return                     Iterator of DataFrames with all the columns as string[pyarrow]
+        """
+        reader = io.BufferedReader(_QueueReader(self), buffer_size=self.block_size)
+        yield from read_csv_chunks(reader, chunksize=chunksize, index_col=0)
+
+        self.__raise_if_aborted()
+
+    def write(self, data):
+        """
+        Enqueues data to be written to the SFTP file, blocks while the writer is behind
+
+        :param data:                String or bytes to write
+        """
+        self.__put(self.__to_write, data)
+
+    def write_marker(self, callback):
+        """
+        Enqueues a function called by the writer, with the bytes written so far, once the data
+        enqueued before it has been sent to the SFTP file
+
+        :param callback:            Function receiving the number of bytes written
+        """
+        self.__put(self.__to_write, _Marker(callback))
+
+    def relay(self):
+        """
+        Passthrough mode: writes the downloaded bytes to the SFTP file as they are, without parsing them
+        """
+        while True:
+            block = self.next_block()
+            if block is None:
+                return
+            self.write(block)
+
+    def close(self):
+        """
+        Waits until all the data has been written to the SFTP file
+
+        :return                     Number of bytes written
+        """
+        if self.__write_thread is not None:
+            self.__put(self.__to_write, None)
+            self.__write_thread.join()
+        self.__raise_if_aborted()
+
+        return self.bytes_written
+
+    def abort(self):
+        """
+        Stops all the stages. Does nothing if the pipeline is already closed
+        """
+        self.__abort.set()
+
+
+def new_sftp_upload_pipeline(url_download):
+    """
+    Creates a pipeline configured from the env variables
+
+    :param url_download:            URL of the CSV generated by Looker
+    """
+    return SftpUploadPipeline(
+        url_download,
+        queue_size = int(os.environ.get("sftp_pipeline_queue_size", "4")),
+        block_size = int(os.environ.get("sftp_pipeline_block_size", str(1024 * 1024)))
+    )
@@ -0,0 +1,227 @@
+# Import libs
+import hashlib
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+import paramiko
+
+from clients import get_logger
+
+
+logger = get_logger('looker-actionhub')
+
+
+class PooledSftpConnection():
+    """
+    Authenticated SSH transport with its SFTP session, kept open between requests
+    """
+    def __init__(self, key, transport, sftp):
+        self.key = key
+        self.transport = transport
+        self.sftp = sftp
+        self.created_at = time.monotonic()
+        self.released_at = self.created_at
+        self.uses = 0
+
+    def is_active(self):
+        return self.transport.is_active() and self.transport.is_authenticated()
+
+    def close(self):
+        try:
+            self.sftp.close()
+        finally:
+            self.transport.close()
+
+
+class SftpConnectionPool():
+    """
+    Process-wide pool of SFTP connections by (host, port, user).
+
+    The plans of a brand usually run one after the other, reusing the connection saves the TCP and SSH
+    handshakes and the authentication. Idle connections are kept alive with SSH keepalives, checked
+    before being reused and closed after idle_timeout seconds. A connection is only given back to the
+    pool when the request using it ended without errors.
+    """
+    def __init__(self, max_idle=2, idle_timeout=300, check_after=30, keepalive_interval=30, window_size=None, max_packet_size=None, timeout=30):
+        """
+        :param max_idle:            Idle connections kept for each (host, port, user), 0 disables the reuse
+        :param idle_timeout:        Seconds an idle connection is kept
+        :param check_after:         Idle seconds after which a connection is checked with a request before being reused
+        :param keepalive_interval:  Seconds between the SSH keepalives of the connections, 0 disables them
+        :param window_size:         SSH window of the SFTP channels, in bytes (paramiko default if None)
+        :param max_packet_size:     Maximum SSH packet of the SFTP channels, in bytes (paramiko default if None)
+        :param timeout:             Seconds to wait for the TCP connection, the SSH banner and the authentication
+        """
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.keepalive_interval = keepalive_interval
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.timeout = timeout
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.__idle = {}
+        self.__lock = threading.Lock()
+
+    def __key(self, host, port, user, password):
+        # Connections opened with a rotated password are not reused
+        return (host, int(port), user, hashlib.sha256(password.encode("utf-8")).hexdigest())
+
+    def __open(self, key, host, port, user, password):
+        # The TCP connect is bounded too, an unreachable host would block the request otherwise
+        sock = socket.create_connection((host, int(port)), timeout=self.timeout)
+        try:
+            transport = paramiko.Transport(sock)
+        except Exception:
+            sock.close()
+            raise
+        try:
+            transport.banner_timeout = self.timeout
+            transport.auth_timeout = self.timeout
+            # Host keys are not checked, as with the previous pysftp connections (cnopts.hostkeys = None)
+            transport.connect(username=user, password=password)
+            if self.keepalive_interval > 0:
+                transport.set_keepalive(self.keepalive_interval)
+            sftp = paramiko.SFTPClient.from_transport(transport, window_size=self.window_size, max_packet_size=self.max_packet_size)
+        except Exception:
+            transport.close()
+            raise
+
+        with self.__lock:
+            self.created += 1
+        return PooledSftpConnection(key, transport, sftp)
+
+    def __is_healthy(self, connection):
+        if not connection.is_active():
+            return False
+        if time.monotonic() - connection.released_at < self.check_after:
+            return True
+        try:
+            connection.sftp.normalize(".")
+            return True
+        except Exception:
+            return False
+
+    def __pop_idle(self, key):
+        now = time.monotonic()
+        with self.__lock:
+            idle = self.__idle.get(key, [])
+            expired = [connection for connection in idle if now - connection.released_at > self.idle_timeout]
+            idle[:] = [connection for connection in idle if connection not in expired]
+            connection = idle.pop() if idle else None
+
+        for expired_connection in expired:
+            expired_connection.close()
+        return connection
+
+    def acquire(self, host, port, user, password):
+        """
+        Returns an idle connection of the user if there is a healthy one, otherwise opens a new one
+        """
+        key = self.__key(host, port, user, password)
+        while True:
+            connection = self.__pop_idle(key)
+            if connection is None:
+                return self.__open(key, host, port, user, password)
+
+            if self.__is_healthy(connection):
+                with self.__lock:
+                    self.reused += 1
+                return connection
+
+            with self.__lock:
+                self.discarded += 1
+            logger.log_text(f"Pooled SFTP connection to {host} is not usable anymore, discarding it", severity='DEFAULT')
+            connection.close()
+
+    def release(self, connection, reusable=True):
+        """
+        Gives a connection back to the pool, or closes it if it can not be reused
+        """
+        connection.uses += 1
+        connection.released_at = time.monotonic()
+        if reusable and connection.is_active():
+            # The working directory of the session must not leak to the next request
+            connection.sftp.chdir(None)
+            with self.__lock:
+                idle = self.__idle.setdefault(connection.key, [])
+                if len(idle) < self.max_idle:
+                    idle.append(connection)
+                    return
+
+        connection.close()
+
+    @contextmanager
+    def connection(self, host, port, user, password):
+        """
+        SFTP session (paramiko SFTPClient) of a pooled connection, given back to the pool if the
+        block ends without errors
+        """
+        connection = self.acquire(host, port, user, password)
+        reusable = False
+        try:
+            yield connection.sftp
+            reusable = True
+        finally:
+            self.release(connection, reusable)
+
+    def close(self):
+        """
+        Closes all the idle connections
+        """
+        with self.__lock:
+            connections = [connection for idle in self.__idle.values() for connection in idle]
+            self.__idle = {}
+        for connection in connections:
+            connection.close()
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "created": self.created,
+                "reused": self.reused,
+                "discarded": self.discarded,
+                "idle": sum(len(idle) for idle in self.__idle.values())
+            }
+
+
+def open_pipelined(sftp, path, mode="a", buffer_size=None):
+    """
+    Opens a file for writing with a large buffer and pipelined writes: the writes are sent without
+    waiting for the acknowledgement of the previous one, the errors are raised when the file is closed
+
+    :param sftp:                    paramiko SFTPClient
+    :param path:                    Path of the file in the server
+    :param mode:                    Mode of the file, append by default
+    :param buffer_size:             Bytes buffered before they are sent, env sftp_write_buffer_size (1 MB) by default
+    """
+    if buffer_size is None:
+        buffer_size = int(os.environ.get("sftp_write_buffer_size", str(1024 * 1024)))
+    sftp_file = sftp.open(path, mode, bufsize=buffer_size)
+    sftp_file.set_pipelined(True)
+    return sftp_file
+
+
+def new_sftp_pool():
+    """
+    Creates the SFTP connection pool configured from the env variables
+    """
+    window_size = os.environ.get("sftp_window_size", "")
+    max_packet_size = os.environ.get("sftp_max_packet_size", "")
+    return SftpConnectionPool(
+        max_idle = int(os.environ.get("sftp_pool_max_idle", "2")),
+        idle_timeout = int(os.environ.get("sftp_pool_idle_timeout", "300")),
+        check_after = int(os.environ.get("sftp_pool_check_after", "30")),
+        keepalive_interval = int(os.environ.get("sftp_keepalive_interval", "30")),
+        window_size = int(window_size) if window_size else None,
+        max_packet_size = int(max_packet_size) if max_packet_size else None,
+        timeout = int(os.environ.get("sftp_connect_timeout", "30"))
+    )
+
+
+sftp_pool = new_sftp_pool()
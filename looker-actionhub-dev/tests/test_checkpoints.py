@@ -0,0 +1,140 @@
+# Import libs
+import os
+import sys
+from datetime import datetime
+
+import pandas as pd
+import pytest
+from google.cloud.bigquery import SchemaField
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clients
+from checkpoints import CheckpointMismatch, discard_delivery, open_checkpoint, resume_sftp_file
+
+REQUEST = {"scheduled_plan": {"scheduled_plan_id": 7, "title": "Plan"}, "form_params": {"brand": "CLZ"}}
+SENT_DATETIME = datetime(2024, 5, 2, 10, 30)
+
+
+class _FakeSftp():
+    """
+    SFTP client with the sizes of the files in the server
+    """
+    def __init__(self, files):
+        self.files = dict(files)
+        self.truncated = []
+
+    def stat(self, path):
+        if path not in self.files:
+            raise IOError(f"No such file {path}")
+        return type("Attributes", (), {"st_size": self.files[path]})()
+
+    def truncate(self, path, size):
+        self.truncated.append((path, size))
+        self.files[path] = size
+
+    def remove(self, path):
+        if self.files.pop(path, None) is None:
+            raise IOError(f"No such file {path}")
+
+
+class _FakeBigQueryClient():
+    def __init__(self):
+        self.queries = []
+
+    def get_table(self, table_ref):
+        return type("Table", (), {"schema": [SchemaField("SENT_DATETIME", "DATETIME")]})()
+
+    def query(self, sql, job_config=None):
+        self.queries.append((sql, job_config))
+        return type("QueryJob", (), {"result": lambda self: []})()
+
+
+def _chunks(rows, chunksize, name="a"):
+    dataframe = pd.DataFrame({"HerokuID": [f"{name}{i}" for i in range(rows)]})
+    return [dataframe.iloc[start:start + chunksize] for start in range(0, rows, chunksize)]
+
+
+def _interrupted_checkpoint(monkeypatch, tmp_path, sftp_rows=300, bq_rows=200):
+    # First attempt: 500 rows read, the first <sftp_rows> in the SFTP file and <bq_rows> in BigQuery
+    monkeypatch.setenv("checkpoint_store_uri", str(tmp_path))
+    checkpoint = open_checkpoint("sftp_upload", REQUEST, "20240502")
+    checkpoint.start("rows", SENT_DATETIME, "/Import/Plan.csv")
+    for chunk in _chunks(500, 100):
+        checkpoint.track_rows(chunk)
+    checkpoint.record_sftp(sftp_rows, 3000, force=True)
+    checkpoint.record_bigquery(bq_rows)
+    return open_checkpoint("sftp_upload", REQUEST, "20240502")
+
+
+def test_retry_resumes_at_the_checkpoint(monkeypatch, tmp_path):
+    checkpoint = _interrupted_checkpoint(monkeypatch, tmp_path)
+    assert checkpoint.is_resumed and checkpoint.sent_datetime == SENT_DATETIME
+
+    # Same rows in other chunks: only the rows after each point are delivered again
+    starts = [checkpoint.track_rows(chunk) for chunk in _chunks(500, 250)]
+    assert starts == [(250, 200), (50, 0)]
+
+
+def test_changed_csv_is_a_mismatch(monkeypatch, tmp_path):
+    checkpoint = _interrupted_checkpoint(monkeypatch, tmp_path)
+
+    with pytest.raises(CheckpointMismatch):
+        for chunk in _chunks(500, 100, name="b"):
+            checkpoint.track_rows(chunk)
+
+
+def test_bytes_resume_and_mismatch(monkeypatch, tmp_path):
+    monkeypatch.setenv("checkpoint_store_uri", str(tmp_path))
+    data = b"".join(f"row {i}\n".encode("ascii") for i in range(100))
+    checkpoint = open_checkpoint("sftp_upload", REQUEST, "20240502")
+    checkpoint.start("passthrough", SENT_DATETIME, "/Import/Plan.csv")
+    checkpoint.track_bytes(data[:400])
+    checkpoint.track_bytes(data[400:])
+    checkpoint.record_sftp(400, 400, force=True)
+
+    checkpoint = open_checkpoint("sftp_upload", REQUEST, "20240502")
+    assert [checkpoint.track_bytes(data[:300]), checkpoint.track_bytes(data[300:])] == [300, 100]
+
+    checkpoint = open_checkpoint("sftp_upload", REQUEST, "20240502")
+    with pytest.raises(CheckpointMismatch):
+        checkpoint.track_bytes(data[:399] + b"x")
+
+
+def test_sftp_file_is_truncated_to_the_checkpoint(monkeypatch, tmp_path):
+    checkpoint = _interrupted_checkpoint(monkeypatch, tmp_path)
+
+    # Bytes written after the last checkpoint are dropped
+    sftp = _FakeSftp({"/Import/Plan.csv": 3500})
+    assert resume_sftp_file(sftp, checkpoint, "/Import/Plan.csv") == 3000
+    assert sftp.truncated == [("/Import/Plan.csv", 3000)]
+
+
+def test_sftp_file_shorter_than_the_checkpoint_starts_over(monkeypatch, tmp_path):
+    checkpoint = _interrupted_checkpoint(monkeypatch, tmp_path)
+
+    sftp = _FakeSftp({"/Import/Plan.csv": 1000})
+    assert resume_sftp_file(sftp, checkpoint, "/Import/Plan.csv") == 0
+    assert sftp.truncated == [("/Import/Plan.csv", 0)]
+    assert (checkpoint.sftp_position, checkpoint.sftp_bytes) == (0, 0)
+
+    # The rows are written again, the BigQuery progress is kept
+    checkpoint = open_checkpoint("sftp_upload", REQUEST, "20240502")
+    assert checkpoint.track_rows(_chunks(500, 500)[0]) == (0, 200)
+
+
+def test_discard_removes_the_file_the_rows_and_the_checkpoint(monkeypatch, tmp_path):
+    checkpoint = _interrupted_checkpoint(monkeypatch, tmp_path)
+    bigquery_client = _FakeBigQueryClient()
+    clients.register_client("bigquery", bigquery_client)
+    sftp = _FakeSftp({"/Import/Plan.csv": 3000})
+
+    discard_delivery(checkpoint, sftp=sftp, table_ref="dataset.table", channel="MKT", brand="CLZ")
+
+    assert sftp.files == {}
+    sql, job_config = bigquery_client.queries[0]
+    assert sql.strip().startswith("DELETE FROM `dataset.table`")
+    assert {parameter.name: parameter.value for parameter in job_config.query_parameters} == {
+        "sent_datetime": SENT_DATETIME, "channel": "MKT", "brand": "CLZ"
+    }
+    assert not open_checkpoint("sftp_upload", REQUEST, "20240502").is_resumed
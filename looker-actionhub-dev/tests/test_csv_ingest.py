@@ -0,0 +1,21 @@
+# Import libs
+import io
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from csv_ingest import read_csv_chunks
+
+
+def test_multiline_values_across_blocks():
+    # Quoted values with line breaks falling on the boundaries of the 4 KB blocks
+    data = ("Row,HerokuID,Note\n" + "".join(f'{i},{1000000000 + i},"line one\nline two {i}"\n' for i in range(5000))).encode("utf-8")
+
+    expected = pd.read_csv(io.BytesIO(data), dtype=str, index_col=0)
+    chunks = list(read_csv_chunks(io.BytesIO(data), chunksize=700, index_col=0, block_size=4096))
+
+    assert [len(chunk) for chunk in chunks] == [700] * 7 + [100]
+    assert pd.concat(chunks).to_csv() == expected.to_csv()
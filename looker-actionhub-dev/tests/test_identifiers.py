@@ -0,0 +1,50 @@
+# Import libs
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from identifiers import normalize_emails, normalize_phone_numbers
+from utils import normalize_email
+
+EMAILS = [
+    "John.Doe@Example.com",
+    "  spaced@example.com ",
+    "a..b...c@example.com",
+    ".dots.@.example.com.",
+    "ñandú+tag@exämple.com",
+    "quote'd\"name@exa mple.com",
+    "UPPER@EXAMPLE.COM",
+    "x@y"
+]
+
+
+def test_emails_as_the_python_reference():
+    normalized, valid = normalize_emails(EMAILS)
+
+    assert normalized.to_pylist() == [normalize_email(email) for email in EMAILS]
+    assert valid.tolist() == [True] * len(EMAILS)
+
+
+def test_emails_without_both_parts_are_invalid():
+    _, valid = normalize_emails(["no-at-sign", "two@at@signs.com", "@example.com", "...@example.com", None, ""])
+
+    assert valid.tolist() == [False] * 6
+
+
+def test_phone_numbers_to_e164():
+    phone_numbers = ["+34 600-00-00-00", "0034600000000", "600 000 000", "(600) 000 000", "'+34600000000", "123", None]
+    normalized, valid = normalize_phone_numbers(phone_numbers, "ES")
+
+    assert normalized.to_pylist()[:5] == ["+34600000000"] * 5
+    assert valid.tolist() == [True] * 5 + [False, False]
+
+
+def test_national_phone_numbers_follow_the_country():
+    assert normalize_phone_numbers(["06 12 34 56 78"], "FR")[0].to_pylist() == ["+33612345678"]
+    # Italian numbers keep the trunk prefix
+    assert normalize_phone_numbers(["06 1234 5678"], "IT")[0].to_pylist() == ["+390612345678"]
+
+    # Without a known country only international numbers are valid
+    _, valid = normalize_phone_numbers(["+33612345678", "0612345678"], None)
+    assert valid.tolist() == [True, False]
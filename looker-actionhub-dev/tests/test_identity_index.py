@@ -0,0 +1,107 @@
+# Import libs
+import hashlib
+import os
+import sys
+import time
+
+import pyarrow as pa
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+sys.path.insert(0, os.path.join(BASE_DIR, "benchmarks"))
+
+import clients
+import identity_index
+from identity_index import IdentityIndexManager
+from standins import StandInQueryJob
+
+
+class _FakeCountJob():
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+    def result(self):
+        return [{"PAIRS": self.pairs}]
+
+
+class _FakeBigQueryClient():
+    """
+    M_MEDIA_KNOWN_IDENTITY as (customer code, external code) rows. The delta query gets the rows of
+    changed_rows, the COUNT the pairs of rows unless pairs is set
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.changed_rows = []
+        self.pairs = None
+        self.queries = []
+
+    def query(self, sql, job_config=None, **kwargs):
+        self.queries.append(sql)
+        if "COUNT(*) AS PAIRS" in sql:
+            return _FakeCountJob(len(set(self.rows)) if self.pairs is None else self.pairs)
+
+        rows = self.changed_rows if "UPDATED_AT" in sql else self.rows
+        return StandInQueryJob(pa.table({
+            "CUSTOMER_KEY": pa.array([hashlib.sha256(customer_code.encode("utf-8")).digest() for customer_code, _ in rows], pa.binary()),
+            "EXTERNAL_CODE": pa.array([external_code for _, external_code in rows], pa.string())
+        }))
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    manager = IdentityIndexManager(str(tmp_path), delta_column="UPDATED_AT")
+    # The activation layer is updated on the date_last_update of each build
+    monkeypatch.setattr(identity_index.freshness_gate, "check", lambda prefix_project, prefix_dataset: (True, manager.date_last_update, manager.date_last_update))
+    clients.register_client("bigquery_storage", False)
+    return manager
+
+
+def _build(manager, bigquery_client, date_last_update):
+    clients.register_client("bigquery", bigquery_client)
+    manager.date_last_update = date_last_update
+    deadline = time.monotonic() + 30
+    while (index := manager.get("dev-", "dev_")) is None:
+        assert manager.errors == 0 and time.monotonic() < deadline
+        time.sleep(0.01)
+    return index
+
+
+def _external_codes(index, customer_codes):
+    return sorted(index.external_codes(index.lookup_code_ids(customer_codes)).to_pylist())
+
+
+def test_lookup_resolves_the_codes_of_each_customer(manager):
+    index = _build(manager, _FakeBigQueryClient([("C1", "E1"), ("C1", "E2"), ("C2", "E3"), ("C2", "E3")]), "20240502")
+
+    assert _external_codes(index, ["C1", "C3", "C2", "C1"]) == ["E1", "E1", "E2", "E2", "E3"]
+    assert _external_codes(index, ["C3"]) == []
+    assert (index.metadata["customers"], index.metadata["pairs"]) == (2, 3)
+
+
+def test_delta_replaces_the_codes_of_the_changed_customers(manager):
+    bigquery_client = _FakeBigQueryClient([("C1", "E1"), ("C1", "E2"), ("C2", "E3")])
+    _build(manager, bigquery_client, "20240502")
+
+    # C1 remapped to E4, C3 added
+    bigquery_client.rows = [("C1", "E4"), ("C2", "E3"), ("C3", "E1")]
+    bigquery_client.changed_rows = [("C1", "E4"), ("C3", "E1")]
+    index = _build(manager, bigquery_client, "20240503")
+
+    assert index.metadata["delta"]
+    assert _external_codes(index, ["C1"]) == ["E4"]
+    assert _external_codes(index, ["C2", "C3"]) == ["E1", "E3"]
+
+
+def test_count_mismatch_rebuilds_the_whole_index(manager):
+    bigquery_client = _FakeBigQueryClient([("C1", "E1"), ("C2", "E2")])
+    _build(manager, bigquery_client, "20240502")
+
+    # C2 deleted from the table, it is not in the delta of the changes
+    bigquery_client.rows = [("C1", "E1"), ("C3", "E3")]
+    bigquery_client.changed_rows = [("C3", "E3")]
+    index = _build(manager, bigquery_client, "20240503")
+
+    assert any("COUNT(*) AS PAIRS" in sql for sql in bigquery_client.queries)
+    assert not index.metadata["delta"]
+    assert _external_codes(index, ["C1", "C2", "C3"]) == ["E1", "E3"]
@@ -0,0 +1,99 @@
+# Import libs
+import hashlib
+import os
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clients
+from membership_store import DIGEST_SIZE, KEY_DTYPE, MembershipStore, diff_members, drop_kept_identifiers, full_refresh_interval, is_last_upload, sort_keys
+
+
+def _digest(value):
+    return hashlib.sha256(value.encode("utf-8")).digest() if value else bytes(DIGEST_SIZE)
+
+
+def _keys(*members):
+    # Members as (email, phone number), empty when missing
+    return np.array([_digest(email) + _digest(phone_number) for email, phone_number in members], dtype=KEY_DTYPE)
+
+
+def test_new_segment_adds_the_whole_audience():
+    current = sort_keys(_keys(("a@x.com", "+34600000001"), ("b@x.com", "")))
+    keys_to_add, keys_to_remove = diff_members(current, sort_keys([]))
+
+    assert keys_to_add.tolist() == current.tolist()
+    assert len(keys_to_remove) == 0
+
+
+def test_diff_gives_the_added_and_removed_members():
+    previous = sort_keys(_keys(("a@x.com", ""), ("b@x.com", ""), ("c@x.com", "")))
+    current = sort_keys(_keys(("b@x.com", ""), ("c@x.com", ""), ("d@x.com", "")))
+    keys_to_add, keys_to_remove = diff_members(current, previous)
+
+    assert keys_to_add.tolist() == _keys(("d@x.com", "")).tolist()
+    assert keys_to_remove.tolist() == _keys(("a@x.com", "")).tolist()
+
+
+def test_identifiers_still_in_the_audience_are_not_removed():
+    # The phone number of a changed, the email of b moved to another member
+    previous = sort_keys(_keys(("a@x.com", "+34600000001"), ("b@x.com", "+34600000002"), ("c@x.com", "+34600000003")))
+    current = sort_keys(_keys(("a@x.com", "+34600000009"), ("e@x.com", "+34600000002"), ("b@x.com", ""), ("c@x.com", "+34600000003")))
+    _, keys_to_remove = diff_members(current, previous)
+
+    # Only the old phone number of a is removed, b has no identifier left to remove
+    assert drop_kept_identifiers(keys_to_remove, current).tolist() == _keys(("", "+34600000001")).tolist()
+    assert len(drop_kept_identifiers(keys_to_remove, sort_keys([]))) == len(keys_to_remove)
+
+
+def test_full_refresh_interval_is_capped_by_the_ttl():
+    assert full_refresh_interval("30") == timedelta(days=7)
+    assert full_refresh_interval("5") == timedelta(days=3)
+    assert full_refresh_interval("2") == timedelta(days=0)
+    assert full_refresh_interval("30", full_refresh_days=14, ttl_margin_days=20) == timedelta(days=10)
+
+
+def test_snapshot_round_trip(tmp_path):
+    store = MembershipStore(str(tmp_path))
+    keys = sort_keys(_keys(("b@x.com", ""), ("a@x.com", "+34600000001"), ("b@x.com", "")))
+    full_refresh_at = datetime(2024, 5, 1, 8, 0)
+    sent_at = datetime(2024, 5, 2, 9, 30)
+    store.save("CLZ", "ES", "Segment / 1", keys, full_refresh_at, sent_at=sent_at)
+
+    snapshot = store.load("CLZ", "ES", "Segment / 1")
+    assert len(keys) == 2 and snapshot.keys.tolist() == keys.tolist()
+    assert list(snapshot.keys) == sorted(snapshot.keys)
+    assert (snapshot.full_refresh_at, snapshot.sent_at) == (full_refresh_at, sent_at)
+    assert store.load("CLZ", "ES", "Segment / 2") is None
+
+
+class _FakeBigQueryClient():
+    def __init__(self, uploads):
+        self.uploads = uploads
+        self.job_configs = []
+
+    def query(self, sql, job_config=None):
+        self.job_configs.append(job_config)
+        return type("QueryJob", (), {"result": lambda job: [(self.uploads,)]})()
+
+
+def test_snapshot_older_than_the_last_upload(tmp_path):
+    store = MembershipStore(str(tmp_path))
+    store.save("CLZ", "ES", "Segment", sort_keys([]), datetime(2024, 5, 1), sent_at=datetime(2024, 5, 2, 9, 30))
+    snapshot = store.load("CLZ", "ES", "Segment")
+
+    bigquery_client = _FakeBigQueryClient(uploads=0)
+    clients.register_client("bigquery", bigquery_client)
+    assert is_last_upload(snapshot, "p.d.F_LOOKER_SENT", "CLZ", "Segment")
+    assert {parameter.name: parameter.value for parameter in bigquery_client.job_configs[0].query_parameters}["sent_at"] == datetime(2024, 5, 2, 9, 30)
+
+    # Sent by another instance after the snapshot
+    clients.register_client("bigquery", _FakeBigQueryClient(uploads=1200))
+    assert not is_last_upload(snapshot, "p.d.F_LOOKER_SENT", "CLZ", "Segment")
+
+    # Snapshots saved without the time of their upload are never trusted
+    store.save("CLZ", "ES", "Segment", sort_keys([]), datetime(2024, 5, 1))
+    assert not is_last_upload(store.load("CLZ", "ES", "Segment"), "p.d.F_LOOKER_SENT", "CLZ", "Segment")
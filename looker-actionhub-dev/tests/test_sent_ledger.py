@@ -0,0 +1,93 @@
+# Import libs
+import os
+import sys
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clients
+from sent_ledger import SentLedger
+
+
+class _FakeQueryJob():
+    def __init__(self, rows):
+        self.rows = rows
+
+    def result(self):
+        return self.rows
+
+
+class _FakeBigQueryClient():
+    """
+    Answers the grouped load with the rows of loaded_rows and the keyed query with the rows of key_rows
+    """
+    def __init__(self, loaded_rows=(), key_rows=()):
+        self.loaded_rows = list(loaded_rows)
+        self.key_rows = list(key_rows)
+        self.queries = []
+
+    def query(self, sql, job_config=None):
+        self.queries.append((sql, job_config))
+        return _FakeQueryJob(self.key_rows if job_config is not None else self.loaded_rows)
+
+
+def _ledger(bigquery_client):
+    clients.register_client("bigquery", bigquery_client)
+    return SentLedger("dev-", "dev_", refresh_interval=3600)
+
+
+def test_miss_of_the_date_is_checked_in_bigquery():
+    # Sent today by another instance after the ledger was loaded
+    bigquery_client = _FakeBigQueryClient(
+        loaded_rows=[("MKT", "ZA", "CMP1", date(2024, 5, 1))],
+        key_rows=[("MKT", "ZA", "CMP1", date(2024, 5, 2))]
+    )
+    ledger = _ledger(bigquery_client)
+
+    assert ledger.last_sent("MKT", "ZA", "CMP1", date(2024, 5, 2)) == "20240502"
+    sql, job_config = bigquery_client.queries[-1]
+    assert "SENT_DATE = @sent_date" in sql
+    assert {parameter.name: parameter.value for parameter in job_config.query_parameters} == {
+        "sent_date": date(2024, 5, 2), "channel": "MKT", "brand": "ZA", "campaign_code": "CMP1"
+    }
+
+    # Now in the ledger, not queried again
+    assert ledger.last_sent("MKT", "ZA", "CMP1", date(2024, 5, 2)) == "20240502"
+    assert len(bigquery_client.queries) == 2
+
+
+def test_hit_of_the_date_does_not_query():
+    bigquery_client = _FakeBigQueryClient(loaded_rows=[("MKT", "ZA", "CMP1", date(2024, 5, 2))])
+    ledger = _ledger(bigquery_client)
+
+    assert ledger.last_sent("MKT", "ZA", "CMP1", date(2024, 5, 2)) == "20240502"
+    assert len(bigquery_client.queries) == 1
+
+
+def test_record_only_moves_the_dates_forward():
+    ledger = _ledger(_FakeBigQueryClient(loaded_rows=[("ADFORM", "ZA", "SEG1", date(2024, 5, 1))]))
+
+    assert ledger.last_sent("ADFORM", "ZA", "SEG1") == "20240501"
+    assert ledger.last_sent("ADFORM", "ZA", "SEG2") == "00000000"
+
+    ledger.record("ADFORM", "ZA", "SEG2", date(2024, 5, 2))
+    ledger.record("ADFORM", "ZA", "SEG1", date(2024, 5, 2))
+    # A late record of an older date, e.g. by a resumed delivery
+    ledger.record("ADFORM", "ZA", "SEG1", date(2024, 4, 30))
+
+    assert ledger.last_sent("ADFORM", "ZA", "SEG1") == "20240502"
+    assert ledger.last_sent("ADFORM", "ZA", "SEG2") == "20240502"
+    assert ledger.last_sent("MKT", "ZA", "SEG1") == "00000000"
+
+    # Reloads never move back a date recorded in-process and not visible to the query yet
+    ledger.load()
+    assert ledger.last_sent("ADFORM", "ZA", "SEG2") == "20240502"
+    assert ledger.stats()["records"] == 3
+
+
+def test_ledger_table():
+    ledger = _ledger(_FakeBigQueryClient())
+
+    assert ledger.is_ledger_table("dev_clz_c4m_public_activation.F_LOOKER_SENT")
+    assert ledger.is_ledger_table("dev-cross-cloud4marketing:dev_clz_c4m_public_activation.f_looker_sent")
+    assert not ledger.is_ledger_table("dev_clz_c4m_public_activation.F_LOOKER_SENT_COPY")
@@ -0,0 +1,53 @@
+# Import libs
+import json
+import os
+import sys
+
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+sys.path.insert(0, os.path.join(BASE_DIR, "benchmarks"))
+
+from standins import install_standins
+
+
+@pytest.fixture(scope="module")
+def standins():
+    os.environ.update({"GOOGLE_CLOUD_PROJECT": "dev-bench", "execute_mode": "sync"})
+    standins = install_standins()
+    yield standins
+    standins.close()
+
+
+def _request(csv_url):
+    # Loaded in F_LOOKER_SENT, so the sends are recorded in the ledger
+    return {
+        "type": "query",
+        "scheduled_plan": {"download_url": csv_url, "title": "Restart plan", "scheduled_plan_id": 7, "type": "Look"},
+        "form_params": {"path_sftp": "/Import/restart", "brand": "CLZ", "dataset_id": "dev_clz_c4m_public_activation", "table_id": "F_LOOKER_SENT"}
+    }
+
+
+def test_restart_after_mismatch_delivers_again(standins, tmp_path, monkeypatch):
+    monkeypatch.setenv("checkpoint_store_uri", str(tmp_path))
+    import app
+
+    client = app.my_api.test_client()
+    response = client.post("/sftp_upload/execute?mode=sync", json=_request(standins.http.csv_url("sftp", 1000)))
+    assert response.get_json()["looker"]["success"]
+    rows_loaded = standins.bigquery.rows_loaded
+
+    # Left as interrupted after the file was written and the rows committed, the ledger has today's send
+    checkpoint_path = next(tmp_path.glob("*.json"))
+    state = json.loads(checkpoint_path.read_text())
+    checkpoint_path.write_text(json.dumps({**state, "completed": False}))
+
+    # Another CSV for the same plan: the attempt is discarded and the delivery starts over
+    response = client.post("/sftp_upload/execute?mode=sync", json=_request(standins.http.csv_url("sftp", 1000, extra_columns=1)))
+    assert response.get_json()["looker"]["success"]
+
+    files = [size for path, size in standins.sftp.files.items() if path.startswith("/Import/restart/")]
+    assert len(files) == 1 and files[0] > state["sftp_bytes"]
+    assert standins.bigquery.rows_loaded == rows_loaded + 1000
+    assert json.loads(next(tmp_path.glob("*.json")).read_text())["completed"]
@@ -0,0 +1,33 @@
+# Import libs
+import io
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from csv_ingest import read_csv_chunks
+from utils import numeric_customer_codes
+
+
+def _codes(csv_text):
+    chunk = next(read_csv_chunks(io.BytesIO(csv_text.encode("utf-8")), usecols=["HerokuID"]))
+    return numeric_customer_codes(chunk["HerokuID"]).tolist()
+
+
+def test_numeric_codes_lose_leading_zeros():
+    # The codes were read as numbers and converted to str, as pd.read_csv(...)["HerokuID"].apply(str)
+    csv_text = "Row,HerokuID\n1,00123\n2,456\n3,+7\n"
+    expected = pd.read_csv(io.StringIO(csv_text))["HerokuID"].apply(str).tolist()
+
+    assert _codes(csv_text) == expected == ["123", "456", "7"]
+
+
+def test_text_codes_are_sent_as_read():
+    assert _codes("Row,HerokuID\n1,00123\n2,A-456\n") == ["00123", "A-456"]
+
+
+def test_missing_codes_are_sent_as_nan():
+    assert _codes("Row,HerokuID\n1,00123\n2,\n3,A-456\n") == ["00123", "nan", "A-456"]
+    assert _codes("Row,HerokuID\n1,00123\n2,\n") == ["123", "nan"]
@@ -1,55 +1,37 @@
 from datetime import datetime, timedelta
-from google.cloud import bigquery
 
-import os
+from freshness import freshness_gate
+
 import re
 
 
 def is_activation_updated(prefix_project, prefix_dataset):
     """
     Checks if the table in activation layer ha been updated today.
+    The result is cached and shared by all the requests of the process.
     
     :param prefix_project:          Project prefix. Depends on the environment (dev, test, prod)
     :param prefix_dataset:          Dataset prefix. Depends on the environment
     :return                         True if the activation layer was updated, false otherwise     
     """    
-    time_now = (datetime.now() + timedelta(hours=1)).replace(microsecond=0)
-    date_now = time_now.date()
-    timedelta_days = os.environ.get("days_check_updates", "0") # timedelta must be 0 in production (current date)
-    date_today = date_now - timedelta(days=int(timedelta_days)) # for test purposes maybe we want to allow another date different from the current date
-    date_today_str = date_today.strftime("%Y%m%d")
-    
-    # Create a BQ client to check last updated date
-    query = f"""
-        SELECT
-            MIN(LAST_UPDATE_DATE)
-        FROM
-            `{prefix_project}cross-cloud4marketing.{prefix_dataset}clz_c4m_curated.TABLES_LAST_UPDATE`
-        WHERE
-            DATASET_NAME = '{prefix_dataset}clz_c4m_public_activation'
-        """
-    # Run query and extract result
-    df_result = bigquery.Client().query(query).to_dataframe()
-    date_last_update_str = df_result.iloc[0,0].strftime("%Y%m%d")
-
-    # Check if tables are NOT updated yet
-    if (date_last_update_str < date_today_str):
-        return False
+    is_updated, _, _ = freshness_gate.check(prefix_project, prefix_dataset)
     
-    return True
+    return is_updated
 
 
-def append_f_looker_sent(content_bq, campaign_code, brand, channel, prefix_dataset):
+def prepare_f_looker_sent(content_bq, campaign_code, brand, channel, time_now=None):
     """
-    Inserts the data received from Looker in the F_LOOKER_SENT table
-        
-    :param content_bq:              Dataframe to insert in the table
+    Formats the data received from Looker with the columns of the F_LOOKER_SENT table
+
+    :param content_bq:              Dataframe with the CUSTOMER_CODE and CONTENT_DESC columns
     :param campaign_code:           Campaign / segment used
     :param brand:                   Brand code
     :param channel:                 Channel to which the data were sent (Adform, Google Ads...)
-    :param prefix_dataset:          Dataset prefix. Depends on the environment
-    """    
-    time_now = (datetime.now() + timedelta(hours=1)).replace(microsecond=0)
+    :param time_now:                SENT_DATETIME of the rows, current time UTC+1 if not given
+    :return                         Dataframe ready to be appended to F_LOOKER_SENT
+    """
+    if time_now is None:
+        time_now = (datetime.now() + timedelta(hours=1)).replace(microsecond=0)
     date_now = time_now.date()
 
     content_bq["SENT_DATE"] = date_now
@@ -62,12 +44,25 @@ def append_f_looker_sent(content_bq, campaign_code, brand, channel, prefix_datas
     content_bq = content_bq[["SENT_DATE","SENT_DATETIME","CUSTOMER_CODE","CAMPAIGN_CODE","BRAND","CHANNEL","CONTENT_DESC"]]
     content_bq.reset_index(drop=True, inplace=True)
 
-    # Append DataFrame to BQ table
-    client = bigquery.Client()
-    table_ref = f'{prefix_dataset}clz_c4m_public_activation.F_LOOKER_SENT'
-    job_config = bigquery.LoadJobConfig(create_disposition="CREATE_NEVER", write_disposition="WRITE_APPEND")
-    job = client.load_table_from_dataframe(content_bq, table_ref, job_config=job_config)
-    job.result()
+    return content_bq
+
+
+def numeric_customer_codes(codes):
+    """
+    Formats the customer codes of a chunk read as strings as the numeric read of the CSV did: when
+    all the codes are integers they are read as numbers and lose the leading zeros ("00123" is sent
+    as "123"). Other codes are sent as they are, and the missing ones as "nan"
+
+    :param codes:                   Series of strings with the customer codes
+    :return                         Series of strings
+    """
+    is_missing = codes.isna()
+    values = codes[~is_missing]
+    if len(values) > 0 and values.str.fullmatch(r"[+-]?\d{1,18}").all():
+        codes = codes.copy()
+        codes[~is_missing] = values.astype("int64").astype(codes.dtype)
+
+    return codes.fillna("nan")
 
 
 def normalize_email(email):